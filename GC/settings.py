@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.humanize',
+    'rest_framework',
     'gestion'
 ]
 
@@ -78,6 +79,17 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Chaque transaction prend le verrou d'écriture dès son début : les ventes
+            # concurrentes attendent leur tour au lieu d'échouer sur "database is locked"
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        'TEST': {
+            # Base de test sur disque : en mémoire (cache partagé), SQLite rejette les écritures
+            # concurrentes au lieu de les faire attendre, ce que les tests multi-threads exercent
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -142,5 +154,35 @@ DEFAULT_FROM_EMAIL = 'noreply@cahier-ecriture.com'
 # Configuration des notifications
 NOTIFICATION_SEUIL_STOCK = 100
 NOTIFICATION_EMAIL_ACTIF = True
+# Regrouper les notifications en attente dans un seul email récapitulatif par passage
+NOTIFICATION_EMAIL_DIGEST = False
 # Nombre de jours avant échéance pour générer une notification (par défaut 7 jours)
 NOTIFICATION_ECHEANCE_JOURS = 7
+# Intervalle (secondes) entre deux vérifications en mode `manage.py verifier_notifications --daemon`
+NOTIFICATION_INTERVALLE_SECONDES = 900
+
+# Re-rendre les factures PDF en arrière-plan dès qu'une vente change (sinon au prochain téléchargement).
+# Rendus faits dans des threads du processus web : perdus si celui-ci redémarre
+FACTURE_RENDU_ARRIERE_PLAN = False
+# Nombre de threads dédiés au rendu des factures
+FACTURE_RENDU_WORKERS = 1
+# Nombre de processus pour l'export groupé des factures (None : nombre de CPU)
+FACTURE_EXPORT_PROCESSUS = None
+
+# Durée de mise en cache (secondes) des indicateurs du tableau de bord
+DASHBOARD_CACHE_TIMEOUT = 300
+
+# Durée (minutes) pendant laquelle le stock réservé par une saisie de vente reste retenu
+RESERVATION_STOCK_MINUTES = 15
+
+# Répartir l'excédent d'un paiement sur les dettes les plus anciennes d'abord (sinon les plus récentes)
+PAIEMENT_DETTES_ANCIENNES_D_ABORD = False
+
+# Nombre de lignes importées par transaction lors d'un import de paiements CSV
+IMPORT_PAIEMENTS_LOT = 500
+
+# Nombre de lignes importées par transaction lors d'un import de commandes CSV
+IMPORT_COMMANDES_LOT = 1000
+
+# Nombre de ventes par page renvoyées par l'API /api/ventes/ (paramètre `limite` pour changer)
+API_VENTES_PAR_PAGE = 50
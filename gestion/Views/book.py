@@ -1,20 +1,12 @@
 from django.shortcuts import *
-from gestion.models import AnneeScolaire, LigneVente, Cahiers
+from gestion.models import AnneeScolaire, LigneVente, Cahiers, Vente, MouvementStock, TypeMouvementStock
 from gestion.services import NotificationService
 from django.contrib import messages
+from django.db import transaction
 import json
 from decimal import Decimal
 
 def allcahiers(request):
-    # Vérification automatique des notifications lors de la consultation des cahiers
-    notification_service = NotificationService()
-    try:
-        notification_service.verifier_notifications()
-        notification_service.envoyer_notifications_en_attente()
-    except Exception as e:
-        # Log l'erreur mais ne pas interrompre le chargement de la page
-        print(f"Erreur lors de la vérification automatique des notifications: {e}")
-    
     cahiers = Cahiers.objects.all()
     return render(request, 'cahiers.html', {'cahiers': cahiers})
 
@@ -24,7 +16,8 @@ def ajouter_cahier(request):
         titre = request.POST.get("titre")
         prix = Decimal(request.POST.get("prix"))
         quantite_stock = int(request.POST.get("quantite_stock"))
-        Cahiers.objects.create(titre=titre, prix=prix, quantite_stock=quantite_stock)
+        cahier = Cahiers.objects.create(titre=titre, prix=prix, quantite_stock=0)
+        MouvementStock.appliquer({cahier.pk: quantite_stock}, TypeMouvementStock.STOCK_INITIAL)
     return redirect('cahiers')
 
 
@@ -33,21 +26,27 @@ def modifier_cahier(request, cahier_id):
     if request.method == "POST":
         cahier.titre = request.POST.get("titre")
         cahier.prix = Decimal(request.POST.get("prix"))
-        ancien_stock = cahier.quantite_stock
         nouveau_stock = int(request.POST.get("quantite_stock"))
-        cahier.quantite_stock = nouveau_stock
-        cahier.save()
+        # Le stock n'est pas réécrit ici : l'écart avec le stock courant devient un ajustement
+        cahier.save(update_fields=['titre', 'prix', 'updated_at'])
+        variation = MouvementStock.ajuster(cahier.pk, nouveau_stock)
         
         # Si le stock a augmenté, supprimer les notifications de stock faible
-        if nouveau_stock > ancien_stock:
+        if variation > 0:
             NotificationService.supprimer_notifications_stock_cahier(cahier_id)
         
     return redirect('cahiers')
 
 
 def supprimer_cahier(request, cahier_id):
-    cahier = get_object_or_404(Cahiers, id=cahier_id)
-    cahier.delete()
+    # Les lignes de vente du cahier sont supprimées en cascade : recalculer les soldes des ventes concernées,
+    # dans la même transaction pour ne jamais laisser des lignes supprimées avec des soldes périmés
+    with transaction.atomic():
+        cahier = get_object_or_404(Cahiers, id=cahier_id)
+        ventes_concernees = list(Vente.objects.filter(lignes__cahier=cahier).distinct())
+        cahier.delete()
+        for vente in ventes_concernees:
+            vente.recalculer_soldes()
     return redirect('cahiers')
 
 def statistiques_cahiers(request):
@@ -117,8 +116,7 @@ def ajouter_stock(request):
         quantite = int(request.POST.get('quantite', 0))
 
         cahier = get_object_or_404(Cahiers, id=cahier_id)
-        cahier.quantite_stock += quantite
-        cahier.save()
+        MouvementStock.appliquer({cahier.pk: quantite}, TypeMouvementStock.REAPPROVISIONNEMENT)
         
         # Supprimer les notifications de stock faible si le stock est maintenant suffisant
         NotificationService.supprimer_notifications_stock_cahier(cahier_id)
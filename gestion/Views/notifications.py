@@ -10,15 +10,6 @@ import json
 
 def notifications_list(request):
     """Vue pour afficher la liste des notifications"""
-    # Vérification automatique et envoi des notifications à chaque chargement
-    notification_service = NotificationService()
-    try:
-        notification_service.verifier_notifications()
-        notification_service.envoyer_notifications_en_attente()
-    except Exception as e:
-        # Log l'erreur mais ne pas interrompre le chargement de la page
-        print(f"Erreur lors de la vérification automatique des notifications: {e}")
-    
     # Filtres
     type_filtre = request.GET.get('type', '')
     statut_filtre = request.GET.get('statut', '')
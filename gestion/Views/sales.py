@@ -1,31 +1,26 @@
 from django.shortcuts import *
 from gestion.models import Vente, AnneeScolaire, Ecoles
-from gestion.services import NotificationService
-from django.db.models import Sum
+from gestion.conditions import donnees_conditionnelles, toutes_les_annees
+from gestion.factures import FactureData
+from django.db.models import Prefetch, Sum
 from decimal import Decimal
 from gestion.models import Cahiers
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
 from django.views.decorators.http import require_GET
 from django.shortcuts import get_object_or_404, redirect
-from gestion.models import LigneVente, Paiement, Cahiers
+from gestion.models import LigneVente, Paiement, Cahiers, ReservationStock
 from decimal import Decimal
 from django.core.paginator import Paginator
 import json
+import uuid
 from django.views.decorators.http import require_POST
 from datetime import timedelta
 from django.utils import timezone
+from django.conf import settings
+from django.db import transaction
 
 
 def liste_ventes(request):
-    # Vérification automatique des notifications lors de la consultation des ventes
-    notification_service = NotificationService()
-    try:
-        notification_service.verifier_notifications()
-        notification_service.envoyer_notifications_en_attente()
-    except Exception as e:
-        # Log l'erreur mais ne pas interrompre le chargement de la page
-        print(f"Erreur lors de la vérification automatique des notifications: {e}")
-        
     ecole_id = request.GET.get('ecole')
 
     annee_active = AnneeScolaire.get_annee_courante()
@@ -38,50 +33,29 @@ def liste_ventes(request):
             'message': "Aucune année scolaire active n'a été définie."
         })
 
-    # Ventes uniquement pour l'année active
+    # Ventes uniquement pour l'année active, dettes de l'école calculées en SQL
     ventes_qs = Vente.objects.select_related('ecole', 'annee_scolaire') \
         .filter(annee_scolaire=annee_active) \
-        .order_by('-updated_at')
+        .with_totals() \
+        .with_dettes_autres() \
+        .order_by('-updated_at', 'id')
 
     if ecole_id:
         ventes_qs = ventes_qs.filter(ecole__id=ecole_id)
 
-    ventes = []
-    for v in ventes_qs:
-        total_lignes = v.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-        montant_paye = v.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
-        montant_total = total_lignes
-        montant_restant = max(Decimal('0'), montant_total - montant_paye)
-
-        autres_ventes = Vente.objects.filter(ecole=v.ecole, annee_scolaire=annee_active) \
-            .exclude(id=v.id) \
-            .select_related('annee_scolaire')
+    # Paginer avant de matérialiser : seules les 10 ventes de la page sont chargées
+    paginator = Paginator(ventes_qs, 10)
+    page_number = request.GET.get('page')
+    ventes_page = paginator.get_page(page_number)
 
+    ventes = []
+    for v in ventes_page:
         dettes_autres_annees = []
-        total_dettes_autres = Decimal('0')
-        annees_dettes = {}
-
-        for autre in autres_ventes:
-            total_lignes_autre = autre.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-            paye_autre = autre.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
-            restant_autre = total_lignes_autre - paye_autre
-
-            if restant_autre > 0:
-                annee_str = str(autre.annee_scolaire)
-                if annee_str in annees_dettes:
-                    annees_dettes[annee_str] += restant_autre
-                else:
-                    annees_dettes[annee_str] = restant_autre
-
-        for annee_str, montant in annees_dettes.items():
+        if v.dette_autres_annee > 0:
             dettes_autres_annees.append({
-                'annee_scolaire': annee_str,
-                'montant_restant': float(montant)
+                'annee_scolaire': str(v.annee_scolaire),
+                'montant_restant': float(v.dette_autres_annee)
             })
-            total_dettes_autres += montant
-
-        # Calculer la dette totale de l'école (utilise les méthodes du modèle)
-        dette_totale_ecole = v.get_total_dettes_ecole()
 
         ventes.append({
             'id': v.id,
@@ -89,19 +63,16 @@ def liste_ventes(request):
             'ecole': v.ecole,
             'annee_scolaire': v.annee_scolaire,
             'created_at': v.created_at,
-            'montant_total': float(montant_total),
-            'montant_paye': float(montant_paye),
-            'montant_restant': float(montant_restant),
-            'lignes_count': v.lignes.count(),
+            'montant_total': float(v.total_lignes),
+            'montant_paye': float(v.total_paye),
+            'montant_restant': float(v.total_restant),
+            'lignes_count': v.nb_lignes,
             'dettes_autres_annees': dettes_autres_annees,
             'dettes_autres_json': json.dumps(dettes_autres_annees),
-            'total_dettes_autres': float(total_dettes_autres),
-            'dette_totale_ecole': float(dette_totale_ecole),
+            'total_dettes_autres': float(v.dette_autres_annee),
+            'dette_totale_ecole': float(v.dette_ecole),
         })
-
-    paginator = Paginator(ventes, 10)
-    page_number = request.GET.get('page')
-    ventes_page = paginator.get_page(page_number)
+    ventes_page.object_list = ventes
 
     ecoles = Ecoles.objects.all()
     cahiers = Cahiers.objects.all()
@@ -128,15 +99,18 @@ def ventes_ajax(request, ecole_id):
     if not annee_active:
         return JsonResponse({'ventes': []})
     
+    # Paiements valides préchargés en une requête (l'API /api/ventes/ pagine pour les gros historiques)
     ventes = Vente.objects.filter(
         ecole_id=ecole_id, 
         annee_scolaire=annee_active
-    ).prefetch_related('paiements', 'lignes').order_by('-updated_at')
+    ).prefetch_related(
+        Prefetch('paiements', queryset=Paiement.objects.filter(est_annule=False), to_attr='paiements_valides')
+    ).order_by('-updated_at')
     
     data = []
     for vente in ventes:
-        montant_lignes = vente.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-        montant_paye = vente.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
+        montant_lignes = vente.total_lignes
+        montant_paye = vente.total_paye
         montant_restant = montant_lignes - montant_paye
         
         # Déterminer le statut
@@ -149,7 +123,7 @@ def ventes_ajax(request, ecole_id):
         
         # Récupérer les dates de paiement (exclure les paiements annulés)
         paiement_dates = []
-        for paiement in vente.paiements.filter(est_annule=False):
+        for paiement in vente.paiements_valides:
             paiement_dates.append(paiement.date_paiement.strftime('%d/%m/%Y'))
         
         data.append({
@@ -164,33 +138,40 @@ def ventes_ajax(request, ecole_id):
     return JsonResponse({'ventes': data})
 
 
+@donnees_conditionnelles(toutes_les_annees)
 def vente_detail(request, vente_id):
-    vente = get_object_or_404(Vente, id=vente_id)
-    lignes = vente.lignes.select_related('cahier').all()
-    paiements = vente.paiements.all()
-
-    # Calculs (exclure les paiements annulés)
-    montant_lignes = lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-    montant_paye = paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
-    montant_total = montant_lignes
+    # Mêmes données préchargées que la facture PDF : vente, lignes, paiements et dettes de l'école
+    try:
+        donnees = FactureData.charger(vente_id)
+    except Vente.DoesNotExist:
+        raise Http404("Vente introuvable")
+    vente = donnees.vente
+    lignes = donnees.lignes
+    paiements = donnees.paiements
+
+    montant_total = vente.total_lignes
+    montant_paye = vente.total_paye
     montant_restant = montant_total - montant_paye
 
     # Calculer la dette totale de l'école (toutes les ventes impayées)
-    dettes_par_annee = vente.get_dettes_par_annee_ecole()
-    dette_totale_ecole = vente.get_total_dettes_ecole()
+    dettes_par_annee = donnees.dettes_par_annee
+    dette_totale_ecole = donnees.total_dettes_ecole
     
-    # Calculer les dettes des autres ventes (exclure la vente courante)
-    autres_ventes = Vente.objects.filter(ecole=vente.ecole)\
-        .exclude(id=vente.id)\
+    # Autres ventes de l'école, lues une seule fois pour les dettes et les ventes liées
+    autres_ventes = list(
+        Vente.objects.filter(ecole_id=vente.ecole_id)
+        .exclude(id=vente.id)
         .select_related('annee_scolaire')
+        .order_by('-created_at')
+    )
     
     dettes_autres_ventes = []
     total_dettes_autres = Decimal('0')
     
     for autre_vente in autres_ventes:
-        total_lignes_autre = autre_vente.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-        paye_autre = autre_vente.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
-        restant_autre = total_lignes_autre - paye_autre
+        total_lignes_autre = autre_vente.total_lignes
+        paye_autre = autre_vente.total_paye
+        restant_autre = autre_vente.total_restant
         
         if restant_autre > 0:
             total_dettes_autres += restant_autre
@@ -202,7 +183,7 @@ def vente_detail(request, vente_id):
             })
 
     # Obtenir les sessions d'ajout d'articles
-    sessions = vente.get_articles_par_session()
+    sessions = donnees.sessions
 
     # Grouper les articles par type pour la vue classique
     from collections import defaultdict
@@ -217,9 +198,10 @@ def vente_detail(request, vente_id):
     ligne_ventes = list(articles_groupes.values())
 
     # Related ventes for the same ecole & annee (grouped by date)
-    related = Vente.objects.filter(ecole=vente.ecole, annee_scolaire=vente.annee_scolaire).exclude(id=vente.id).order_by('-created_at')
     groups = {}
-    for rv in related:
+    for rv in autres_ventes:
+        if rv.annee_scolaire_id != vente.annee_scolaire_id:
+            continue
         key = rv.created_at.date().isoformat()
         groups.setdefault(key, []).append(rv)
 
@@ -241,6 +223,29 @@ def vente_detail(request, vente_id):
     return render(request, 'vente_detail.html', context)
 
 
+def _articles_data(articles):
+    """Associe les articles {'cahier_id', 'quantite'} à leurs cahiers en une seule requête.
+
+    Les quantités nulles, les identifiants invalides et les cahiers inexistants sont ignorés.
+    """
+    demandes = []
+    for art in articles:
+        try:
+            cahier_id = uuid.UUID(str(art.get('cahier_id')))
+            quantite = int(art.get('quantite', 0))
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if quantite > 0:
+            demandes.append((cahier_id, quantite))
+    
+    cahiers = Cahiers.objects.in_bulk([cahier_id for cahier_id, _ in demandes])
+    return [
+        {'cahier': cahiers[cahier_id], 'quantite': quantite}
+        for cahier_id, quantite in demandes
+        if cahier_id in cahiers
+    ]
+
+
 def modifier_vente(request, vente_id):
     vente = get_object_or_404(Vente, id=vente_id)
     if request.method == 'POST':
@@ -261,24 +266,16 @@ def modifier_vente(request, vente_id):
                 articles.append({'cahier_id': cahier_id, 'quantite': quantite})
 
         # Préparer les données pour la nouvelle méthode
-        articles_data = []
-        for art in articles:
-            try:
-                cahier = get_object_or_404(Cahiers, id=art.get('cahier_id'))
-                quantite = int(art.get('quantite', 0))
-                if quantite <= 0:
-                    continue
-                articles_data.append({
-                    'cahier': cahier,
-                    'quantite': quantite
-                })
-            except Exception:
-                continue
+        articles_data = _articles_data(articles)
         
         # Utiliser la nouvelle méthode avec traçabilité
         if articles_data:
             description = f"Ajout de {len(articles_data)} type(s) d'articles via interface web"
-            vente.ajouter_articles(articles_data, description_session=description)
+            try:
+                vente.ajouter_articles(articles_data, description_session=description, reservation=request.POST.get('reservation'))
+            except ValueError as e:
+                from django.contrib import messages
+                messages.error(request, str(e))
             
     return redirect('ventes')
 
@@ -288,75 +285,8 @@ def gerer_paiement(request, vente_id):
     if request.method == 'POST':
         montant_donne = Decimal(request.POST.get('montant', '0') or '0')
         
-        # Calculer le montant restant de la vente courante (exclure les paiements annulés)
-        montant_lignes = vente.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-        montant_paye_actuel = vente.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
-        montant_restant_vente = max(Decimal('0'), montant_lignes - montant_paye_actuel)
-        
-        # Calculer le total des dettes des autres ventes (toutes années confondues)
-        autres_ventes = Vente.objects.filter(ecole=vente.ecole)\
-            .exclude(id=vente.id)\
-            .select_related('annee_scolaire')\
-            .order_by('-annee_scolaire__annee_debut')
-        
-        total_dettes_autres = Decimal('0')
-        autres_ventes_avec_dettes = []
-        
-        for autre_vente in autres_ventes:
-            total_lignes_autre = autre_vente.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-            paye_autre = autre_vente.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
-            restant_autre = max(Decimal('0'), total_lignes_autre - paye_autre)
-            
-            if restant_autre > 0:
-                total_dettes_autres += restant_autre
-                autres_ventes_avec_dettes.append((autre_vente, restant_autre))
-        
-        # Montant total maximum qu'on peut accepter
-        montant_total_acceptable = montant_restant_vente + total_dettes_autres
-        
-        # Limiter le montant du paiement au montant acceptable
-        montant_paiement = min(montant_donne, montant_total_acceptable)
-        montant_excedent = montant_donne - montant_paiement
-        
-        if montant_paiement > 0:
-            # Enregistrer le paiement pour la vente courante (exclure les paiements annulés pour le calcul du numéro de tranche)
-            last = vente.paiements.filter(est_annule=False).order_by('-numero_tranche').first()
-            numero = (last.numero_tranche + 1) if last else 1
-            
-            # Montant à appliquer à cette vente
-            montant_pour_vente_courante = min(montant_paiement, montant_restant_vente)
-            
-            if montant_pour_vente_courante > 0:
-                Paiement.objects.create(
-                    vente=vente, 
-                    montant=montant_pour_vente_courante, 
-                    numero_tranche=numero
-                )
-            
-            # Calculer l'excédent pour les autres ventes
-            excedent = montant_paiement - montant_pour_vente_courante
-            
-            # Appliquer l'excédent aux autres ventes
-            for autre_vente, restant_autre in autres_ventes_avec_dettes:
-                if excedent <= 0:
-                    break
-                
-                # Montant à appliquer à cette autre vente
-                montant_pour_autre_vente = min(excedent, restant_autre)
-                
-                # Trouver le dernier numéro de tranche pour cette vente (exclure les paiements annulés)
-                last_autre = autre_vente.paiements.filter(est_annule=False).order_by('-numero_tranche').first()
-                numero_autre = (last_autre.numero_tranche + 1) if last_autre else 1
-                
-                # Créer le paiement pour l'autre vente
-                Paiement.objects.create(
-                    vente=autre_vente,
-                    montant=montant_pour_autre_vente,
-                    numero_tranche=numero_autre
-                )
-                
-                # Réduire l'excédent
-                excedent -= montant_pour_autre_vente
+        # Répartir le paiement sur la vente courante puis sur les dettes de l'école
+        montant_excedent = vente.gerer_paiement(montant_donne)
         
         if montant_excedent > 0:
             from django.contrib import messages
@@ -365,6 +295,77 @@ def gerer_paiement(request, vente_id):
     return redirect('ventes')
 
 
+@require_POST
+def importer_paiements(request):
+    """Importe un relevé CSV de paiements téléversé depuis la page des ventes"""
+    from django.contrib import messages
+    from gestion.imports import importer_paiements as importer
+    
+    fichier = request.FILES.get('fichier')
+    if not fichier:
+        messages.error(request, 'Veuillez choisir un fichier CSV')
+        return redirect('ventes')
+    
+    try:
+        rapport = importer(fichier)
+    except ValueError as e:
+        messages.error(request, str(e))
+        return redirect('ventes')
+    
+    if rapport['interruption']:
+        messages.error(request, f"{rapport['interruption']}. Les lignes précédentes ont été traitées.")
+    messages.success(
+        request,
+        f"Import terminé : {rapport['importees']} paiement(s) importé(s) sur {rapport['lignes']} ligne(s), "
+        f"{rapport['doublons']} doublon(s) ignoré(s), {rapport['montant_affecte']} F affecté(s)."
+    )
+    if rapport['montant_non_affecte'] > 0:
+        messages.warning(request, f"{rapport['montant_non_affecte']} F reçus sans dette à régler")
+    if rapport['nb_erreurs']:
+        messages.warning(
+            request,
+            f"{rapport['nb_erreurs']} ligne(s) en erreur : " + ' ; '.join(rapport['erreurs'][:5])
+        )
+    return redirect('ventes')
+
+
+@require_POST
+def importer_commandes(request):
+    """Importe un fichier CSV de commandes téléversé depuis la page des ventes (ou le simule)"""
+    from django.contrib import messages
+    from gestion.imports import importer_commandes as importer
+    
+    fichier = request.FILES.get('fichier')
+    if not fichier:
+        messages.error(request, 'Veuillez choisir un fichier CSV')
+        return redirect('ventes')
+    
+    simulation = bool(request.POST.get('simulation'))
+    try:
+        rapport = importer(fichier, simulation=simulation)
+    except ValueError as e:
+        messages.error(request, str(e))
+        return redirect('ventes')
+    
+    if rapport['interruption']:
+        messages.error(request, f"{rapport['interruption']}. Les lignes précédentes ont été traitées.")
+    prefixe = "Simulation : l'import ajouterait" if simulation else 'Import terminé :'
+    messages.success(
+        request,
+        f"{prefixe} {rapport['importees']} ligne(s) sur {rapport['lignes']}, "
+        f"{rapport['ventes_creees']} vente(s) créée(s) et {rapport['ventes_completees']} complétée(s), "
+        f"{rapport['montant']} F d'articles."
+    )
+    if rapport['ruptures']:
+        messages.warning(request, f"Stock insuffisant pour : {', '.join(rapport['ruptures'])}")
+    if rapport['nb_erreurs']:
+        messages.warning(
+            request,
+            f"{rapport['nb_erreurs']} ligne(s) en erreur : " + ' ; '.join(rapport['erreurs'][:5])
+        )
+    return redirect('ventes')
+
+
 def creer_vente(request):
     """Créer une nouvelle vente avec articles via modal ou ajouter articles à une vente existante"""
     if request.method == 'POST':
@@ -390,22 +391,6 @@ def creer_vente(request):
                     'error': 'Aucune année scolaire active trouvée'
                 })
             
-            # Vérifier si une vente existe déjà pour cette école et année
-            vente_existante = Vente.objects.filter(ecole=ecole, annee_scolaire=annee).first()
-            
-            if vente_existante:
-                # Utiliser la vente existante
-                vente = vente_existante
-                action_message = 'Articles ajoutés à la vente existante'
-            else:
-                now = timezone.now()
-                vente = Vente.objects.create(
-                    ecole=ecole,
-                    annee_scolaire=annee,
-                    date_paiement=now + timedelta(days=30),
-                )
-                action_message = 'Nouvelle vente créée avec succès'
-            
             # Traiter les articles (format JSON comme pour modifier_vente)
             import json as _json
             articles_json = request.POST.get('articles')
@@ -413,21 +398,8 @@ def creer_vente(request):
             
             if articles_json:
                 try:
-                    articles = _json.loads(articles_json)
-                    for art in articles:
-                        cahier_id = art.get('cahier_id')
-                        quantite = int(art.get('quantite', 0))
-                        
-                        if cahier_id and quantite > 0:
-                            try:
-                                cahier = Cahiers.objects.get(id=cahier_id)
-                                articles_data.append({
-                                    'cahier': cahier,
-                                    'quantite': quantite
-                                })
-                            except Cahiers.DoesNotExist:
-                                pass  # Ignorer les cahiers inexistants
-                except (ValueError, TypeError):
+                    articles_data = _articles_data(_json.loads(articles_json))
+                except (ValueError, TypeError, AttributeError):
                     pass  # Ignorer les erreurs de parsing JSON
             
             if not articles_data:
@@ -436,9 +408,25 @@ def creer_vente(request):
                     'error': 'Veuillez ajouter au moins un article valide'
                 })
             
-            # Ajouter les articles à la vente
-            if articles_data:
-                vente.ajouter_articles(articles_data)
+            # Vente créée et articles ajoutés ensemble : un stock insuffisant ne laisse pas de vente vide
+            with transaction.atomic():
+                # Vérifier si une vente existe déjà pour cette école et année
+                vente_existante = Vente.objects.filter(ecole=ecole, annee_scolaire=annee).first()
+                
+                if vente_existante:
+                    # Utiliser la vente existante
+                    vente = vente_existante
+                    action_message = 'Articles ajoutés à la vente existante'
+                else:
+                    now = timezone.now()
+                    vente = Vente.objects.create(
+                        ecole=ecole,
+                        annee_scolaire=annee,
+                        date_paiement=now + timedelta(days=30),
+                    )
+                    action_message = 'Nouvelle vente créée avec succès'
+                
+                vente.ajouter_articles(articles_data, reservation=request.POST.get('reservation'))
             
             return JsonResponse({
                 'success': True,
@@ -447,6 +435,9 @@ def creer_vente(request):
                 'redirect_url': f'/ventes'
             })
             
+        except ValueError as e:
+            # Stock insuffisant : message affiché tel quel dans la fenêtre de vente
+            return JsonResponse({'success': False, 'error': str(e)})
         except Exception as e:
             return JsonResponse({
                 'success': False,
@@ -459,26 +450,63 @@ def creer_vente(request):
     })
 
 
+@require_POST
+def reserver_stock(request):
+    """Retient le stock des articles saisis tant que la fenêtre de vente est ouverte.
+
+    Chaque appel remplace les réservations de la saisie `cle` (créée si absente) ;
+    la clé est ensuite transmise à creer_vente sous le nom `reservation`.
+    """
+    cle = (request.POST.get('cle') or uuid.uuid4().hex)[:64]
+    try:
+        articles = json.loads(request.POST.get('articles') or '[]')
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Articles invalides'}, status=400)
+    
+    quantites = {}
+    for article in _articles_data(articles):
+        cahier = article['cahier']
+        quantites[cahier.pk] = quantites.get(cahier.pk, 0) + article['quantite']
+    
+    reservees = ReservationStock.reserver(cle, quantites)
+    disponibles = ReservationStock.disponibles(quantites.keys(), sauf_cle=cle)
+    expire_le = timezone.now() + timedelta(minutes=getattr(settings, 'RESERVATION_STOCK_MINUTES', 15))
+    
+    return JsonResponse({
+        'success': True,
+        'reservation': cle,
+        'expire_le': expire_le.isoformat(),
+        'articles': [
+            {
+                'cahier_id': str(cahier_id),
+                'demande': quantite,
+                'reserve': reservees.get(cahier_id, 0),
+                'disponible': max(disponibles.get(cahier_id, 0), 0),
+            }
+            for cahier_id, quantite in quantites.items()
+        ],
+    })
+
+
+@require_POST
+def liberer_reservation(request):
+    """Libère le stock retenu par une saisie abandonnée (fenêtre de vente fermée)"""
+    cle = request.POST.get('cle')
+    if not cle:
+        return JsonResponse({'success': False, 'error': 'Réservation manquante'}, status=400)
+    return JsonResponse({'success': True, 'liberees': ReservationStock.liberer(cle)})
+
+
 @require_POST
 def retirer_articles(request, vente_id):
     vente = get_object_or_404(Vente, id=vente_id)
-    lignes = vente.lignes.select_related('cahier').all()
-    modifications = []
-    for idx, ligne in enumerate(lignes):
+    retraits = []
+    for idx in range(vente.nb_lignes):
         cahier_id = request.POST.get(f'cahier_{idx}')
         quantite_retirer = int(request.POST.get(f'quantite_{idx}', 0))
         if cahier_id and quantite_retirer > 0:
-            ligne_vente = vente.lignes.filter(cahier_id=cahier_id).first()
-            if ligne_vente and quantite_retirer <= ligne_vente.quantite:
-                ligne_vente.quantite -= quantite_retirer
-                ligne_vente.montant = ligne_vente.quantite * ligne_vente.cahier.prix
-                ligne_vente.save()
-                # Optionnel: augmenter le stock du cahier
-                ligne_vente.cahier.quantite_stock += quantite_retirer
-                ligne_vente.cahier.save()
-                modifications.append(ligne_vente.cahier.titre)
-    # Optionnel: supprimer les lignes à 0
-    vente.lignes.filter(quantite=0).delete()
+            retraits.append({'cahier_id': cahier_id, 'quantite': quantite_retirer})
+    modifications = vente.retirer_articles(retraits)
     # Message de confirmation
     from django.contrib import messages
     if modifications:
@@ -507,7 +535,7 @@ def supprimer_vente(request, vente_id):
     try:
         # Récupérer les informations pour le message
         ecole_nom = vente.ecole.nom
-        montant_total = vente.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
+        montant_total = vente.total_lignes
         
         # Supprimer la vente (les lignes et paiements seront supprimés en cascade)
         vente.delete()
@@ -537,7 +565,7 @@ def supprimer_vente(request, vente_id):
     try:
         # Récupérer les informations pour le message
         ecole_nom = vente.ecole.nom
-        montant_total = vente.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
+        montant_total = vente.total_lignes
         
         # Supprimer la vente (les lignes et paiements seront supprimés en cascade)
         vente.delete()
@@ -582,10 +610,8 @@ def annuler_paiement(request, vente_id, paiement_id):
         montant_annule = paiement.montant
         numero_tranche = paiement.numero_tranche
         
-        # Marquer le paiement comme annulé
-        paiement.est_annule = True
-        paiement.date_annulation = timezone.now()
-        paiement.save()
+        # Marquer le paiement comme annulé et mettre à jour les soldes de la vente
+        vente.annuler_paiement(paiement)
         
         # Si c'est une requête AJAX, retourner JSON
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -45,11 +45,10 @@ def activer_annee_scolaire(request, annee_id):
     return redirect('annees_scolaires')
 
 def comparaison_annees(request):
-    annees = AnneeScolaire.objects.all().order_by('-annee_debut')[:5]  
+    annees = list(AnneeScolaire.objects.all().order_by('-annee_debut')[:5])
     
     comparaison_data = []
-    for annee in annees:
-        bilan = BilanAnneeScolaire.generer_bilan(annee)
+    for annee, bilan in zip(annees, BilanAnneeScolaire.get_bilans(annees)):
         comparaison_data.append({
             'annee': annee,
             'bilan': bilan,
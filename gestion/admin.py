@@ -1,8 +1,12 @@
-from django.contrib import admin
+import os
+from django.conf import settings
+from django.contrib import admin, messages
+from django.utils.html import format_html, format_html_join
+from .factures import chemin_export, export_en_cours, lancer_export_factures
 from .models import (
     Cahiers, Ecoles, AnneeScolaire, Vente, LigneVente, 
     Paiement, BilanAnneeScolaire, BilanMensuel,
-    Notification, EmailNotification
+    Notification, EmailNotification, MouvementStock
 )
 
 @admin.register(Notification)
@@ -22,3 +26,47 @@ class EmailNotificationAdmin(admin.ModelAdmin):
     search_fields = ['email', 'nom']
 
 # Gardez vos autres registrations existantes si il y en a
+
+@admin.register(AnneeScolaire)
+class AnneeScolaireAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'date_debut', 'date_fin', 'est_active']
+    list_filter = ['est_active']
+    actions = ['exporter_factures']
+
+    @admin.action(description="Exporter toutes les factures (ZIP)")
+    def exporter_factures(self, request, queryset):
+        # Rendu confié à `manage.py exporter_factures` en arrière-plan : une année complète dépasse
+        # largement le délai d'une requête web
+        annees = [annee for annee in queryset.order_by('annee_debut') if not export_en_cours(chemin_export(annee))]
+        if not annees:
+            self.message_user(request, "Un export de ces années est déjà en cours.", messages.WARNING)
+            return
+        lancer_export_factures(annees)
+        liens = format_html_join(
+            ', ', '<a href="{}">{}</a>',
+            ((f"{settings.MEDIA_URL}exports/{os.path.basename(chemin_export(annee))}", str(annee)) for annee in annees),
+        )
+        self.message_user(
+            request,
+            format_html("Export lancé en arrière-plan. Archives disponibles une fois terminées : {}", liens),
+            messages.SUCCESS,
+        )
+
+@admin.register(MouvementStock)
+class MouvementStockAdmin(admin.ModelAdmin):
+    # Journal en ajout seul : consultable, jamais modifié à la main
+    list_display = ['cahier', 'type_mouvement', 'quantite', 'vente', 'date_mouvement']
+    list_filter = ['type_mouvement', 'date_mouvement']
+    search_fields = ['cahier__titre']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('cahier', 'vente__ecole')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,182 @@
+from django.conf import settings
+from django.db.models import Prefetch, Q
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import generics, serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from gestion.models import AnneeScolaire, Paiement, Vente
+import base64
+import binascii
+import hashlib
+import uuid
+
+
+class PaiementResumeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Paiement
+        fields = ['numero_tranche', 'montant', 'date_paiement']
+
+
+class VenteSerializer(serializers.ModelSerializer):
+    """Vente avec ses soldes persistés ; `?champs=id,montant_restant` limite les champs renvoyés"""
+    ecole_nom = serializers.CharField(source='ecole.nom', read_only=True)
+    annee_scolaire = serializers.CharField(source='annee_scolaire.__str__', read_only=True)
+    montant_total = serializers.DecimalField(source='total_lignes', max_digits=15, decimal_places=2, coerce_to_string=False)
+    montant_paye = serializers.DecimalField(source='total_paye', max_digits=15, decimal_places=2, coerce_to_string=False)
+    montant_restant = serializers.DecimalField(source='total_restant', max_digits=15, decimal_places=2, coerce_to_string=False)
+    statut = serializers.SerializerMethodField()
+    paiements = PaiementResumeSerializer(source='paiements_valides', many=True, read_only=True)
+
+    class Meta:
+        model = Vente
+        fields = [
+            'id', 'ecole', 'ecole_nom', 'annee_scolaire', 'created_at', 'updated_at', 'date_paiement',
+            'montant_total', 'montant_paye', 'montant_restant', 'nb_lignes', 'statut', 'paiements',
+        ]
+
+    def __init__(self, *args, champs=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if champs is not None:
+            for nom in set(self.fields) - set(champs):
+                self.fields.pop(nom)
+
+    def get_statut(self, vente):
+        if vente.total_restant <= 0:
+            return 'Payée'
+        if vente.total_paye > 0:
+            return 'Partiellement payée'
+        return 'Non payée'
+
+
+class PaginationParCle(BasePagination):
+    """Pagination par clé (updated_at, id), de la vente la plus récemment modifiée à la plus ancienne.
+
+    Le curseur `?curseur=` désigne la dernière vente de la page précédente : une page coûte une
+    requête indexée, quelle que soit sa profondeur dans l'historique.
+    """
+    cursor_query_param = 'curseur'
+    page_size_query_param = 'limite'
+    max_page_size = 500
+    ordering = ('-updated_at', '-id')
+
+    def encoder(self, vente):
+        position = f'{vente.updated_at.isoformat()}|{vente.pk}'
+        return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+    def decoder(self, curseur):
+        try:
+            position = base64.urlsafe_b64decode(curseur + '=' * (-len(curseur) % 4)).decode()
+            date_texte, vente_id = position.split('|')
+            date_modification = parse_datetime(date_texte)
+            vente_id = uuid.UUID(vente_id)
+        except (ValueError, TypeError, binascii.Error, UnicodeDecodeError):
+            date_modification = None
+        if date_modification is None:
+            raise ValidationError({self.cursor_query_param: 'Curseur invalide'})
+        return date_modification, vente_id
+
+    def get_page_size(self, request):
+        try:
+            limite = int(request.query_params.get(self.page_size_query_param, getattr(settings, 'API_VENTES_PAR_PAGE', 50)))
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: 'Nombre entier attendu'})
+        return max(1, min(limite, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        limite = self.get_page_size(request)
+        curseur = request.query_params.get(self.cursor_query_param)
+        if curseur:
+            date_modification, vente_id = self.decoder(curseur)
+            queryset = queryset.filter(
+                Q(updated_at__lt=date_modification) | Q(updated_at=date_modification, id__lt=vente_id)
+            )
+        page = list(queryset.order_by(*self.ordering)[:limite + 1])
+        self.derniere = page[limite - 1] if len(page) > limite else None
+        return page[:limite]
+
+    def get_next_link(self):
+        if self.derniere is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.encoder(self.derniere))
+
+    def get_paginated_response(self, data):
+        return Response({'suivant': self.get_next_link(), 'ventes': data})
+
+
+class VenteListe(generics.ListAPIView):
+    """GET /api/ventes/ : ventes paginées par clé, filtrables par `ecole` et `annee` (2024-2025 ou courante).
+
+    L'ETag d'une page est calculé sur ses colonnes persistées (une requête légère) : un client qui
+    renvoie If-None-Match reçoit 304 sans que la page soit chargée ni sérialisée.
+    """
+    serializer_class = VenteSerializer
+    pagination_class = PaginationParCle
+    # Colonnes dont dépend la représentation d'une vente, lues pour l'ETag
+    CHAMPS_EMPREINTE = (
+        'id', 'updated_at', 'date_paiement', 'total_lignes', 'total_paye', 'total_restant',
+        'nb_lignes', 'derniere_tranche', 'ecole__nom', 'annee_scolaire_id',
+    )
+
+    def get_champs(self):
+        champs = self.request.query_params.get('champs')
+        if not champs:
+            return None
+        champs = [champ.strip() for champ in champs.split(',') if champ.strip()]
+        inconnus = set(champs) - set(VenteSerializer.Meta.fields)
+        if inconnus:
+            raise ValidationError({'champs': f"Champ(s) inconnu(s) : {', '.join(sorted(inconnus))}"})
+        return champs
+
+    def get_queryset(self):
+        ventes = Vente.objects.all()
+        ecole_id = self.request.query_params.get('ecole')
+        if ecole_id:
+            try:
+                ventes = ventes.filter(ecole_id=uuid.UUID(ecole_id))
+            except ValueError:
+                raise ValidationError({'ecole': 'Identifiant invalide'})
+        libelle = self.request.query_params.get('annee')
+        if libelle:
+            annee = AnneeScolaire.get_annee_courante() if libelle == 'courante' else AnneeScolaire.get_annee_par_libelle(libelle)
+            if annee is None:
+                raise ValidationError({'annee': 'Année scolaire introuvable (format attendu: 2024-2025 ou courante)'})
+            ventes = ventes.filter(annee_scolaire=annee)
+        return ventes
+
+    def get_serializer(self, *args, **kwargs):
+        return super().get_serializer(*args, champs=self.get_champs(), **kwargs)
+
+    def etag(self, page):
+        empreinte = hashlib.sha1(self.request.get_full_path().encode())
+        for vente in page:
+            valeurs = [getattr(vente, champ) for champ in self.CHAMPS_EMPREINTE if '__' not in champ]
+            empreinte.update(repr(valeurs + [vente.ecole.nom]).encode())
+        return quote_etag(empreinte.hexdigest())
+
+    def list(self, request, *args, **kwargs):
+        champs = self.get_champs()
+        page = self.paginate_queryset(
+            self.get_queryset().select_related('ecole').only(*self.CHAMPS_EMPREINTE)
+        )
+        etag = self.etag(page)
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=304, headers={'ETag': etag})
+
+        # Page complète, chargée seulement pour les ventes retenues
+        ventes = Vente.objects.filter(pk__in=[vente.pk for vente in page]).select_related('ecole', 'annee_scolaire')
+        if champs is None or 'paiements' in champs:
+            ventes = ventes.prefetch_related(Prefetch(
+                'paiements',
+                queryset=Paiement.objects.filter(est_annule=False).order_by('numero_tranche'),
+                to_attr='paiements_valides',
+            ))
+        ventes = {vente.pk: vente for vente in ventes}
+        reponse = self.get_paginated_response(
+            self.get_serializer([ventes[vente.pk] for vente in page if vente.pk in ventes], many=True).data
+        )
+        reponse['ETag'] = etag
+        return reponse
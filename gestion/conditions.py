@@ -0,0 +1,64 @@
+import hashlib
+from datetime import datetime, time
+from django.contrib.messages import get_messages
+from django.utils import timezone
+from django.views.decorators.http import condition
+from gestion.models import AnneeScolaire
+
+
+# Change à chaque démarrage du serveur : un déploiement (code, gabarits) invalide les pages déjà servies
+_DEMARRAGE = timezone.now()
+
+
+def _annees(request, filtre):
+    """(id, version, active, modifiée le, créée le) des années retenues, lus une fois par requête"""
+    memo = request.__dict__.setdefault('_versions_donnees', {})
+    cle = repr(sorted(filtre.items()))
+    if cle not in memo:
+        memo[cle] = list(
+            AnneeScolaire.objects.filter(**filtre).order_by('pk')
+            .values_list('pk', 'version_donnees', 'est_active', 'donnees_modifiees_le', 'created_at')
+        )
+    return memo[cle]
+
+
+def donnees_conditionnelles(portee):
+    """Décorateur condition() dont l'ETag et le Last-Modified suivent AnneeScolaire.version_donnees.
+
+    `portee(**kwargs_de_la_vue)` retourne le filtre des années dont dépend la page ; toute écriture de
+    vente, ligne, paiement, cahier ou école incrémente leur version. Une page inchangée est servie en
+    304 sans exécuter la vue, donc sans aucun calcul de bilan ni rendu de PDF.
+    """
+    def etag(request, *args, **kwargs):
+        annees = _annees(request, portee(**kwargs))
+        # Rien à comparer (année absente : la vue répond 404 ou la crée) ou messages à afficher
+        if not annees or len(get_messages(request)):
+            return None
+        versions = [(str(pk), version, active) for pk, version, active, _, _ in annees]
+        # La date du jour en fait partie : tableau de bord et échéances en dépendent
+        empreinte = repr((_DEMARRAGE.isoformat(), request.get_full_path(), timezone.localdate().isoformat(), versions))
+        return hashlib.sha1(empreinte.encode()).hexdigest()
+
+    def derniere_modification(request, *args, **kwargs):
+        annees = _annees(request, portee(**kwargs))
+        # Suppression d'une année non datée : seules les pages d'une seule année ont un Last-Modified
+        if len(annees) != 1:
+            return None
+        _, _, _, modifiee_le, creee_le = annees[0]
+        debut_du_jour = timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+        return max(filter(None, (modifiee_le, creee_le, debut_du_jour, _DEMARRAGE)))
+
+    return condition(etag_func=etag, last_modified_func=derniere_modification)
+
+
+def annee_courante(**kwargs):
+    return {'est_active': True}
+
+
+def annee_de_l_url(annee_id, **kwargs):
+    return {'pk': annee_id}
+
+
+def toutes_les_annees(**kwargs):
+    # Pages d'une vente ou d'une école : elles affichent aussi les dettes des autres années
+    return {}
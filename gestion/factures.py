@@ -0,0 +1,867 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, connections, transaction
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from gestion.models import Vente, LigneVente, Paiement, DetteEcoleAnnee
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from PyPDF2 import PdfReader, PdfWriter, PageObject
+from io import BytesIO
+from decimal import Decimal
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+
+def _dettes_autres_ventes(vente, dettes_par_annee):
+    """Années dont la dette provient d'au moins une autre vente que la vente courante"""
+    dettes_autres = {}
+    for annee_str, dette_info in dettes_par_annee.items():
+        vente_courante_incluse = dette_info['annee_scolaire'].id == vente.annee_scolaire_id and vente.total_restant > 0
+        if dette_info['nb_ventes'] > (1 if vente_courante_incluse else 0):
+            dettes_autres[annee_str] = dette_info
+    return dettes_autres
+
+
+class PapierEnTete:
+    """Registre, par processus, des papiers en-tête PDF fusionnés sous les factures.
+
+    Chaque fichier n'est analysé qu'une fois ; il est relu seulement si sa date
+    de modification change. Les pages analysées restent en mémoire.
+    """
+
+    FICHIERS = {
+        'page': 'static/admin/fa.pdf',
+        'signature': 'static/admin/FACTURE.pdf',
+    }
+
+    _modeles = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def chemin(cls, nom):
+        return os.path.join(settings.BASE_DIR, cls.FICHIERS[nom])
+
+    @classmethod
+    def page(cls, nom):
+        """Première page du modèle, ou None si le fichier est introuvable"""
+        chemin = cls.chemin(nom)
+        try:
+            mtime = os.path.getmtime(chemin)
+        except OSError:
+            return None
+        with cls._lock:
+            modele = cls._modeles.get(nom)
+            if modele is None or modele[0] != mtime:
+                with open(chemin, 'rb') as fichier:
+                    lecteur = PdfReader(BytesIO(fichier.read()))
+                modele = (mtime, lecteur.pages[0])
+                cls._modeles[nom] = modele
+            return modele[1]
+
+    @classmethod
+    def vider(cls):
+        with cls._lock:
+            cls._modeles.clear()
+
+
+# Les pages des modèles sont partagées entre threads : une fusion à la fois
+_fusion_lock = threading.Lock()
+
+
+def fusionner_papier_en_tete(buffer):
+    """Fusionne les pages rendues avec le papier en-tête (signature sur la dernière page)"""
+    fond_page = PapierEnTete.page('page')
+    fond_signature = PapierEnTete.page('signature')
+    if fond_page is None or fond_signature is None:
+        logger.warning("Fichier papier en-tête introuvable : facture rendue sans fond")
+        return buffer.getvalue()
+
+    try:
+        tableau_pdf = PdfReader(buffer)
+        writer = PdfWriter()
+        total_pages = len(tableau_pdf.pages)
+
+        with _fusion_lock:
+            for idx, page_tableau in enumerate(tableau_pdf.pages):
+                fond = fond_signature if idx == total_pages - 1 else fond_page
+
+                page_fusionnee = PageObject.create_blank_page(
+                    width=fond.mediabox.width,
+                    height=fond.mediabox.height
+                )
+                page_fusionnee.merge_page(fond)
+                page_fusionnee.merge_page(page_tableau)
+                writer.add_page(page_fusionnee)
+
+            # L'écriture résout encore des objets des modèles partagés
+            final_buffer = BytesIO()
+            writer.write(final_buffer)
+        return final_buffer.getvalue()
+
+    except Exception as pdf_error:
+        logger.exception(f"Erreur lors de la fusion PDF : {pdf_error}")
+        return buffer.getvalue()
+
+
+@dataclass
+class FactureData:
+    """Données préchargées d'une facture ; sérialisables pour un rendu dans un autre processus"""
+    vente: Vente
+    lignes: list = field(default_factory=list)
+    paiements: list = field(default_factory=list)
+    dettes_par_annee: dict = field(default_factory=dict)
+    total_dettes_ecole: Decimal = Decimal('0')
+
+    @property
+    def sessions(self):
+        return Vente.grouper_par_session(self.lignes)
+
+    @property
+    def paiements_valides(self):
+        """Paiements non annulés, par date, tels qu'affichés sur la facture"""
+        return sorted(
+            (paiement for paiement in self.paiements if not paiement.est_annule),
+            key=lambda paiement: (paiement.date_paiement, paiement.numero_tranche)
+        )
+
+    def empreinte(self):
+        """Empreinte SHA-256 de tout ce qu'affiche la facture : en-tête, lignes, paiements et dettes de l'école"""
+        vente = self.vente
+        contenu = {
+            'vente': [
+                str(vente.id), vente.ecole.nom, vente.ecole.representant, str(vente.annee_scolaire),
+                vente.created_at, vente.modified_at, vente.date_paiement,
+                vente.total_lignes, vente.total_paye, vente.total_restant,
+            ],
+            # Le numéro de facture contient l'année d'édition
+            'edition': datetime.now().year,
+            'lignes': [
+                (ligne.cahier.titre, ligne.cahier.prix, ligne.quantite, ligne.montant, ligne.date_ajout)
+                for ligne in self.lignes
+            ],
+            'paiements': [
+                (paiement.numero_tranche, paiement.montant, paiement.date_paiement)
+                for paiement in self.paiements_valides
+            ],
+            'dettes': [
+                (annee, dette['montant_articles'], dette['montant_paye'], dette['montant_restant'], dette['nb_ventes'])
+                for annee, dette in self.dettes_par_annee.items()
+            ],
+            'total_dettes': self.total_dettes_ecole,
+        }
+        return hashlib.sha256(json.dumps(contenu, default=str).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def charger(cls, vente_id):
+        """Données de la facture d'une vente en quatre requêtes ; lève Vente.DoesNotExist si absente"""
+        donnees = cls.pour_ventes(Vente.objects.filter(pk=vente_id))
+        if not donnees:
+            raise Vente.DoesNotExist(f"Vente {vente_id} introuvable")
+        return donnees[0]
+
+    @classmethod
+    def pour_ventes(cls, ventes):
+        """Charge les données de toutes les factures du queryset en quatre requêtes"""
+        ventes = list(ventes.select_related('ecole', 'annee_scolaire'))
+        ids = [vente.pk for vente in ventes]
+
+        lignes = defaultdict(list)
+        for ligne in LigneVente.objects.filter(vente_id__in=ids).select_related('cahier').order_by('date_ajout', 'id'):
+            lignes[ligne.vente_id].append(ligne)
+
+        paiements = defaultdict(list)
+        for paiement in Paiement.objects.filter(vente_id__in=ids).order_by('numero_tranche'):
+            paiements[paiement.vente_id].append(paiement)
+
+        # Même contenu que DetteEcoleAnnee.dettes_par_annee / total_dette, pour toutes les écoles à la fois
+        dettes = defaultdict(dict)
+        totaux = defaultdict(Decimal)
+        ecoles = {vente.ecole_id for vente in ventes}
+        for dette in DetteEcoleAnnee.objects.filter(ecole_id__in=ecoles).select_related('annee_scolaire'):
+            totaux[dette.ecole_id] += dette.montant_restant
+            if dette.montant_restant > 0:
+                dettes[dette.ecole_id][str(dette.annee_scolaire)] = {
+                    'annee_scolaire': dette.annee_scolaire,
+                    'montant_restant': dette.montant_restant,
+                    'montant_articles': dette.montant_articles,
+                    'montant_total': dette.montant_articles,
+                    'montant_paye': dette.montant_paye,
+                    'nb_ventes': dette.nb_ventes,
+                }
+
+        return [
+            cls(
+                vente=vente,
+                lignes=lignes[vente.pk],
+                paiements=paiements[vente.pk],
+                dettes_par_annee=dettes[vente.ecole_id],
+                total_dettes_ecole=totaux[vente.ecole_id],
+            )
+            for vente in ventes
+        ]
+
+
+def rendre_facture(vente):
+    """Construit la facture PDF de la vente et la fusionne avec le papier en-tête ; retourne les octets"""
+    return construire_facture(FactureData.charger(vente.pk))
+
+
+def construire_facture(donnees):
+    """Mise en page de la facture à partir de données préchargées (FactureData), sans aucune requête"""
+    vente = donnees.vente
+    buffer = BytesIO()
+    
+    # Styles
+    styles_paragraph = getSampleStyleSheet()
+    style_cellule = styles_paragraph['BodyText']
+    style_cellule.wordWrap = 'CJK'
+    style_cellule.leading = 11
+    style_cellule.fontSize = 9
+    
+    # Créer le document PDF
+    doc = SimpleDocTemplate(buffer, pagesize=A4,
+                            leftMargin=2*cm, rightMargin=2*cm,
+                            topMargin=5.5*cm, bottomMargin=4*cm)
+    
+    story = []
+    styles = getSampleStyleSheet()
+    style_normal = styles["Normal"]
+    style_bold = styles["Heading4"]
+    style_important = styles["Heading3"]
+
+    
+    # Style pour le nom de l'école
+    style_header = ParagraphStyle(
+        'HeaderStyle',
+        parent=styles['Normal'],
+        fontSize=9,
+        fontName='Helvetica-Bold',
+        alignment=1,  
+        leading=10,
+        spaceBefore=0,
+        spaceAfter=0,
+        wordWrap='LTR'   
+    )
+
+    # Style pour les valeurs
+    style_ecole = ParagraphStyle(
+        'EcoleStyle',
+        parent=styles['Normal'],
+        fontSize=9,
+        fontName='Helvetica',
+        alignment=1,  
+        leading=10,
+        spaceBefore=0,
+        spaceAfter=0,
+        wordWrap='LTR'   
+    )
+    
+    # Style pour le nom de l'école en rouge
+    style_nom_ecole = ParagraphStyle(
+        'NomEcoleStyle',
+        parent=styles['Normal'],
+        fontSize=12,
+        fontName='Helvetica-Bold',
+        alignment=1,  # Centré
+        textColor=colors.darkred,
+        spaceBefore=0,
+        spaceAfter=5
+    )
+    style_representant = ParagraphStyle(
+        'RepresentantEcoleStyle',
+        parent=styles['Normal'],
+        fontSize=10,
+        fontName='Helvetica-Bold',
+        alignment=1,  # Centré
+        textColor=colors.black,
+        spaceBefore=0,
+        spaceAfter=5
+    )
+    
+    # Informations de la facture
+    representant = vente.ecole.representant if vente.ecole.representant else "—"
+    numero_facture = f"F-{datetime.now().year}-{str(vente.id)[:8]}"
+    date_creation_str = vente.created_at.strftime('%d-%m-%Y') if vente.created_at else "—"
+    date_modif_str = vente.modified_at.strftime('%d-%m-%Y') if vente.modified_at else "—"
+    date_paiement = vente.date_paiement.strftime('%d-%m-%Y') if vente.date_paiement else "—"
+    
+    # Afficher le nom de l'école en rouge au-dessus du tableau
+    story.append(Paragraph(vente.ecole.nom, style_nom_ecole))
+    story.append(Paragraph(f"<b>Représenté par :</b> {representant}", style_representant))
+    story.append(Spacer(0.1, 0.2 * cm))
+    
+    # Tableau d'en-tête avec informations (sans la colonne école)
+    info_data = [
+        [
+            Paragraph("FACTURE", style_header),
+            Paragraph("DATE D'ÉDITION", style_header),
+            Paragraph("DATE DE MODIFICATION", style_header),
+            Paragraph("DATE DE PAIEMENT", style_header),
+            Paragraph("ANNÉE SCOLAIRE", style_header)
+        ],
+        [
+            Paragraph(numero_facture, style_ecole),
+            Paragraph(date_creation_str, style_ecole),
+            Paragraph(date_modif_str, style_ecole),
+            Paragraph(date_paiement, style_ecole),
+            Paragraph(str(vente.annee_scolaire), style_ecole)
+        ]
+    ]
+
+    # Largeurs de colonnes (ajustées sans la colonne école)
+    info_table = Table(info_data, colWidths=[3*cm, 3*cm, 3*cm, 3*cm, 3*cm])
+
+    # Style du tableau
+    info_table_style = TableStyle([
+        ('GRID', (0,0), (-1,-1), 1.5, colors.black),
+        ('BACKGROUND', (0,0), (-1,0), colors.white),
+        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+        ('TOPPADDING', (0,0), (-1,-1), 4),
+        ('BOTTOMPADDING', (0,0), (-1,-1), 4),
+        ('LEFTPADDING', (0,0), (-1,-1), 5),
+        ('RIGHTPADDING', (0,0), (-1,-1), 5),
+    ])
+
+    info_table.setStyle(info_table_style)
+
+    story.append(info_table)
+    story.append(Spacer(0.1, 0.1 * cm))
+    
+    # Récupérer toutes les dettes de l'école par année
+    dettes_par_annee = donnees.dettes_par_annee
+    total_dettes_ecole = donnees.total_dettes_ecole
+    
+    # Affichage des dettes par année (s'il y en a)
+    if len(dettes_par_annee) > 0:
+        # Exclure la vente courante du calcul des autres dettes à afficher
+        dettes_autres = _dettes_autres_ventes(vente, dettes_par_annee)
+        
+        if dettes_autres:
+            story.append(Paragraph("<b>HISTORIQUE DES DETTES PAR ANNÉE SCOLAIRE</b>", style_bold))
+            story.append(Spacer(0.1, 0.1*cm))
+            
+            # Tableau des dettes par année
+            dettes_data = [["Année scolaire", "Montant articles", "Total", "Payé", "Restant dû"]]
+            
+            for annee_str, dette_info in dettes_autres.items():
+                dettes_data.append([
+                    str(dette_info['annee_scolaire']),
+                    f"{dette_info['montant_articles']:.2f} F",
+                    f"{dette_info['montant_total']:.2f} F",
+                    f"{dette_info['montant_paye']:.2f} F",
+                    f"{dette_info['montant_restant']:.2f} F"
+                ])
+            
+            table_dettes = Table(dettes_data, colWidths=[3*cm, 3*cm, 3*cm, 3*cm, 3*cm])
+            table_style_dettes = TableStyle([
+                ('BACKGROUND', (0,0), (-1,0), colors.darkred),
+                ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
+                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0,0), (-1,0), 8),
+                ('BOTTOMPADDING', (0,0), (-1,0), 6),
+                ('TOPPADDING', (0,0), (-1,0), 3),
+                ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
+                ('FONTSIZE', (0,1), (-1,-1), 8),
+                ('TOPPADDING', (0,1), (-1,-1), 3),
+                ('BOTTOMPADDING', (0,1), (-1,-1), 3),
+                ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+                ('GRID', (0,0), (-1,-1), 1, colors.black),
+                ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+            ])
+            
+            # Alterner les couleurs des lignes
+            for i in range(1, len(dettes_data), 2):
+                if i < len(dettes_data):
+                    table_style_dettes.add('BACKGROUND', (0,i), (-1,i), colors.lightgrey)
+            
+            table_dettes.setStyle(table_style_dettes)
+            story.append(table_dettes)
+            story.append(Spacer(0.2, 0.3*cm))
+    
+    # Sessions d'articles de cette facture
+    sessions = donnees.sessions
+    
+    if sessions:
+        story.append(Paragraph("<b>ARTICLES DE CETTE FACTURE PAR SESSION</b>", style_bold))
+        story.append(Spacer(0.1, 0.1*cm))
+        
+        for i, session in enumerate(sessions, 1):
+            # Titre de la session
+            session_title = f"SESSION #{i} - {session['date_session'].strftime('%d-%m-%Y %H:%M')}"
+            story.append(Paragraph(f"<b>{session_title}</b>", style_normal))
+            story.append(Spacer(0.1, 0.1*cm))
+            
+            # Tableau des articles de cette session
+            session_data = [["Cahier", "Quantité", "Prix Unitaire", "Total"]]
+            
+            for ligne in session['lignes']:
+                session_data.append([
+                    Paragraph(ligne.cahier.titre, style_cellule),
+                    str(ligne.quantite),
+                    f"{ligne.cahier.prix:.2f} F",
+                    f"{ligne.montant:.2f} F"
+                ])
+            
+            table_session = Table(session_data, colWidths=[8*cm, 2.5*cm, 3*cm, 3*cm])
+            table_style_session = TableStyle([
+                ('BACKGROUND', (0,0), (-1,0), colors.blue),
+                ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
+                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0,0), (-1,0), 10),
+                ('BOTTOMPADDING', (0,0), (-1,0), 6),
+                ('TOPPADDING', (0,0), (-1,0), 3),
+                ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
+                ('FONTSIZE', (0,1), (-1,-1), 10),
+                ('TOPPADDING', (0,1), (-1,-1), 3),
+                ('BOTTOMPADDING', (0,1), (-1,-1), 3),
+                ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+                ('GRID', (0,0), (-1,-1), 1, colors.black),
+                ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+            ])
+            
+            # Alterner les couleurs des lignes
+            for j in range(1, len(session_data), 2):
+                if j < len(session_data):
+                    table_style_session.add('BACKGROUND', (0,j), (-1,j), colors.lightgrey)
+            
+            table_session.setStyle(table_style_session)
+            story.append(table_session)
+            
+            # Sous-total de la session
+            story.append(Spacer(0.1, 0.2*cm))
+            story.append(Paragraph(f"<b>Sous-total session #{i} : {session['montant_total']:.2f} F</b>", style_normal))
+            story.append(Spacer(0.2, 0.3*cm))
+    
+    # Récapitulatif financier
+    montant_total_articles = vente.total_lignes
+    montant_total_facture = montant_total_articles
+    
+    # Paiements (exclure les paiements annulés)
+    paiements_vente = donnees.paiements_valides
+    montant_paye = vente.total_paye
+    montant_restant_facture = montant_total_facture - montant_paye
+    
+    story.append(Spacer(1, 0.3*cm))
+    
+    # Préparation des données du récapitulatif
+    recap_data = []
+    
+    # Ligne articles
+    recap_data.append([
+        "Sous-total des articles :",
+        f"{montant_total_articles:.2f} F"
+    ])
+    
+    # Ligne total de cette facture
+    recap_data.append([
+        "Total de la facture :",
+        f"{montant_total_facture:.2f} F"
+    ])
+    
+    # Ligne montant payé
+    recap_data.append([
+        "Paiements reçus :",
+        f"{montant_paye:.2f} F" if montant_paye > 0 else "Aucun paiement"
+    ])
+    
+    # Calculer les dettes antérieures (excluant la vente courante)
+    dettes_autres = _dettes_autres_ventes(vente, dettes_par_annee)
+    total_dettes_autres = sum(Decimal(str(dette_info['montant_restant'])) for dette_info in dettes_autres.values())
+    
+    # Colonne STATUS (tenir compte des dettes antérieures)
+    if montant_restant_facture > 0:
+        # Facture courante pas totalement payée
+        if vente.montant_paye == 0:
+            status_text = "IMPAYÉ"
+        else:
+            status_text = "PARTIELLEMENT PAYÉ"
+    else:
+        # Facture courante payée, mais vérifier les dettes antérieures
+        if total_dettes_autres > 0:
+            status_text = "PARTIELLEMENT PAYÉ"  # Facture payée mais dettes restantes
+        else:
+            status_text = "PAYÉ"  # Tout est payé
+    
+    recap_data.append([
+        "Status :",
+        status_text
+    ])
+    
+    # Colonne RESTE À PAYER avec indication de la nature du montant
+    total_reste_a_payer = montant_restant_facture + total_dettes_autres
+    
+    if total_reste_a_payer > 0:
+        # Déterminer le libellé approprié avec parenthèses pour clarification
+        if montant_restant_facture > 0 and total_dettes_autres > 0:
+            # Il y a à la fois du reste sur facture ET des dettes antérieures
+            libelle_reste = "Reste à payer (Dette + Reste) :"
+        elif total_dettes_autres > 0 and montant_restant_facture == 0:
+            # Seulement des dettes antérieures
+            libelle_reste = "Reste à payer (Dette) :"
+        else:
+            # Seulement du reste sur la facture courante
+            libelle_reste = "Reste à payer (Reste) :"
+        
+        recap_data.append([
+            libelle_reste,
+            f"{total_reste_a_payer:.2f} F"
+        ])
+    else:
+        recap_data.append([
+            "Reste à payer :",
+            "0 F"
+        ])
+    
+    # Si il y a d'autres dettes, ajouter le total global
+    if len(dettes_par_annee) > 1:
+        recap_data.append([
+            "Encours global de l'établissement :",
+            f"{total_dettes_ecole:.2f} F"
+        ])
+    
+    recap_table = Table(recap_data, colWidths=[10*cm, 6.5*cm])
+    recap_table_style = TableStyle([
+        ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,0), (-1,-1), 10),
+        ('ALIGN', (0,0), (0,-1), 'LEFT'),     
+        ('ALIGN', (1,0), (1,-1), 'RIGHT'),    
+        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+        ('GRID', (0,0), (-1,-1), 1, colors.black),
+        ('TOPPADDING', (0,0), (-1,-1), 4),
+        ('BOTTOMPADDING', (0,0), (-1,-1), 4),
+        ('LEFTPADDING', (0,0), (-1,-1), 6),
+        ('RIGHTPADDING', (0,0), (-1,-1), 6),
+    ])
+    
+    # Mise en forme spéciale pour certaines lignes
+    ligne_total_facture = 1  
+    ligne_status = 2  # Position de la ligne Status
+    ligne_reste_a_payer = 3  # Position de la ligne Reste à payer/Dette/etc.
+    
+    # Ligne total facture en gris
+    recap_table_style.add('BACKGROUND', (0,ligne_total_facture), (-1,ligne_total_facture), colors.lightgrey)
+    recap_table_style.add('FONTNAME', (0,ligne_total_facture), (-1,ligne_total_facture), 'Helvetica-Bold')
+    
+    # Colorer la ligne STATUS selon l'état
+    if status_text == "PAYÉ":
+        recap_table_style.add('BACKGROUND', (0,ligne_status), (-1,ligne_status), colors.lightgreen)
+        recap_table_style.add('TEXTCOLOR', (0,ligne_status), (-1,ligne_status), colors.darkgreen)
+        recap_table_style.add('FONTNAME', (0,ligne_status), (-1,ligne_status), 'Helvetica-Bold')
+    elif status_text == "PARTIELLEMENT PAYÉ":
+        recap_table_style.add('BACKGROUND', (0,ligne_status), (-1,ligne_status), colors.lightyellow)
+        recap_table_style.add('TEXTCOLOR', (0,ligne_status), (-1,ligne_status), colors.orange)
+        recap_table_style.add('FONTNAME', (0,ligne_status), (-1,ligne_status), 'Helvetica-Bold')
+    elif status_text == "IMPAYÉ":
+        recap_table_style.add('BACKGROUND', (0,ligne_status), (-1,ligne_status), colors.lightcoral)
+        recap_table_style.add('TEXTCOLOR', (0,ligne_status), (-1,ligne_status), colors.darkred)
+        recap_table_style.add('FONTNAME', (0,ligne_status), (-1,ligne_status), 'Helvetica-Bold')
+    
+    # Colorer la ligne "reste à payer" selon l'état
+    if total_reste_a_payer <= 0:
+        recap_table_style.add('BACKGROUND', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), colors.lightgreen)
+        recap_table_style.add('TEXTCOLOR', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), colors.darkgreen)
+        recap_table_style.add('FONTNAME', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), 'Helvetica-Bold')
+    else:
+        recap_table_style.add('BACKGROUND', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), colors.lightyellow)
+        recap_table_style.add('TEXTCOLOR', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), colors.orange)
+        recap_table_style.add('FONTNAME', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), 'Helvetica-Bold')
+    
+    # Si il y a un total des dettes école, le mettre en évidence
+    if len(dettes_par_annee) > 1:
+        ligne_total_ecole = len(recap_data) - 1
+        recap_table_style.add('BACKGROUND', (0,ligne_total_ecole), (-1,ligne_total_ecole), colors.lightyellow)
+        recap_table_style.add('FONTNAME', (0,ligne_total_ecole), (-1,ligne_total_ecole), 'Helvetica-Bold')
+        recap_table_style.add('FONTSIZE', (0,ligne_total_ecole), (-1,ligne_total_ecole), 11)
+    
+    recap_table.setStyle(recap_table_style)
+    story.append(recap_table)
+    story.append(Spacer(1, 0.5*cm))
+    if paiements_vente:
+        style_paiement = ParagraphStyle(
+            'PaiementStyle',
+            parent=styles['Normal'],
+            fontSize=10,
+            fontName='Helvetica',
+            textColor=colors.red,
+            spaceBefore=2,
+            spaceAfter=2
+        )
+        
+        style_paiement_bold = ParagraphStyle(
+            'PaiementBoldStyle',
+            parent=styles['Normal'],
+            fontSize=10,
+            fontName='Helvetica-Bold',
+            textColor=colors.darkred,
+            spaceBefore=2,
+            spaceAfter=2
+        )
+        
+        story.append(Paragraph("<b>HISTORIQUE DES PAIEMENTS :</b>", style_paiement_bold))
+        for paiement in paiements_vente:
+            paiement_text = f"Tranche {paiement.numero_tranche} : {paiement.montant:.2f} FCFA payé le {paiement.date_paiement.strftime('%d-%m-%Y')}"
+            story.append(Paragraph(paiement_text, style_paiement_bold))
+        
+    story.append(Spacer(1, 0.5*cm))
+    story.append(Paragraph("Merci pour votre confiance !", 
+                          ParagraphStyle('Thanks', parent=styles['Normal'], 
+                                       alignment=TA_CENTER, fontSize=12, 
+                                       textColor=colors.darkblue)))
+    story.append(Spacer(1, 0.2*cm))
+    # Le PDF est stocké et resservi tant que la vente ne change pas : la date est celle du rendu
+    story.append(Paragraph(f"Document rendu le {timezone.now().strftime('%d/%m/%Y à %H:%M')}", 
+                          ParagraphStyle('Generated', parent=styles['Normal'], 
+                                       alignment=TA_CENTER, fontSize=8, 
+                                       textColor=colors.grey)))
+    
+    # Construire le PDF principal
+    doc.build(story)
+    buffer.seek(0)
+    
+    return fusionner_papier_en_tete(buffer)
+
+
+def _nom_fichier(vente, empreinte):
+    return f"factures/facture_{vente.id}_{empreinte[:16]}.pdf"
+
+
+def facture_a_jour(vente, empreinte):
+    """Vrai si le fichier stocké correspond à l'empreinte courante"""
+    return bool(
+        vente.facture_pdf
+        and vente.facture_empreinte == empreinte
+        and vente.facture_pdf.storage.exists(vente.facture_pdf.name)
+    )
+
+
+def enregistrer_facture(donnees, empreinte=None):
+    """Rend la facture et la stocke dans Vente.facture_pdf avec son empreinte ; retourne les octets"""
+    vente = donnees.vente
+    empreinte = empreinte or donnees.empreinte()
+    contenu = construire_facture(donnees)
+
+    ancien_nom = vente.facture_pdf.name if vente.facture_pdf else None
+    nom = _nom_fichier(vente, empreinte)
+    storage = Vente._meta.get_field('facture_pdf').storage
+    if storage.exists(nom):
+        storage.delete(nom)
+    nom = storage.save(nom, ContentFile(contenu))
+
+    Vente.objects.filter(pk=vente.pk).update(facture_pdf=nom, facture_empreinte=empreinte)
+    vente.facture_pdf.name = nom
+    vente.facture_empreinte = empreinte
+
+    if ancien_nom and ancien_nom != nom and storage.exists(ancien_nom):
+        storage.delete(ancien_nom)
+    return contenu
+
+
+def obtenir_facture(donnees):
+    """Contenu PDF de la facture : relu depuis le fichier tant que l'empreinte est inchangée, rendu sinon"""
+    empreinte = donnees.empreinte()
+    if facture_a_jour(donnees.vente, empreinte):
+        with donnees.vente.facture_pdf.open('rb') as fichier:
+            return fichier.read()
+    return enregistrer_facture(donnees, empreinte)
+
+
+_executeur = None
+_executeur_lock = threading.Lock()
+# Ventes dont le rendu est déjà en file : les modifications en rafale n'en ajoutent pas d'autre
+_rendus_en_attente = set()
+# Ventes à re-rendre en fin de bloc rendus_differes(), par thread
+_rendus_differes = threading.local()
+
+
+def _executeur_rendu():
+    global _executeur
+    with _executeur_lock:
+        if _executeur is None:
+            _executeur = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'FACTURE_RENDU_WORKERS', 1),
+                thread_name_prefix='rendu-facture',
+            )
+        return _executeur
+
+
+def _rendre_en_arriere_plan(vente_id):
+    with _executeur_lock:
+        _rendus_en_attente.discard(vente_id)
+    close_old_connections()
+    try:
+        donnees = FactureData.charger(vente_id)
+        empreinte = donnees.empreinte()
+        if not facture_a_jour(donnees.vente, empreinte):
+            enregistrer_facture(donnees, empreinte)
+    except Vente.DoesNotExist:
+        pass
+    except Exception as e:
+        logger.error(f"Erreur lors du rendu de la facture {vente_id}: {str(e)}")
+    finally:
+        close_old_connections()
+
+
+def planifier_rendu(vente_id):
+    """Programme le re-rendu de la facture après validation de la transaction en cours.
+
+    Désactivé par défaut : obtenir_facture re-rend déjà une facture périmée au téléchargement suivant.
+    """
+    if not getattr(settings, 'FACTURE_RENDU_ARRIERE_PLAN', False):
+        return
+    transaction.on_commit(lambda: _soumettre_rendu(vente_id))
+
+
+def _soumettre_rendu(vente_id):
+    differes = getattr(_rendus_differes, 'ventes', None)
+    if differes is not None:
+        differes.add(vente_id)
+        return
+    with _executeur_lock:
+        if vente_id in _rendus_en_attente:
+            return
+        _rendus_en_attente.add(vente_id)
+    _executeur_rendu().submit(_rendre_en_arriere_plan, vente_id)
+
+
+@contextmanager
+def rendus_differes():
+    """Regroupe les re-rendus validés dans le bloc (imports en masse) : un seul par vente, à la sortie"""
+    if getattr(_rendus_differes, 'ventes', None) is not None:
+        yield
+        return
+    _rendus_differes.ventes = set()
+    try:
+        yield
+    finally:
+        ventes, _rendus_differes.ventes = _rendus_differes.ventes, None
+        for vente_id in ventes:
+            _soumettre_rendu(vente_id)
+
+
+def _initialiser_processus():
+    # Processus démarrés par « spawn » : Django doit être configuré pour désérialiser les modèles
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _nom_archive(vente):
+    return f"{vente.annee_scolaire}/{get_valid_filename(f'facture_{vente.ecole.nom}_{str(vente.id)[:8]}.pdf')}"
+
+
+def _rendre_pour_export(donnees):
+    return _nom_archive(donnees.vente), construire_facture(donnees)
+
+
+def exporter_factures(ventes, chemin_zip, processus=None):
+    """Rend les factures du queryset dans un pool de processus et les écrit au fil de l'eau dans une archive ZIP.
+
+    Les données sont chargées en quelques requêtes avant le rendu ; les processus ne touchent pas à la base.
+    L'archive est écrite sous un nom temporaire puis renommée : une archive visible est toujours complète.
+    Retourne le nombre de factures, la durée, le débit et la taille de l'archive.
+    """
+    debut = time.perf_counter()
+    donnees = FactureData.pour_ventes(ventes)
+    processus = processus or getattr(settings, 'FACTURE_EXPORT_PROCESSUS', None) or os.cpu_count() or 1
+
+    dossier = os.path.dirname(chemin_zip)
+    if dossier:
+        os.makedirs(dossier, exist_ok=True)
+
+    nombre = 0
+    temporaire = f'{chemin_zip}.{os.getpid()}.tmp'
+    try:
+        with zipfile.ZipFile(temporaire, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            if processus == 1 or len(donnees) <= 1:
+                for nom, contenu in map(_rendre_pour_export, donnees):
+                    archive.writestr(nom, contenu)
+                    nombre += 1
+            else:
+                # Connexions fermées avant le fork : les processus enfants ne doivent pas les partager
+                connections.close_all()
+                taille_lot = max(1, len(donnees) // (processus * 4))
+                with ProcessPoolExecutor(max_workers=processus, initializer=_initialiser_processus) as executeur:
+                    for nom, contenu in executeur.map(_rendre_pour_export, donnees, chunksize=taille_lot):
+                        archive.writestr(nom, contenu)
+                        nombre += 1
+        os.replace(temporaire, chemin_zip)
+    finally:
+        for chemin in (temporaire, _marqueur_export(chemin_zip)):
+            if os.path.exists(chemin):
+                os.remove(chemin)
+
+    duree = time.perf_counter() - debut
+    return {
+        'factures': nombre,
+        'duree': duree,
+        'par_seconde': nombre / duree if duree > 0 else 0,
+        'taille': os.path.getsize(chemin_zip),
+        'processus': processus,
+    }
+
+
+def chemin_export(annee):
+    """Archive des factures d'une année écrite par `manage.py exporter_factures`"""
+    return os.path.join(settings.MEDIA_ROOT, 'exports', f'factures_{annee}.zip')
+
+
+def _marqueur_export(chemin_zip):
+    return f'{chemin_zip}.en_cours'
+
+
+def export_en_cours(chemin_zip):
+    """Vrai si un export de l'archive a été lancé depuis moins d'une heure et n'est pas terminé"""
+    try:
+        return time.time() - os.path.getmtime(_marqueur_export(chemin_zip)) < 3600
+    except OSError:
+        return False
+
+
+def lancer_export_factures(annees):
+    """Lance `manage.py exporter_factures` pour ces années dans un processus détaché.
+
+    Le rendu (pool de processus, plusieurs minutes sur une année complète) se fait hors du
+    processus web ; la sortie de la commande est ajoutée à exports/exporter_factures.log.
+    """
+    import subprocess
+    import sys
+
+    dossier = os.path.join(settings.MEDIA_ROOT, 'exports')
+    os.makedirs(dossier, exist_ok=True)
+    commande = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'exporter_factures']
+    marqueurs = []
+    for annee in annees:
+        commande += ['--annee', str(annee)]
+        # Marqueur posé avant le lancement, retiré par exporter_factures en fin d'export
+        marqueurs.append(_marqueur_export(chemin_export(annee)))
+        open(marqueurs[-1], 'w').close()
+    try:
+        with open(os.path.join(dossier, 'exporter_factures.log'), 'ab') as journal:
+            export = subprocess.Popen(
+                commande, cwd=settings.BASE_DIR, stdin=subprocess.DEVNULL, stdout=journal,
+                stderr=subprocess.STDOUT, start_new_session=True,
+            )
+    except OSError:
+        for marqueur in marqueurs:
+            os.remove(marqueur)
+        raise
+    # Attendre la fin en arrière-plan pour ne pas laisser de processus zombie
+    threading.Thread(target=export.wait, daemon=True).start()
@@ -0,0 +1,400 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from gestion.factures import rendus_differes
+from gestion.models import AnneeScolaire, Cahiers, Ecoles, Paiement, ReservationStock, Vente
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+import codecs
+import csv
+import io
+import itertools
+import logging
+import time
+import unicodedata
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Noms de colonnes acceptés (après normalisation) pour chaque champ d'une ligne de relevé
+COLONNES_PAIEMENTS = {
+    'ecole': ('ecole', 'ecole_id', 'nom_ecole', 'client'),
+    'montant': ('montant', 'amount', 'somme'),
+    'date': ('date', 'date_paiement', 'date_operation'),
+    'reference': ('reference', 'ref', 'transaction', 'id_transaction'),
+}
+COLONNES_COMMANDES = {
+    'ecole': COLONNES_PAIEMENTS['ecole'],
+    'cahier': ('cahier', 'cahier_id', 'titre', 'article', 'designation'),
+    'quantite': ('quantite', 'qte', 'quantity', 'nombre'),
+}
+FORMATS_DATE = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d/%m/%y')
+# Nombre maximal d'erreurs détaillées dans le rapport (les suivantes sont seulement comptées)
+ERREURS_DETAILLEES = 50
+
+
+def _normaliser(texte):
+    """Minuscules, sans accents ni espaces superflus : 'École ' -> 'ecole'"""
+    texte = unicodedata.normalize('NFKD', str(texte or '')).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(texte.lower().split())
+
+
+def _encodage(binaire):
+    """'utf-8-sig' si le fichier est de l'UTF-8 valide, sinon 'cp1252' (exports Excel et bancaires)"""
+    if not binaire.seekable():
+        return 'utf-8-sig'
+    decodeur = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for bloc in iter(lambda: binaire.read(1 << 16), b''):
+            decodeur.decode(bloc)
+        decodeur.decode(b'', final=True)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'cp1252'
+    finally:
+        binaire.seek(0)
+
+
+def ouvrir_texte(fichier):
+    """Flux texte sur un fichier téléversé ou ouvert en binaire, lu au fil de l'eau (UTF-8 ou cp1252)"""
+    binaire = getattr(fichier, 'file', fichier)
+    return io.TextIOWrapper(binaire, encoding=_encodage(binaire), errors='replace', newline='')
+
+
+def _interruption(rapport, erreur):
+    """Message d'un fichier illisible en cours de lecture ; les lignes déjà lues restent importées"""
+    return f"Lecture interrompue après la ligne {rapport['lignes'] + 1} : fichier illisible ({erreur})"
+
+
+def lire_csv(flux, colonnes):
+    """Itère sur les lignes d'un CSV (séparateur ',', ';' ou tabulation détecté sur l'en-tête).
+
+    Produit des couples (numéro de ligne, {champ: valeur}) sans charger le fichier en mémoire.
+    """
+    entete = flux.readline()
+    if not entete.strip():
+        return
+    separateur = max(',;\t', key=entete.count)
+    lecteur = csv.reader(itertools.chain([entete], flux), delimiter=separateur)
+
+    positions = {}
+    for position, nom in enumerate(next(lecteur)):
+        nom = _normaliser(nom).replace(' ', '_')
+        for champ, alias in colonnes.items():
+            if nom in alias and champ not in positions:
+                positions[champ] = position
+
+    for numero, valeurs in enumerate(lecteur, start=2):
+        if not any(valeur.strip() for valeur in valeurs):
+            continue
+        yield numero, {
+            champ: valeurs[position].strip() if position < len(valeurs) else ''
+            for champ, position in positions.items()
+        }
+
+
+def lire_montant(valeur):
+    """'1 500,50' ou '1500.50' -> Decimal('1500.50')"""
+    try:
+        montant = Decimal(valeur.replace('\xa0', '').replace(' ', '').replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f'Montant invalide : {valeur!r}')
+    if not montant.is_finite() or montant <= 0:
+        raise ValueError(f'Montant invalide : {valeur!r}')
+    return montant.quantize(Decimal('0.01'))
+
+
+def lire_quantite(valeur):
+    try:
+        quantite = int(valeur.replace('\xa0', '').replace(' ', ''))
+    except ValueError:
+        raise ValueError(f'Quantité invalide : {valeur!r}')
+    if quantite <= 0:
+        raise ValueError(f'Quantité invalide : {valeur!r}')
+    return quantite
+
+
+def lire_date(valeur):
+    if not valeur:
+        return date.today()
+    for format_date in FORMATS_DATE:
+        try:
+            return datetime.strptime(valeur, format_date).date()
+        except ValueError:
+            continue
+    raise ValueError(f'Date invalide : {valeur!r}')
+
+
+class IndexEcoles:
+    """Résolution en mémoire d'une école par identifiant ou par nom, chargée en une requête"""
+
+    def __init__(self):
+        self.par_id = {}
+        self.par_nom = {}
+        for ecole_id, nom in Ecoles.objects.values_list('id', 'nom'):
+            self.par_id[str(ecole_id)] = ecole_id
+            # Un nom porté par plusieurs écoles est ambigu : il faut alors l'identifiant
+            cle = _normaliser(nom)
+            self.par_nom[cle] = None if cle in self.par_nom else ecole_id
+
+    def ecole(self, valeur):
+        try:
+            ecole_id = self.par_id.get(str(uuid.UUID(valeur)))
+        except ValueError:
+            cle = _normaliser(valeur)
+            if cle in self.par_nom and self.par_nom[cle] is None:
+                raise ValueError(f'École ambiguë (plusieurs écoles nommées {valeur!r}), utiliser son identifiant')
+            ecole_id = self.par_nom.get(cle)
+        if ecole_id is None:
+            raise ValueError(f'École introuvable : {valeur!r}')
+        return ecole_id
+
+
+class IndexCahiers:
+    """Résolution en mémoire d'un cahier par identifiant ou par titre, chargée en une requête"""
+
+    def __init__(self):
+        self.par_id = {}
+        self.par_titre = {}
+        for cahier in Cahiers.objects.all():
+            self.par_id[str(cahier.pk)] = cahier
+            cle = _normaliser(cahier.titre)
+            self.par_titre[cle] = None if cle in self.par_titre else cahier
+
+    def cahier(self, valeur):
+        try:
+            cahier = self.par_id.get(str(uuid.UUID(valeur)))
+        except ValueError:
+            cle = _normaliser(valeur)
+            if cle in self.par_titre and self.par_titre[cle] is None:
+                raise ValueError(f'Cahier ambigu (plusieurs cahiers intitulés {valeur!r}), utiliser son identifiant')
+            cahier = self.par_titre.get(cle)
+        if cahier is None:
+            raise ValueError(f'Cahier introuvable : {valeur!r}')
+        return cahier
+
+
+def _ventes_a_crediter():
+    """Vente à créditer en premier pour chaque école : celle de l'année active, sinon la plus récente"""
+    annee_active = AnneeScolaire.get_annee_courante()
+    ventes = {}
+    for ecole_id, vente_id, annee_id in Vente.objects.order_by('ecole_id', 'annee_scolaire__annee_debut', 'created_at')\
+            .values_list('ecole_id', 'pk', 'annee_scolaire_id'):
+        if ecole_id not in ventes or ventes[ecole_id][1] != getattr(annee_active, 'pk', None):
+            ventes[ecole_id] = (vente_id, annee_id)
+    return {ecole_id: vente_id for ecole_id, (vente_id, _) in ventes.items()}
+
+
+def importer_paiements(fichier, taille_lot=None):
+    """Importe un relevé CSV de paiements (école, montant, date, référence).
+
+    Chaque paiement suit la répartition de Vente.gerer_paiement sur la vente à créditer de
+    l'école. Les lignes sont traitées par lots, chacun dans sa transaction ; une ligne en erreur
+    n'annule pas son lot. Les références déjà importées (fichier ou base) sont ignorées.
+    Retourne le rapport d'import.
+    """
+    taille_lot = max(1, taille_lot or getattr(settings, 'IMPORT_PAIEMENTS_LOT', 500))
+    debut = time.perf_counter()
+    index = IndexEcoles()
+    ventes_a_crediter = _ventes_a_crediter()
+    references_vues = set()
+    rapport = {
+        'lignes': 0, 'importees': 0, 'sans_dette': 0, 'doublons': 0, 'nb_erreurs': 0, 'erreurs': [],
+        'montant_affecte': Decimal('0'), 'montant_non_affecte': Decimal('0'), 'interruption': None,
+    }
+
+    def erreur(numero, message):
+        rapport['nb_erreurs'] += 1
+        if len(rapport['erreurs']) < ERREURS_DETAILLEES:
+            rapport['erreurs'].append(f'Ligne {numero} : {message}')
+
+    def traiter_lot(lot):
+        references = [ligne['reference'] for _, ligne in lot if ligne['reference']]
+        deja_importees = set(
+            Paiement.objects.filter(reference__in=references).values_list('reference', flat=True).distinct()
+        ) if references else set()
+        ventes = Vente.objects.in_bulk([ligne['vente_id'] for _, ligne in lot])
+
+        with transaction.atomic():
+            for numero, ligne in lot:
+                if ligne['reference'] in deja_importees:
+                    rapport['doublons'] += 1
+                    continue
+                try:
+                    # gerer_paiement ouvre un point de sauvegarde : une erreur n'annule que sa ligne
+                    excedent = ventes[ligne['vente_id']].gerer_paiement(
+                        ligne['montant'], date_paiement=ligne['date'], reference=ligne['reference']
+                    )
+                except Exception as e:
+                    logger.exception("Import de paiement, ligne %s", numero)
+                    erreur(numero, str(e))
+                    continue
+                if excedent < ligne['montant']:
+                    rapport['importees'] += 1
+                else:
+                    # Aucune dette à régler : rien n'est enregistré, la référence pourra être réimportée
+                    rapport['sans_dette'] += 1
+                rapport['montant_affecte'] += ligne['montant'] - excedent
+                rapport['montant_non_affecte'] += excedent
+
+    # Les factures touchées sont re-rendues une seule fois, après l'import
+    with rendus_differes():
+        lot = []
+        try:
+            for numero, valeurs in lire_csv(ouvrir_texte(fichier), COLONNES_PAIEMENTS):
+                rapport['lignes'] += 1
+                try:
+                    ecole_id = index.ecole(valeurs.get('ecole', ''))
+                    if ecole_id not in ventes_a_crediter:
+                        raise ValueError('Aucune vente pour cette école')
+                    ligne = {
+                        'vente_id': ventes_a_crediter[ecole_id],
+                        'montant': lire_montant(valeurs.get('montant', '')),
+                        'date': lire_date(valeurs.get('date', '')),
+                        'reference': valeurs.get('reference', '')[:100],
+                    }
+                except ValueError as e:
+                    erreur(numero, str(e))
+                    continue
+
+                if ligne['reference']:
+                    if ligne['reference'] in references_vues:
+                        rapport['doublons'] += 1
+                        continue
+                    references_vues.add(ligne['reference'])
+
+                lot.append((numero, ligne))
+                if len(lot) >= taille_lot:
+                    traiter_lot(lot)
+                    lot = []
+        except (UnicodeDecodeError, csv.Error) as e:
+            rapport['interruption'] = _interruption(rapport, e)
+        if lot:
+            traiter_lot(lot)
+
+    rapport['duree'] = time.perf_counter() - debut
+    rapport['par_seconde'] = rapport['lignes'] / rapport['duree'] if rapport['duree'] else 0
+    return rapport
+
+
+def importer_commandes(fichier, simulation=False, taille_lot=None):
+    """Importe un fichier de commandes (école, cahier, quantité) dans les ventes de l'année active.
+
+    Dans chaque lot, les lignes sont regroupées par école : un seul Vente.ajouter_articles par école,
+    donc une seule mise à jour de stock par cahier. La vente de l'année est créée si besoin, comme
+    dans creer_vente. En simulation rien n'est écrit : le rapport décrit ce que l'import ferait.
+    Retourne le rapport d'import.
+    """
+    annee = AnneeScolaire.get_annee_courante()
+    if annee is None:
+        raise ValueError('Aucune année scolaire active')
+    
+    taille_lot = max(1, taille_lot or getattr(settings, 'IMPORT_COMMANDES_LOT', 1000))
+    debut = time.perf_counter()
+    ecoles = IndexEcoles()
+    cahiers = IndexCahiers()
+    # Première vente de l'année par école, comme creer_vente ; None : vente à créer (simulation)
+    ventes = dict(
+        Vente.objects.filter(annee_scolaire=annee).order_by('-created_at').values_list('ecole_id', 'pk')
+    )
+    # Stock vendable (hors réservations des saisies en cours), comme le vérifie Vente.ajouter_articles
+    stock_prevu = ReservationStock.disponibles(cahiers.par_id.keys())
+    ventes_creees, ventes_completees, ruptures = set(), set(), set()
+    rapport = {
+        'simulation': simulation, 'annee': str(annee),
+        'lignes': 0, 'importees': 0, 'nb_erreurs': 0, 'erreurs': [], 'montant': Decimal('0'), 'interruption': None,
+    }
+
+    def erreur(numero, message, nb_lignes=1):
+        rapport['nb_erreurs'] += nb_lignes
+        if len(rapport['erreurs']) < ERREURS_DETAILLEES:
+            rapport['erreurs'].append(f'Ligne {numero} : {message}')
+
+    def compter(ecole_id, lignes, creee):
+        (ventes_creees if creee else ventes_completees).add(ecole_id)
+        rapport['importees'] += len(lignes)
+        for _, cahier, quantite in lignes:
+            rapport['montant'] += cahier.prix * quantite
+            stock_prevu[cahier.pk] -= quantite
+
+    def manquants(lignes):
+        """Titres des cahiers dont le stock prévu ne couvre pas les lignes d'une école"""
+        demandes = {}
+        for _, cahier, quantite in lignes:
+            demandes[cahier] = demandes.get(cahier, 0) + quantite
+        return [cahier.titre for cahier, quantite in demandes.items() if quantite > stock_prevu.get(cahier.pk, 0)]
+
+    def traiter_lot(lot):
+        if simulation:
+            for ecole_id, lignes in lot.items():
+                # Vente.ajouter_articles refuserait toutes les lignes de l'école
+                titres = manquants(lignes)
+                if titres:
+                    ruptures.update(titres)
+                    erreur(lignes[0][0], f"{len(lignes)} ligne(s) de cette école non importée(s) : Stock insuffisant : {', '.join(titres)}", len(lignes))
+                    continue
+                compter(ecole_id, lignes, creee=ecole_id not in ventes or ecole_id in ventes_creees)
+                ventes.setdefault(ecole_id, None)
+            return
+        
+        existantes = Vente.objects.in_bulk([ventes[ecole_id] for ecole_id in lot if ventes.get(ecole_id)])
+        with transaction.atomic():
+            for ecole_id, lignes in lot.items():
+                creee = ecole_id in ventes_creees
+                try:
+                    # Point de sauvegarde par école : une erreur n'annule que ses lignes
+                    with transaction.atomic():
+                        vente = existantes.get(ventes.get(ecole_id))
+                        if vente is None:
+                            vente = Vente.objects.create(
+                                ecole_id=ecole_id,
+                                annee_scolaire=annee,
+                                date_paiement=timezone.now() + timedelta(days=30),
+                            )
+                            creee = True
+                        vente.ajouter_articles(
+                            [{'cahier': cahier, 'quantite': quantite} for _, cahier, quantite in lignes],
+                            description_session=f"Import de {len(lignes)} ligne(s) de commande"
+                        )
+                except ValueError as e:
+                    # Stock insuffisant : erreur attendue, sans trace
+                    ruptures.update(manquants(lignes))
+                    erreur(lignes[0][0], f'{len(lignes)} ligne(s) de cette école non importée(s) : {e}', len(lignes))
+                    continue
+                except Exception as e:
+                    logger.exception("Import de commandes, école %s", ecole_id)
+                    erreur(lignes[0][0], f'{len(lignes)} ligne(s) de cette école non importée(s) : {e}', len(lignes))
+                    continue
+                ventes[ecole_id] = vente.pk
+                compter(ecole_id, lignes, creee)
+
+    # Les factures touchées sont re-rendues une seule fois, après l'import
+    with rendus_differes():
+        lot, taille = {}, 0
+        try:
+            for numero, valeurs in lire_csv(ouvrir_texte(fichier), COLONNES_COMMANDES):
+                rapport['lignes'] += 1
+                try:
+                    ecole_id = ecoles.ecole(valeurs.get('ecole', ''))
+                    cahier = cahiers.cahier(valeurs.get('cahier', ''))
+                    quantite = lire_quantite(valeurs.get('quantite', ''))
+                except ValueError as e:
+                    erreur(numero, str(e))
+                    continue
+
+                lot.setdefault(ecole_id, []).append((numero, cahier, quantite))
+                taille += 1
+                if taille >= taille_lot:
+                    traiter_lot(lot)
+                    lot, taille = {}, 0
+        except (UnicodeDecodeError, csv.Error) as e:
+            rapport['interruption'] = _interruption(rapport, e)
+        if lot:
+            traiter_lot(lot)
+
+    rapport['ventes_creees'] = len(ventes_creees)
+    rapport['ventes_completees'] = len(ventes_completees - ventes_creees)
+    rapport['ruptures'] = sorted(ruptures)
+    rapport['duree'] = time.perf_counter() - debut
+    rapport['par_seconde'] = rapport['lignes'] / rapport['duree'] if rapport['duree'] else 0
+    return rapport
@@ -0,0 +1,63 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from gestion.factures import PapierEnTete, rendre_facture
+from gestion.models import Vente
+
+
+class Command(BaseCommand):
+    help = "Mesure la latence de rendu d'une facture avec et sans le registre des papiers en-tête"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=20,
+            help='Nombre de rendus par mesure (défaut: 20)'
+        )
+        parser.add_argument(
+            '--vente',
+            type=str,
+            default=None,
+            help='Identifiant de la vente à rendre (défaut: la vente avec le plus de lignes)'
+        )
+
+    def mesurer(self, vente, iterations, recharger):
+        durees = []
+        for _ in range(iterations):
+            if recharger:
+                # Comportement d'origine : papiers en-tête relus et analysés à chaque facture
+                PapierEnTete.vider()
+            debut = time.perf_counter()
+            rendre_facture(vente)
+            durees.append((time.perf_counter() - debut) * 1000)
+        return durees
+
+    def afficher(self, libelle, durees):
+        self.stdout.write(
+            f'{libelle:<28} moyenne {statistics.mean(durees):8.1f} ms   '
+            f'médiane {statistics.median(durees):8.1f} ms   min {min(durees):8.1f} ms'
+        )
+
+    def handle(self, *args, **options):
+        ventes = Vente.objects.select_related('ecole', 'annee_scolaire')
+        if options['vente']:
+            vente = ventes.filter(id=options['vente']).first()
+        else:
+            vente = ventes.order_by('-nb_lignes').first()
+        if vente is None:
+            raise CommandError('Aucune vente à rendre')
+
+        iterations = max(1, options['iterations'])
+        self.stdout.write(f'Facture de {vente.ecole.nom} ({vente.nb_lignes} ligne(s)), {iterations} rendu(s) par mesure')
+
+        # Un rendu à blanc pour charger polices et modules
+        rendre_facture(vente)
+
+        avant = self.mesurer(vente, iterations, recharger=True)
+        apres = self.mesurer(vente, iterations, recharger=False)
+        self.afficher('Papiers relus à chaque fois', avant)
+        self.afficher('Registre préchargé', apres)
+        self.stdout.write(
+            self.style.SUCCESS(f'Gain moyen: {statistics.mean(avant) - statistics.mean(apres):.1f} ms par facture')
+        )
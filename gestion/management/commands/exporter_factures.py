@@ -0,0 +1,86 @@
+import os
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from gestion.factures import chemin_export, exporter_factures
+from gestion.models import AnneeScolaire, Ecoles, Vente
+
+
+class Command(BaseCommand):
+    help = "Exporte dans une archive ZIP toutes les factures d'une année scolaire (ou d'une école)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--annee',
+            type=str,
+            action='append',
+            default=None,
+            help="Année scolaire au format 2024-2025, répétable : une archive par année (défaut: l'année active)"
+        )
+        parser.add_argument(
+            '--ecole',
+            type=str,
+            default=None,
+            help="Identifiant de l'école à exporter (défaut: toutes les écoles)"
+        )
+        parser.add_argument(
+            '--sortie',
+            type=str,
+            default=None,
+            help='Chemin de l\'archive ZIP, pour une seule année (défaut: MEDIA_ROOT/exports/factures_<annee>.zip)'
+        )
+        parser.add_argument(
+            '--processus',
+            type=int,
+            default=None,
+            help='Nombre de processus de rendu (défaut: FACTURE_EXPORT_PROCESSUS ou nombre de CPU)'
+        )
+
+    def get_annee(self, libelle):
+        if not libelle:
+            annee = AnneeScolaire.get_annee_courante()
+            if annee is None:
+                raise CommandError('Aucune année scolaire active')
+            return annee
+        annee = AnneeScolaire.get_annee_par_libelle(libelle)
+        if annee is None:
+            raise CommandError(f'Année scolaire {libelle} introuvable (format attendu: 2024-2025)')
+        return annee
+
+    def handle(self, *args, **options):
+        annees = [self.get_annee(libelle) for libelle in options['annee'] or [None]]
+        if options['sortie'] and len(annees) > 1:
+            raise CommandError('--sortie ne peut être utilisé qu\'avec une seule année')
+
+        ecole = None
+        if options['ecole']:
+            try:
+                ecole = Ecoles.objects.filter(id=options['ecole']).first()
+            except ValidationError:
+                ecole = None
+            if ecole is None:
+                raise CommandError(f"École {options['ecole']} introuvable")
+
+        for annee in annees:
+            self.exporter(annee, ecole, options)
+
+    def exporter(self, annee, ecole, options):
+        ventes = Vente.objects.filter(annee_scolaire=annee).order_by('ecole__nom', 'created_at')
+        chemin = chemin_export(annee)
+        if ecole is not None:
+            ventes = ventes.filter(ecole=ecole)
+            chemin = os.path.join(settings.MEDIA_ROOT, 'exports', f'factures_{annee}_{str(ecole.id)[:8]}.zip')
+
+        chemin = options['sortie'] or chemin
+        self.stdout.write(f'Export des factures {annee} vers {chemin}...')
+
+        resultats = exporter_factures(ventes, chemin, processus=options['processus'])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Export terminé:\n'
+                f'- {resultats["factures"]} facture(s) en {resultats["duree"]:.1f} s '
+                f'({resultats["par_seconde"]:.1f} facture(s)/s, {resultats["processus"]} processus)\n'
+                f'- Archive: {chemin} ({resultats["taille"] / 1024:.0f} Ko)'
+            )
+        )
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from gestion.imports import importer_commandes
+
+
+class Command(BaseCommand):
+    help = "Importe un fichier CSV de commandes (colonnes: ecole, cahier, quantite) dans les ventes de l'année active"
+
+    def add_arguments(self, parser):
+        parser.add_argument('fichier', type=str, help='Chemin du fichier CSV')
+        parser.add_argument(
+            '--simulation',
+            action='store_true',
+            help="Vérifier le fichier et afficher ce qui serait importé, sans rien écrire"
+        )
+        parser.add_argument(
+            '--lot',
+            type=int,
+            default=None,
+            help='Nombre de lignes par transaction (défaut: IMPORT_COMMANDES_LOT)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            fichier = open(options['fichier'], 'rb')
+        except OSError as e:
+            raise CommandError(f"Impossible d'ouvrir {options['fichier']} : {e}")
+
+        mode = ' (simulation)' if options['simulation'] else ''
+        self.stdout.write(f"Import des commandes de {options['fichier']}{mode}...")
+        with fichier:
+            try:
+                rapport = importer_commandes(fichier, simulation=options['simulation'], taille_lot=options['lot'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        for erreur in rapport['erreurs']:
+            self.stdout.write(self.style.WARNING(f'- {erreur}'))
+        if rapport['interruption']:
+            self.stdout.write(self.style.ERROR(f"- {rapport['interruption']}, les lignes précédentes ont été traitées"))
+        if rapport['ruptures']:
+            self.stdout.write(self.style.WARNING(f"- Stock insuffisant pour : {', '.join(rapport['ruptures'])}"))
+
+        verbe = 'seraient importées' if options['simulation'] else 'importée(s)'
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Import{mode} terminé pour {rapport["annee"]}:\n'
+                f'- {rapport["lignes"]} ligne(s) lue(s) en {rapport["duree"]:.1f} s ({rapport["par_seconde"]:.0f} ligne(s)/s)\n'
+                f'- {rapport["importees"]} ligne(s) {verbe}, {rapport["nb_erreurs"]} ligne(s) en erreur\n'
+                f'- {rapport["ventes_creees"]} vente(s) créée(s), {rapport["ventes_completees"]} vente(s) complétée(s), '
+                f'{rapport["montant"]} F d\'articles'
+            )
+        )
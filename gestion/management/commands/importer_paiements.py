@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from gestion.imports import importer_paiements
+
+
+class Command(BaseCommand):
+    help = "Importe un relevé CSV de paiements (colonnes: ecole, montant, date, reference)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('fichier', type=str, help='Chemin du fichier CSV')
+        parser.add_argument(
+            '--lot',
+            type=int,
+            default=None,
+            help='Nombre de lignes par transaction (défaut: IMPORT_PAIEMENTS_LOT)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            fichier = open(options['fichier'], 'rb')
+        except OSError as e:
+            raise CommandError(f"Impossible d'ouvrir {options['fichier']} : {e}")
+
+        self.stdout.write(f"Import des paiements de {options['fichier']}...")
+        with fichier:
+            rapport = importer_paiements(fichier, taille_lot=options['lot'])
+
+        for erreur in rapport['erreurs']:
+            self.stdout.write(self.style.WARNING(f'- {erreur}'))
+        if rapport['interruption']:
+            self.stdout.write(self.style.ERROR(f"- {rapport['interruption']}, les lignes précédentes ont été traitées"))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Import terminé:\n'
+                f'- {rapport["lignes"]} ligne(s) lue(s) en {rapport["duree"]:.1f} s ({rapport["par_seconde"]:.0f} ligne(s)/s)\n'
+                f'- {rapport["importees"]} paiement(s) importé(s), {rapport["doublons"]} doublon(s) ignoré(s), '
+                f'{rapport["nb_erreurs"]} ligne(s) en erreur\n'
+                f'- {rapport["montant_affecte"]} F affecté(s), {rapport["montant_non_affecte"]} F sans dette à régler '
+                f'({rapport["sans_dette"]} ligne(s) non enregistrée(s))'
+            )
+        )
@@ -0,0 +1,108 @@
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from gestion.models import AnneeScolaire, Vente, DetteEcoleAnnee
+
+
+CENTIME = Decimal('0.01')
+
+
+class Command(BaseCommand):
+    help = 'Reconstruit et vérifie les soldes persistés des ventes et le registre des dettes par école'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verifier-seulement',
+            action='store_true',
+            help='Signaler les écarts sans corriger les soldes'
+        )
+
+    def _ecarts(self, ventes):
+        """Retourne les ventes dont les soldes persistés diffèrent des lignes et paiements"""
+        incoherentes = []
+        for vente in ventes:
+            attendu = {
+                'total_lignes': Decimal(vente.calc_total_lignes).quantize(CENTIME),
+                'total_paye': Decimal(vente.calc_total_paye).quantize(CENTIME),
+                'total_restant': Decimal(vente.calc_total_restant).quantize(CENTIME),
+                'nb_lignes': vente.calc_nb_lignes,
+            }
+            actuel = {
+                'total_lignes': Decimal(vente.total_lignes).quantize(CENTIME),
+                'total_paye': Decimal(vente.total_paye).quantize(CENTIME),
+                'total_restant': Decimal(vente.total_restant).quantize(CENTIME),
+                'nb_lignes': vente.nb_lignes,
+            }
+            if attendu != actuel:
+                for champ, valeur in attendu.items():
+                    setattr(vente, champ, valeur)
+                incoherentes.append(vente)
+        return incoherentes
+
+    def _ecarts_registre(self):
+        """Retourne les couples (école, année) dont le registre des dettes diffère des ventes"""
+        attendu = {
+            cle: tuple(Decimal(v).quantize(CENTIME) for v in valeurs[:3]) + (valeurs[3],)
+            for cle, valeurs in DetteEcoleAnnee.calculer().items()
+        }
+        actuel = {
+            (dette.ecole_id, dette.annee_scolaire_id): (
+                Decimal(dette.montant_articles).quantize(CENTIME),
+                Decimal(dette.montant_paye).quantize(CENTIME),
+                Decimal(dette.montant_restant).quantize(CENTIME),
+                dette.nb_ventes,
+            )
+            for dette in DetteEcoleAnnee.objects.exclude(nb_ventes=0, montant_restant=0)
+        }
+        return [cle for cle in attendu.keys() | actuel.keys() if attendu.get(cle) != actuel.get(cle)]
+
+    def handle(self, *args, **options):
+        verifier_seulement = options['verifier_seulement']
+        self.stdout.write('Vérification des soldes des ventes...')
+
+        with transaction.atomic():
+            ventes = Vente.objects.with_live_totals().select_related('ecole').order_by('pk')
+            if not verifier_seulement:
+                ventes = ventes.select_for_update(of=('self',))
+            incoherentes = self._ecarts(ventes)
+
+            for vente in incoherentes:
+                self.stdout.write(
+                    self.style.WARNING(
+                        f'- Vente {str(vente.id)[:8]} ({vente.ecole.nom}) : '
+                        f'{vente.total_lignes} F / {vente.total_paye} F payé / {vente.nb_lignes} ligne(s) attendus'
+                    )
+                )
+
+            if verifier_seulement:
+                ecarts_registre = self._ecarts_registre()
+                if ecarts_registre:
+                    self.stdout.write(self.style.WARNING(f'- {len(ecarts_registre)} entrée(s) du registre des dettes incohérente(s)'))
+                if incoherentes or ecarts_registre:
+                    raise CommandError(f'{len(incoherentes)} vente(s) avec des soldes incohérents')
+                self.stdout.write(self.style.SUCCESS('Tous les soldes sont cohérents'))
+                return
+
+            Vente.objects.bulk_update(incoherentes, Vente.CHAMPS_SOLDES, batch_size=500)
+            # Années dont les chiffres changent : ventes corrigées ou registre des dettes faux
+            annees = {vente.annee_scolaire_id for vente in incoherentes}
+            annees.update(annee_id for _, annee_id in self._ecarts_registre())
+            DetteEcoleAnnee.reconstruire()
+            # Bilans, tableau de bord, ETag et rapport annuel en cache suivent version_donnees
+            for annee_id in sorted(annees):
+                AnneeScolaire.marquer_modifiee(annee_id)
+
+            # Contrôle après reconstruction
+            restantes = self._ecarts(Vente.objects.with_live_totals().order_by('pk'))
+            if restantes or self._ecarts_registre():
+                raise CommandError(f'{len(restantes)} vente(s) toujours incohérentes après reconstruction')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Recalcul terminé:\n'
+                f'- {len(incoherentes)} vente(s) corrigée(s)\n'
+                f'- Registre des dettes par école reconstruit\n'
+                f'- {len(annees)} année(s) scolaire(s) marquée(s) comme modifiée(s)\n'
+                f'- Soldes vérifiés après reconstruction'
+            )
+        )
@@ -1,14 +1,26 @@
 from django.core.management.base import BaseCommand
-from gestion.services import NotificationService
+from gestion.services import PlanificateurNotifications
 
 class Command(BaseCommand):
     help = 'Vérifie les stocks et envoie les notifications'
 
-    def handle(self, *args, **options):
-        self.stdout.write('Début de la vérification des notifications...')
-        
-        resultats = NotificationService.executer_verification_periodique()
-        
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--daemon',
+            action='store_true',
+            help='Rester actif et relancer la vérification à intervalle régulier'
+        )
+        parser.add_argument(
+            '--intervalle',
+            type=int,
+            default=None,
+            help='Intervalle entre deux vérifications en secondes (défaut: NOTIFICATION_INTERVALLE_SECONDES)'
+        )
+
+    def afficher_resultats(self, resultats):
+        if resultats is None:
+            self.stdout.write(self.style.WARNING('Vérification déjà assurée par un autre processus, passage ignoré'))
+            return
         self.stdout.write(
             self.style.SUCCESS(
                 f'Vérification terminée:\n'
@@ -16,4 +28,24 @@ class Command(BaseCommand):
                 f'- {resultats["emails_traites"]} emails traités\n'
                 f'- {resultats["emails_reussis"]} emails envoyés avec succès'
             )
-        )
\ No newline at end of file
+        )
+
+    def handle(self, *args, **options):
+        planificateur = PlanificateurNotifications(intervalle=options['intervalle'])
+
+        if options['daemon']:
+            self.stdout.write(f'Planificateur des notifications démarré (toutes les {planificateur.intervalle} s)...')
+            try:
+                planificateur.boucle(rapport=self.afficher_resultats)
+            except KeyboardInterrupt:
+                self.stdout.write('Arrêt du planificateur des notifications')
+            return
+
+        self.stdout.write('Début de la vérification des notifications...')
+        
+        try:
+            resultats = planificateur.executer_une_fois()
+        finally:
+            planificateur.liberer_bail()
+        
+        self.afficher_resultats(resultats)
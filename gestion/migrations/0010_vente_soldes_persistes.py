@@ -0,0 +1,60 @@
+# Generated by Django 5.2 on 2026-10-18 12:12
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def initialiser_soldes(apps, schema_editor):
+    Vente = apps.get_model('gestion', 'Vente')
+    LigneVente = apps.get_model('gestion', 'LigneVente')
+    Paiement = apps.get_model('gestion', 'Paiement')
+
+    lignes = {
+        row['vente']: row for row in
+        LigneVente.objects.values('vente').annotate(total=Sum('montant'), nb=Count('id'))
+    }
+    paiements = {
+        row['vente']: row['total'] for row in
+        Paiement.objects.filter(est_annule=False).values('vente').annotate(total=Sum('montant'))
+    }
+
+    ventes = list(Vente.objects.all())
+    for vente in ventes:
+        ligne = lignes.get(vente.pk, {})
+        vente.total_lignes = ligne.get('total') or Decimal('0')
+        vente.nb_lignes = ligne.get('nb') or 0
+        vente.total_paye = paiements.get(vente.pk) or Decimal('0')
+        vente.total_restant = max(Decimal('0'), vente.total_lignes - vente.total_paye)
+    Vente.objects.bulk_update(ventes, ['total_lignes', 'total_paye', 'total_restant', 'nb_lignes'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0009_paiement_date_annulation_paiement_est_annule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vente',
+            name='nb_lignes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vente',
+            name='total_lignes',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='vente',
+            name='total_paye',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='vente',
+            name='total_restant',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=15),
+        ),
+        migrations.RunPython(initialiser_soldes, migrations.RunPython.noop),
+    ]
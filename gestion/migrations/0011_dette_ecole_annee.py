@@ -0,0 +1,54 @@
+# Generated by Django 5.2 on 2026-10-18 12:13
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def initialiser_registre(apps, schema_editor):
+    Vente = apps.get_model('gestion', 'Vente')
+    DetteEcoleAnnee = apps.get_model('gestion', 'DetteEcoleAnnee')
+
+    lignes = Vente.objects.filter(total_restant__gt=0).order_by()\
+        .values('ecole_id', 'annee_scolaire_id')\
+        .annotate(articles=Sum('total_lignes'), paye=Sum('total_paye'), restant=Sum('total_restant'), nb=Count('id'))
+    DetteEcoleAnnee.objects.bulk_create([
+        DetteEcoleAnnee(
+            ecole_id=ligne['ecole_id'],
+            annee_scolaire_id=ligne['annee_scolaire_id'],
+            montant_articles=ligne['articles'],
+            montant_paye=ligne['paye'],
+            montant_restant=ligne['restant'],
+            nb_ventes=ligne['nb'],
+        )
+        for ligne in lignes
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0010_vente_soldes_persistes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetteEcoleAnnee',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('montant_articles', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('montant_paye', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('montant_restant', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('nb_ventes', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('annee_scolaire', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dettes_ecoles', to='gestion.anneescolaire')),
+                ('ecole', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dettes_annuelles', to='gestion.ecoles')),
+            ],
+            options={
+                'ordering': ['-annee_scolaire__annee_debut'],
+                'unique_together': {('ecole', 'annee_scolaire')},
+            },
+        ),
+        migrations.RunPython(initialiser_registre, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 12:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0011_dette_ecole_annee'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='anneescolaire',
+            name='version_donnees',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bilananneescolaire',
+            name='version_donnees',
+            field=models.IntegerField(default=-1),
+        ),
+    ]
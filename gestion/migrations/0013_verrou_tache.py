@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 12:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0012_bilan_version_donnees'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VerrouTache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nom', models.CharField(max_length=100, unique=True)),
+                ('proprietaire', models.CharField(max_length=255)),
+                ('expire_le', models.DateTimeField()),
+                ('derniere_execution', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-18 12:18
+
+from django.db import migrations, models
+
+
+def supprimer_doublons(apps, schema_editor):
+    # Conserve la plus ancienne alerte de stock faible non lue de chaque cahier
+    Notification = apps.get_model('gestion', 'Notification')
+    vus = set()
+    doublons = []
+    alertes = Notification.objects.filter(type_notification='stock_faible', est_lu=False, cahier__isnull=False)\
+        .order_by('cahier_id', 'date_creation').values_list('id', 'cahier_id')
+    for pk, cahier_id in alertes:
+        if cahier_id in vus:
+            doublons.append(pk)
+        vus.add(cahier_id)
+    Notification.objects.filter(id__in=doublons).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0013_verrou_tache'),
+    ]
+
+    operations = [
+        migrations.RunPython(supprimer_doublons, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(condition=models.Q(('est_lu', False), ('type_notification', 'stock_faible')), fields=('cahier',), name='notification_stock_faible_non_lue_unique'),
+        ),
+    ]
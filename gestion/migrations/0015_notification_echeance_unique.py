@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-18 12:19
+
+from django.db import migrations, models
+
+
+def supprimer_doublons(apps, schema_editor):
+    # Conserve la plus ancienne alerte d'échéance non lue de chaque vente
+    Notification = apps.get_model('gestion', 'Notification')
+    vus = set()
+    doublons = []
+    alertes = Notification.objects.filter(type_notification='echeance_paiement', est_lu=False, vente__isnull=False)\
+        .order_by('vente_id', 'date_creation').values_list('id', 'vente_id')
+    for pk, vente_id in alertes:
+        if vente_id in vus:
+            doublons.append(pk)
+        vus.add(vente_id)
+    Notification.objects.filter(id__in=doublons).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0014_notification_stock_faible_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(supprimer_doublons, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(condition=models.Q(('est_lu', False), ('type_notification', 'echeance_paiement')), fields=('vente',), name='notification_echeance_non_lue_unique'),
+        ),
+    ]
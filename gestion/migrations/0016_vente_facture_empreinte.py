@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0015_notification_echeance_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vente',
+            name='facture_empreinte',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0016_vente_facture_empreinte'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bilanmensuel',
+            name='version_donnees',
+            field=models.IntegerField(default=-1),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2 on 2026-10-18 12:29
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+def stock_initial(apps, schema_editor):
+    # Ouvre le journal avec le stock actuel de chaque cahier
+    Cahiers = apps.get_model('gestion', 'Cahiers')
+    MouvementStock = apps.get_model('gestion', 'MouvementStock')
+    MouvementStock.objects.bulk_create([
+        MouvementStock(cahier_id=pk, type_mouvement='stock_initial', quantite=stock)
+        for pk, stock in Cahiers.objects.filter(quantite_stock__gt=0).values_list('pk', 'quantite_stock')
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0017_bilan_mensuel_version_donnees'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MouvementStock',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('type_mouvement', models.CharField(choices=[('stock_initial', 'Stock initial'), ('vente', 'Vente'), ('retour', "Retour (retrait d'articles)"), ('reapprovisionnement', 'Réapprovisionnement'), ('ajustement', 'Ajustement manuel')], max_length=20)),
+                ('quantite', models.IntegerField()),
+                ('date_mouvement', models.DateTimeField(auto_now_add=True)),
+                ('cahier', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mouvements', to='gestion.cahiers')),
+                ('vente', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mouvements_stock', to='gestion.vente')),
+            ],
+            options={
+                'ordering': ['-date_mouvement'],
+                'indexes': [models.Index(fields=['cahier', 'date_mouvement'], name='gestion_mou_cahier__0113d6_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReservationStock',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('cle', models.CharField(max_length=64)),
+                ('quantite', models.PositiveIntegerField()),
+                ('expire_le', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('cahier', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='gestion.cahiers')),
+            ],
+            options={
+                'unique_together': {('cle', 'cahier')},
+            },
+        ),
+        migrations.RunPython(stock_initial, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 5.2 on 2026-10-18 12:32
+
+import django.db.models.deletion
+import django.utils.timezone
+from datetime import datetime, time
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remplir_journal(apps, schema_editor):
+    # Une écriture par paiement existant, plus une écriture négative par annulation
+    Paiement = apps.get_model('gestion', 'Paiement')
+    Vente = apps.get_model('gestion', 'Vente')
+    MouvementPaiement = apps.get_model('gestion', 'MouvementPaiement')
+    mouvements = []
+    for paiement in Paiement.objects.order_by('pk').iterator():
+        date_paiement = django.utils.timezone.make_aware(datetime.combine(paiement.date_paiement, time(12)))
+        mouvements.append(MouvementPaiement(
+            vente_id=paiement.vente_id, paiement_id=paiement.pk, type_mouvement='paiement',
+            montant=paiement.montant, date_mouvement=date_paiement,
+        ))
+        if paiement.est_annule:
+            mouvements.append(MouvementPaiement(
+                vente_id=paiement.vente_id, paiement_id=paiement.pk, type_mouvement='annulation',
+                montant=-paiement.montant, date_mouvement=paiement.date_annulation or date_paiement,
+            ))
+    MouvementPaiement.objects.bulk_create(mouvements, batch_size=500)
+
+    # Le compteur de tranches reprend après le plus grand numéro déjà attribué
+    for vente_id, numero in Paiement.objects.values('vente').annotate(numero=Max('numero_tranche')).values_list('vente', 'numero'):
+        Vente.objects.filter(pk=vente_id).update(derniere_tranche=numero)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0018_mouvement_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MouvementPaiement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type_mouvement', models.CharField(choices=[('paiement', 'Paiement'), ('annulation', 'Annulation')], max_length=20)),
+                ('montant', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('date_mouvement', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+            ],
+            options={
+                'ordering': ['date_mouvement'],
+            },
+        ),
+        migrations.AddField(
+            model_name='vente',
+            name='derniere_tranche',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='paiement',
+            index=models.Index(fields=['vente', 'est_annule', 'montant'], name='paiement_vente_actif_idx'),
+        ),
+        migrations.AddField(
+            model_name='mouvementpaiement',
+            name='paiement',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mouvements', to='gestion.paiement'),
+        ),
+        migrations.AddField(
+            model_name='mouvementpaiement',
+            name='vente',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mouvements_paiement', to='gestion.vente'),
+        ),
+        migrations.AddIndex(
+            model_name='mouvementpaiement',
+            index=models.Index(fields=['vente', 'montant'], name='mouvement_paiement_vente_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='mouvementpaiement',
+            constraint=models.UniqueConstraint(fields=('paiement', 'type_mouvement'), name='mouvement_paiement_unique'),
+        ),
+        migrations.RunPython(remplir_journal, migrations.RunPython.noop),
+    ]
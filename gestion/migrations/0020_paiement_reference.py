@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-18 12:34
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0019_journal_paiements'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paiement',
+            name='reference',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='paiement',
+            name='date_paiement',
+            field=models.DateField(default=datetime.date.today),
+        ),
+    ]
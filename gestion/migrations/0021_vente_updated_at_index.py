@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0020_paiement_reference'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='vente',
+            index=models.Index(fields=['updated_at', 'id'], name='vente_updated_at_id_idx'),
+        ),
+    ]
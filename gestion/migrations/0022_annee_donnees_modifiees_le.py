@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestion', '0021_vente_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='anneescolaire',
+            name='donnees_modifiees_le',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
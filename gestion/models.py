@@ -1,5 +1,6 @@
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest, TruncMonth
 from django.utils import timezone
 import uuid
 from datetime import date
@@ -15,6 +16,10 @@ class AnneeScolaire(models.Model):
     date_fin = models.DateField()        
     est_active = models.BooleanField(default=False)  
     created_at = models.DateTimeField(auto_now_add=True)
+    # Incrémentée à chaque écriture de vente, ligne, paiement ou cahier touchant l'année
+    version_donnees = models.PositiveIntegerField(default=0)
+    # Date de la dernière incrémentation (Last-Modified des pages de l'année)
+    donnees_modifiees_le = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['-annee_debut']
@@ -31,6 +36,23 @@ class AnneeScolaire(models.Model):
     def get_annee_courante(cls):
         return cls.objects.filter(est_active=True).first()
 
+    @classmethod
+    def get_annee_par_libelle(cls, libelle):
+        """Année scolaire au format '2024-2025', ou None si le format est invalide ou l'année absente"""
+        annee_debut = cls.debut_du_libelle(libelle)
+        if annee_debut is None:
+            return None
+        return cls.objects.filter(annee_debut=annee_debut, annee_fin=annee_debut + 1).first()
+
+    @staticmethod
+    def debut_du_libelle(libelle):
+        """Année de début d'un libellé '2024-2025', ou None s'il est mal formé (l'année n'a pas à exister)"""
+        try:
+            annee_debut, annee_fin = (int(partie) for partie in libelle.split('-'))
+        except (AttributeError, ValueError):
+            return None
+        return annee_debut if annee_fin == annee_debut + 1 else None
+
     @classmethod
     def get_annee_pour_date(cls, date_donnee):
         return cls.objects.filter(
@@ -51,10 +73,18 @@ class AnneeScolaire(models.Model):
             date_fin=date_fin
         )
 
+    @classmethod
+    def marquer_modifiee(cls, annee_id=None):
+        """Incrémente la version des données d'une année (de toutes les années si annee_id est None)"""
+        annees = cls.objects.all() if annee_id is None else cls.objects.filter(pk=annee_id)
+        annees.update(version_donnees=F('version_donnees') + 1, donnees_modifiees_le=timezone.now())
+
     def activer(self):
         AnneeScolaire.objects.all().update(est_active=False)
         self.est_active = True
         self.save()
+        # L'année affichée par le tableau de bord change
+        AnneeScolaire.marquer_modifiee()
 
     def get_mois_scolaires(self):
         mois = []
@@ -92,6 +122,17 @@ class Cahiers(models.Model):
     def __str__(self):
         return self.titre
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Titre, prix et stock apparaissent dans les bilans de toutes les années
+        AnneeScolaire.marquer_modifiee()
+
+    def delete(self, *args, **kwargs):
+        # Les lignes de vente du cahier sont supprimées en cascade
+        resultat = super().delete(*args, **kwargs)
+        AnneeScolaire.marquer_modifiee()
+        return resultat
+
 class Ecoles(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     nom = models.TextField()
@@ -103,69 +144,182 @@ class Ecoles(models.Model):
     def __str__(self):
         return self.nom
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Le nom de l'école apparaît dans les bilans, tableaux de bord et factures
+        AnneeScolaire.marquer_modifiee()
+
+    def delete(self, *args, **kwargs):
+        # Les ventes de l'école sont supprimées en cascade
+        resultat = super().delete(*args, **kwargs)
+        AnneeScolaire.marquer_modifiee()
+        return resultat
+
+MONTANT_FIELD = models.DecimalField(max_digits=15, decimal_places=2)
+
+
+def _somme_lignes(vente_ref='pk'):
+    lignes = LigneVente.objects.filter(vente=OuterRef(vente_ref)).order_by()\
+        .values('vente').annotate(total=Sum('montant')).values('total')
+    return Coalesce(Subquery(lignes, output_field=MONTANT_FIELD), Value(Decimal('0')), output_field=MONTANT_FIELD)
+
+
+def _somme_paiements(vente_ref='pk'):
+    # Somme du journal : les annulations y sont des écritures négatives
+    paiements = MouvementPaiement.objects.filter(vente=OuterRef(vente_ref)).order_by()\
+        .values('vente').annotate(total=Sum('montant')).values('total')
+    return Coalesce(Subquery(paiements, output_field=MONTANT_FIELD), Value(Decimal('0')), output_field=MONTANT_FIELD)
+
+
+def _nombre_lignes(vente_ref='pk'):
+    lignes = LigneVente.objects.filter(vente=OuterRef(vente_ref)).order_by()\
+        .values('vente').annotate(nb=Count('id')).values('nb')
+    return Coalesce(Subquery(lignes, output_field=models.IntegerField()), Value(0))
+
+
+def _reste_du():
+    return Greatest(_somme_lignes() - _somme_paiements(), Value(Decimal('0')), output_field=MONTANT_FIELD)
+
+
+def _dettes_ecole(*conditions):
+    """Somme des dettes de l'école lues dans le registre DetteEcoleAnnee (sous-requête corrélée)"""
+    dettes = DetteEcoleAnnee.objects.filter(Q(ecole=OuterRef('ecole')), *conditions).order_by()\
+        .values('ecole').annotate(total=Sum('montant_restant')).values('total')
+    return Coalesce(Subquery(dettes, output_field=MONTANT_FIELD), Value(Decimal('0')), output_field=MONTANT_FIELD)
+
+
+class VenteQuerySet(models.QuerySet):
+
+    def with_totals(self):
+        """Annote chaque vente avec la dette totale de son école (les totaux de la vente sont persistés)"""
+        return self.annotate(dette_ecole=_dettes_ecole())
+
+    def with_dettes_autres(self):
+        """Annote la dette des autres ventes de la même école pour la même année scolaire"""
+        return self.annotate(
+            dette_autres_annee=_dettes_ecole(Q(annee_scolaire=OuterRef('annee_scolaire'))) - F('total_restant')
+        )
+
+    def with_live_totals(self):
+        """Annote les totaux recalculés depuis les lignes et paiements (contrôle des soldes persistés)"""
+        return self.annotate(
+            calc_total_lignes=_somme_lignes(),
+            calc_total_paye=_somme_paiements(),
+            calc_total_restant=_reste_du(),
+            calc_nb_lignes=_nombre_lignes(),
+        )
+
+
 class Vente(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     ecole = models.ForeignKey(Ecoles, on_delete=models.CASCADE, related_name='ventes')
     annee_scolaire = models.ForeignKey(AnneeScolaire, on_delete=models.CASCADE, related_name='ventes')
     date_paiement = models.DateTimeField(null=True, blank=True) 
     facture_pdf = models.FileField(upload_to='factures/', blank=True, null=True)
+    # Empreinte du contenu ayant servi à rendre facture_pdf (voir gestion/factures.py)
+    facture_empreinte = models.CharField(max_length=64, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     modified_at = models.DateTimeField(null=True, blank=True)
     derniere_modification_type = models.CharField(max_length=50, null=True, blank=True) 
     articles_ajoutes_session = models.TextField(null=True, blank=True)
     description_dette = models.TextField(blank=True, null=True, help_text="Description de la dette (ex: 'Reliquat année 2023-2024')")
-    
+
+    # Soldes persistés, tenus à jour à chaque écriture de ligne ou de paiement
+    total_lignes = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    total_paye = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    total_restant = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    nb_lignes = models.IntegerField(default=0)
+    # Dernier numéro de tranche attribué (jamais réutilisé, même après annulation)
+    derniere_tranche = models.PositiveIntegerField(default=0)
+
+    objects = VenteQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Pagination par clé de l'API des ventes (gestion/api.py)
+            models.Index(fields=['updated_at', 'id'], name='vente_updated_at_id_idx'),
+        ]
+
+    CHAMPS_SOLDES = ['total_lignes', 'total_paye', 'total_restant', 'nb_lignes']
 
     @property
     def montant_total(self):
-        return self.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
+        return self.total_lignes
     
     @property
     def montant_paye(self):
-        # Exclure les paiements annulés
-        return self.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
+        return self.total_paye
     
     @property
     def montant_restant(self):
-        return max(Decimal('0'), self.montant_total - self.montant_paye)
+        return self.total_restant
+
+    def _verrouiller(self):
+        """Verrouille la ligne de la vente et recharge ses soldes (à appeler dans transaction.atomic)"""
+        soldes = Vente.objects.select_for_update().filter(pk=self.pk).values(*self.CHAMPS_SOLDES).get()
+        for champ, valeur in soldes.items():
+            setattr(self, champ, valeur)
+
+    def _appliquer_soldes(self, delta_lignes=Decimal('0'), delta_paye=Decimal('0'), delta_nb=0):
+        """Applique une variation aux soldes persistés d'une vente préalablement verrouillée"""
+        avant = (self.total_lignes, self.total_paye, self.total_restant)
+        self.total_lignes = Decimal(self.total_lignes) + delta_lignes
+        self.total_paye = Decimal(self.total_paye) + delta_paye
+        self.nb_lignes += delta_nb
+        self.total_restant = max(Decimal('0'), self.total_lignes - self.total_paye)
+        Vente.objects.filter(pk=self.pk).update(
+            total_lignes=self.total_lignes,
+            total_paye=self.total_paye,
+            total_restant=self.total_restant,
+            nb_lignes=self.nb_lignes,
+        )
+        DetteEcoleAnnee.enregistrer_variation(
+            self, avant, (self.total_lignes, self.total_paye, self.total_restant)
+        )
+        AnneeScolaire.marquer_modifiee(self.annee_scolaire_id)
+
+        # La facture stockée est périmée : re-rendu en arrière-plan après validation
+        from .factures import planifier_rendu
+        planifier_rendu(self.pk)
+
+    def save(self, *args, **kwargs):
+        creation = self._state.adding
+        super().save(*args, **kwargs)
+        if creation:
+            AnneeScolaire.marquer_modifiee(self.annee_scolaire_id)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            self._verrouiller()
+            DetteEcoleAnnee.enregistrer_variation(
+                self, (self.total_lignes, self.total_paye, self.total_restant), (0, 0, 0)
+            )
+            AnneeScolaire.marquer_modifiee(self.annee_scolaire_id)
+            if self.facture_pdf:
+                fichier = self.facture_pdf
+                transaction.on_commit(lambda: fichier.delete(save=False))
+            return super().delete(*args, **kwargs)
+
+    def recalculer_soldes(self):
+        """Reconstruit les soldes persistés depuis les lignes et paiements"""
+        with transaction.atomic():
+            self._verrouiller()
+            calcul = Vente.objects.filter(pk=self.pk).with_live_totals().values(
+                'calc_total_lignes', 'calc_total_paye', 'calc_nb_lignes'
+            ).get()
+            # Variations par rapport aux soldes verrouillés, pour que le registre des dettes suive
+            self._appliquer_soldes(
+                delta_lignes=Decimal(calcul['calc_total_lignes']) - Decimal(self.total_lignes),
+                delta_paye=Decimal(calcul['calc_total_paye']) - Decimal(self.total_paye),
+                delta_nb=calcul['calc_nb_lignes'] - self.nb_lignes,
+            )
 
     def get_dettes_par_annee_ecole(self):
-        ventes_ecole = Vente.objects.filter(ecole=self.ecole)\
-            .select_related('annee_scolaire')\
-            .order_by('-annee_scolaire__annee_debut')
-        
-        dettes_par_annee = {}
-        
-        for vente in ventes_ecole:
-            annee_str = str(vente.annee_scolaire)
-            total_lignes = vente.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-            # Exclure les paiements annulés
-            total_paye = vente.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
-            restant = total_lignes - total_paye
-            
-            if restant > 0:
-                if annee_str in dettes_par_annee:
-                    dettes_par_annee[annee_str]['montant_restant'] += restant
-                    dettes_par_annee[annee_str]['ventes'].append(vente)
-                    dettes_par_annee[annee_str]['montant_articles'] += total_lignes
-                    dettes_par_annee[annee_str]['montant_total'] += total_lignes
-                    dettes_par_annee[annee_str]['montant_paye'] += total_paye
-                else:
-                    dettes_par_annee[annee_str] = {
-                        'annee_scolaire': vente.annee_scolaire,
-                        'montant_restant': restant,
-                        'ventes': [vente],
-                        'montant_articles': total_lignes,
-                        'montant_total': total_lignes,
-                        'montant_paye': total_paye
-                    }
-        
-        return dettes_par_annee
+        return DetteEcoleAnnee.dettes_par_annee(self.ecole_id)
     
     def get_total_dettes_ecole(self):
-        dettes = self.get_dettes_par_annee_ecole()
-        return sum(dette['montant_restant'] for dette in dettes.values())
+        return DetteEcoleAnnee.total_dette(self.ecole_id)
 
     def est_en_retard(self): 
         return
@@ -174,113 +328,299 @@ class Vente(models.Model):
         return
     
     def get_articles_par_session(self, tolerance_minutes=5):
-        lignes = self.lignes.all().order_by('date_ajout')
+        return Vente.grouper_par_session(self.lignes.all().order_by('date_ajout'), tolerance_minutes)
+
+    @staticmethod
+    def grouper_par_session(lignes, tolerance_minutes=5):
+        """Regroupe en sessions des lignes déjà triées par date d'ajout, sans requête supplémentaire.
+
+        Les écarts entre lignes consécutives sont calculés une seule fois et servent
+        à la fois au choix de la tolérance et au découpage.
+        """
+        lignes = list(lignes)
         if not lignes:
             return []
         
+        ecarts = Vente._ecarts_minutes(lignes)
         if tolerance_minutes == 5:
-            tolerance_minutes = self._detecter_tolerance_automatique()
+            tolerance_minutes = Vente._tolerance_pour_ecarts(ecarts)
         
         sessions = []
-        session_courante = []
-        derniere_date = None
-        
-        for ligne in lignes:
-            if not session_courante:
-                session_courante = [ligne]
-                derniere_date = ligne.date_ajout
-            else:
-                ecart_minutes = (ligne.date_ajout - derniere_date).total_seconds() / 60
-                
-                if ecart_minutes <= tolerance_minutes:
-                    session_courante.append(ligne)
-                    derniere_date = ligne.date_ajout
-                else:
-                    sessions.append({
-                        'date_session': session_courante[0].date_ajout,
-                        'lignes': session_courante.copy(),
-                        'montant_total': sum(l.montant for l in session_courante),
-                        'nombre_articles': sum(l.quantite for l in session_courante)
-                    })
-                    
-                    session_courante = [ligne]
-                    derniere_date = ligne.date_ajout
-
-        if session_courante:
-            sessions.append({
-                'date_session': session_courante[0].date_ajout,
-                'lignes': session_courante.copy(),
-                'montant_total': sum(l.montant for l in session_courante),
-                'nombre_articles': sum(l.quantite for l in session_courante)
-            })
+        debut = 0
+        for i, ecart in enumerate(ecarts, 1):
+            if ecart > tolerance_minutes:
+                sessions.append(Vente._session(lignes[debut:i]))
+                debut = i
+        sessions.append(Vente._session(lignes[debut:]))
         
         return sessions
+
+    @staticmethod
+    def _session(lignes):
+        return {
+            'date_session': lignes[0].date_ajout,
+            'lignes': lignes,
+            'montant_total': sum(l.montant for l in lignes),
+            'nombre_articles': sum(l.quantite for l in lignes)
+        }
+
+    @staticmethod
+    def _ecarts_minutes(lignes):
+        """Écarts en minutes entre lignes consécutives"""
+        return [
+            (suivante.date_ajout - precedente.date_ajout).total_seconds() / 60
+            for precedente, suivante in zip(lignes, lignes[1:])
+        ]
     
     def _detecter_tolerance_automatique(self):
-        lignes = self.lignes.all().order_by('date_ajout')
-        if len(lignes) <= 1:
+        lignes = list(self.lignes.all().order_by('date_ajout'))
+        return Vente._tolerance_pour_ecarts(Vente._ecarts_minutes(lignes))
+
+    @staticmethod
+    def _tolerance_pour_ecarts(ecarts):
+        if not ecarts:
             return 30  
         
-        ecarts = []
-        for i in range(1, len(lignes)):
-            ecart = (lignes[i].date_ajout - lignes[i-1].date_ajout).total_seconds() / 60
-            ecarts.append(ecart)
-        
-        ecarts_tries = sorted(ecarts)
-        
-        if any(e > 60 for e in ecarts_tries):
+        ecart_max = max(ecarts)
+        if ecart_max > 60:
             return 20
-        elif any(e > 15 for e in ecarts_tries):
+        elif ecart_max > 15:
             return 10
         else:
             return 5
     
-    def ajouter_articles(self, articles_data, description_session=None):
-        lignes_creees = []
+    def ajouter_articles(self, articles_data, description_session=None, reservation=None):
+        """Ajoute des lignes à la vente et décrémente le stock, en un nombre fixe de requêtes.
+
+        `articles_data` est une liste de dictionnaires {'cahier': Cahiers, 'quantite': int}.
+        `reservation` est la clé de la saisie dont les réservations de stock sont consommées.
+        Lève ValueError si un cahier n'a pas assez de stock hors réservations des autres saisies.
+        """
         maintenant = timezone.now()
+        lignes = [
+            LigneVente(
+                vente=self,
+                cahier=article['cahier'],
+                quantite=article['quantite'],
+                montant=Decimal(str(article['cahier'].prix)) * Decimal(str(article['quantite']))
+            )
+            for article in articles_data
+        ]
+        if not lignes:
+            return []
+        
+        # Quantités retirées par cahier (un cahier peut figurer plusieurs fois)
+        quantites = {}
+        for ligne in lignes:
+            quantites[ligne.cahier_id] = quantites.get(ligne.cahier_id, 0) + ligne.quantite
         
-        for article in articles_data:
-            cahier = article['cahier']
-            quantite = article['quantite']
-            montant = Decimal(str(cahier.prix)) * Decimal(str(quantite))
+        with transaction.atomic():
+            self._verrouiller()
+            
+            # Cahiers verrouillés comme dans ReservationStock.reserver : le stock retenu par
+            # les autres saisies ne peut pas être vendu entre la vérification et la sortie
+            list(Cahiers.objects.select_for_update().filter(pk__in=quantites).order_by('pk').values_list('pk', flat=True))
+            disponibles = ReservationStock.disponibles(quantites.keys(), sauf_cle=reservation)
+            manquants = [
+                f"{ligne.cahier.titre} ({max(disponibles.get(ligne.cahier_id, 0), 0)} disponible(s))"
+                for ligne in {ligne.cahier_id: ligne for ligne in lignes}.values()
+                if quantites[ligne.cahier_id] > disponibles.get(ligne.cahier_id, 0)
+            ]
+            if manquants:
+                raise ValueError(f"Stock insuffisant : {', '.join(manquants)}")
             
-            ligne = LigneVente.objects.create(
+            lignes_creees = LigneVente.objects.bulk_create(lignes)
+            
+            # Sortie de stock atomique et journalisée (voir MouvementStock)
+            MouvementStock.appliquer(
+                {cahier_id: -quantite for cahier_id, quantite in quantites.items()},
+                TypeMouvementStock.VENTE,
                 vente=self,
-                cahier=cahier,
-                quantite=quantite,
-                montant=montant
             )
+            if reservation:
+                ReservationStock.liberer(reservation)
             
-            lignes_creees.append(ligne)
+            self._appliquer_soldes(
+                delta_lignes=sum((ligne.montant for ligne in lignes_creees), Decimal('0')),
+                delta_nb=len(lignes_creees)
+            )
             
-            if cahier.quantite_stock is not None:
-                cahier.quantite_stock = max(0, cahier.quantite_stock - quantite)
-                cahier.save()
-        
-        self.modified_at = maintenant
-        self.derniere_modification_type = 'ajout_articles'
-        if description_session:
-            self.articles_ajoutes_session = description_session
-        self.save()
+            self.modified_at = maintenant
+            self.derniere_modification_type = 'ajout_articles'
+            if description_session:
+                self.articles_ajoutes_session = description_session
+            self.save(update_fields=['modified_at', 'derniere_modification_type', 'articles_ajoutes_session', 'updated_at'])
         
         return lignes_creees
+
+    def retirer_articles(self, retraits):
+        """Retire des quantités de cahiers de la vente et remet le stock correspondant.
+
+        `retraits` est une liste de dictionnaires {'cahier_id': ..., 'quantite': ...}.
+        Retourne les titres des cahiers modifiés.
+        """
+        modifications = []
+        
+        with transaction.atomic():
+            self._verrouiller()
+            delta_lignes = Decimal('0')
+            retours = {}
+            
+            for retrait in retraits:
+                quantite_retirer = retrait['quantite']
+                ligne_vente = self.lignes.select_related('cahier').filter(cahier_id=retrait['cahier_id']).first()
+                if ligne_vente and 0 < quantite_retirer <= ligne_vente.quantite:
+                    ancien_montant = ligne_vente.montant
+                    ligne_vente.quantite -= quantite_retirer
+                    ligne_vente.montant = ligne_vente.quantite * ligne_vente.cahier.prix
+                    ligne_vente.save()
+                    delta_lignes += ligne_vente.montant - ancien_montant
+                    retours[ligne_vente.cahier_id] = retours.get(ligne_vente.cahier_id, 0) + quantite_retirer
+                    modifications.append(ligne_vente.cahier.titre)
+            
+            # Remettre le stock des cahiers
+            MouvementStock.appliquer(retours, TypeMouvementStock.RETOUR, vente=self)
+            
+            # Supprimer les lignes à 0
+            lignes_supprimees, _ = self.lignes.filter(quantite=0).delete()
+            self._appliquer_soldes(delta_lignes=delta_lignes, delta_nb=-lignes_supprimees)
+        
+        return modifications
+
+    def gerer_paiement(self, montant_donne, anciennes_d_abord=None, date_paiement=None, reference=''):
+        """Enregistre un paiement sur la vente puis répartit l'excédent sur les autres dettes de l'école.
+
+        L'excédent va d'abord aux années les plus récentes, ou aux plus anciennes si
+        `anciennes_d_abord` (défaut: PAIEMENT_DETTES_ANCIENNES_D_ABORD).
+        `date_paiement` (défaut: aujourd'hui) et `reference` sont reportés sur chaque tranche créée.
+        Retourne le montant excédentaire à rendre.
+        """
+        from django.conf import settings
+        
+        if anciennes_d_abord is None:
+            anciennes_d_abord = getattr(settings, 'PAIEMENT_DETTES_ANCIENNES_D_ABORD', False)
+        
+        with transaction.atomic():
+            # Verrouiller en une requête, dans un ordre stable, la vente et les autres ventes dues de l'école
+            ventes = list(
+                Vente.objects.select_for_update()
+                .filter(Q(pk=self.pk) | Q(total_restant__gt=0), ecole_id=self.ecole_id)
+                .select_related('annee_scolaire')
+                .order_by('pk')
+            )
+            courante = next(vente for vente in ventes if vente.pk == self.pk)
+            for champ in self.CHAMPS_SOLDES:
+                setattr(self, champ, getattr(courante, champ))
+            self.derniere_tranche = courante.derniere_tranche
+            
+            autres_ventes = sorted(
+                (vente for vente in ventes if vente.pk != self.pk),
+                key=lambda vente: vente.annee_scolaire.annee_debut,
+                reverse=not anciennes_d_abord
+            )
+            
+            # Répartition en mémoire : la vente courante d'abord, puis les autres dettes
+            repartition = []
+            reste = montant_donne
+            for vente in [self] + autres_ventes:
+                if reste <= 0:
+                    break
+                montant = min(reste, vente.total_restant)
+                if montant > 0:
+                    repartition.append((vente, montant))
+                    reste -= montant
+            
+            if not repartition:
+                return max(reste, Decimal('0'))
+            
+            paiements = Paiement.objects.bulk_create([
+                Paiement(vente=vente, montant=montant, numero_tranche=vente.derniere_tranche + 1,
+                         date_paiement=date_paiement or date.today(), reference=reference)
+                for vente, montant in repartition
+            ])
+            MouvementPaiement.objects.bulk_create([
+                MouvementPaiement(vente_id=paiement.vente_id, paiement=paiement,
+                                  type_mouvement=TypeMouvementPaiement.PAIEMENT, montant=paiement.montant)
+                for paiement in paiements
+            ])
+            Vente.objects.filter(pk__in=[vente.pk for vente, _ in repartition])\
+                .update(derniere_tranche=F('derniere_tranche') + 1)
+            for vente, montant in repartition:
+                vente.derniere_tranche += 1
+                vente._appliquer_soldes(delta_paye=montant)
+        
+        return max(reste, Decimal('0'))
+
+    def annuler_paiement(self, paiement):
+        """Marque un paiement comme annulé et retire son montant des soldes.
+
+        Retourne False si le paiement était déjà annulé.
+        """
+        with transaction.atomic():
+            self._verrouiller()
+            paiement = Paiement.objects.select_for_update().get(pk=paiement.pk, vente=self)
+            if paiement.est_annule:
+                return False
+            paiement.est_annule = True
+            paiement.date_annulation = timezone.now()
+            paiement.save(update_fields=['est_annule', 'date_annulation'])
+            # L'annulation s'ajoute au journal en écriture négative
+            MouvementPaiement.objects.create(
+                vente=self, paiement=paiement, type_mouvement=TypeMouvementPaiement.ANNULATION,
+                montant=-paiement.montant, date_mouvement=paiement.date_annulation
+            )
+            self._appliquer_soldes(delta_paye=-paiement.montant)
+        return True
     
 
 class Paiement(models.Model):
     vente = models.ForeignKey(Vente, on_delete=models.CASCADE, related_name='paiements')
     montant = models.DecimalField(max_digits=10, decimal_places=2)
-    date_paiement = models.DateField(auto_now_add=True)
+    date_paiement = models.DateField(default=date.today)
     numero_tranche = models.IntegerField(default=1)
+    # Référence de l'opération (banque, mobile money), utilisée pour ignorer les imports en double
+    reference = models.CharField(max_length=100, blank=True, default='', db_index=True)
     est_annule = models.BooleanField(default=False)
     date_annulation = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['numero_tranche']
+        indexes = [
+            # Couvre les sommes de paiements actifs par vente sans lire la table
+            models.Index(fields=['vente', 'est_annule', 'montant'], name='paiement_vente_actif_idx'),
+        ]
 
     def __str__(self):
         statut = " (ANNULÉ)" if self.est_annule else ""
         return f"{self.vente.ecole.nom} - Tranche {self.numero_tranche} - {self.montant} F le {self.date_paiement}{statut}"
 
+class TypeMouvementPaiement(models.TextChoices):
+    PAIEMENT = 'paiement', 'Paiement'
+    ANNULATION = 'annulation', 'Annulation'
+
+class MouvementPaiement(models.Model):
+    """Journal des paiements, en ajout seul : une annulation y est une écriture négative"""
+    vente = models.ForeignKey(Vente, on_delete=models.CASCADE, related_name='mouvements_paiement')
+    paiement = models.ForeignKey(Paiement, on_delete=models.CASCADE, related_name='mouvements')
+    type_mouvement = models.CharField(max_length=20, choices=TypeMouvementPaiement.choices)
+    # Positif pour un paiement, négatif pour une annulation
+    montant = models.DecimalField(max_digits=15, decimal_places=2)
+    date_mouvement = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        ordering = ['date_mouvement']
+        indexes = [
+            # Le total payé d'une vente est une somme lue dans l'index
+            models.Index(fields=['vente', 'montant'], name='mouvement_paiement_vente_idx'),
+        ]
+        constraints = [
+            # Un paiement n'est enregistré, et annulé, qu'une seule fois
+            models.UniqueConstraint(fields=['paiement', 'type_mouvement'], name='mouvement_paiement_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_type_mouvement_display()} {self.montant} F - Tranche {self.paiement.numero_tranche}"
+
 class LigneVente(models.Model):
     vente = models.ForeignKey(Vente, on_delete=models.CASCADE, related_name='lignes')
     cahier = models.ForeignKey(Cahiers, on_delete=models.CASCADE)
@@ -300,6 +640,252 @@ class LigneVente(models.Model):
         date_str = self.date_ajout.strftime('%d/%m/%Y %H:%M') if self.date_ajout else 'Date inconnue'
         return f"{self.quantite} x {self.cahier.titre} pour {self.vente.ecole.nom} le {date_str}"
 
+class TypeMouvementStock(models.TextChoices):
+    STOCK_INITIAL = 'stock_initial', 'Stock initial'
+    VENTE = 'vente', 'Vente'
+    RETOUR = 'retour', "Retour (retrait d'articles)"
+    REAPPROVISIONNEMENT = 'reapprovisionnement', 'Réapprovisionnement'
+    AJUSTEMENT = 'ajustement', 'Ajustement manuel'
+
+class MouvementStock(models.Model):
+    """Journal des mouvements de stock, en ajout seul : Cahiers.quantite_stock en est le solde"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    cahier = models.ForeignKey(Cahiers, on_delete=models.CASCADE, related_name='mouvements')
+    type_mouvement = models.CharField(max_length=20, choices=TypeMouvementStock.choices)
+    # Positive pour une entrée, négative pour une sortie
+    quantite = models.IntegerField()
+    vente = models.ForeignKey(Vente, on_delete=models.SET_NULL, null=True, blank=True, related_name='mouvements_stock')
+    date_mouvement = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-date_mouvement']
+        indexes = [models.Index(fields=['cahier', 'date_mouvement'])]
+
+    def __str__(self):
+        return f"{self.get_type_mouvement_display()} {self.quantite:+d} - {self.cahier.titre}"
+
+    @classmethod
+    def appliquer(cls, variations, type_mouvement, vente=None):
+        """Applique des variations de stock {cahier_id: quantité signée} et les journalise.
+
+        Les cahiers sont verrouillés, une sortie est bornée au stock restant, puis le stock est
+        mis à jour en base par F() : aucune mise à jour concurrente n'est perdue.
+        Retourne les variations réellement appliquées.
+        """
+        variations = {cahier_id: quantite for cahier_id, quantite in variations.items() if quantite}
+        if not variations:
+            return {}
+        
+        with transaction.atomic():
+            stocks = dict(
+                Cahiers.objects.select_for_update().filter(pk__in=variations).order_by('pk')
+                .values_list('pk', 'quantite_stock')
+            )
+            appliquees = {}
+            for cahier_id, quantite in variations.items():
+                if cahier_id in stocks:
+                    quantite = max(quantite, -max(stocks[cahier_id], 0))
+                    if quantite:
+                        appliquees[cahier_id] = quantite
+            if not appliquees:
+                return {}
+            
+            Cahiers.objects.filter(pk__in=appliquees).update(
+                quantite_stock=Greatest(
+                    F('quantite_stock') + Case(
+                        *[When(pk=cahier_id, then=Value(quantite)) for cahier_id, quantite in appliquees.items()],
+                        default=Value(0),
+                        output_field=models.IntegerField(),
+                    ),
+                    Value(0),
+                ),
+                updated_at=timezone.now(),
+            )
+            cls.objects.bulk_create([
+                cls(cahier_id=cahier_id, type_mouvement=type_mouvement, quantite=quantite, vente=vente)
+                for cahier_id, quantite in appliquees.items()
+            ])
+            # Le stock apparaît dans les bilans de toutes les années (comme Cahiers.save)
+            AnneeScolaire.marquer_modifiee()
+        
+        return appliquees
+
+    @classmethod
+    def ajuster(cls, cahier_id, nouveau_stock):
+        """Fixe le stock d'un cahier à une valeur saisie, via un mouvement d'ajustement"""
+        with transaction.atomic():
+            stock = Cahiers.objects.select_for_update().filter(pk=cahier_id).values_list('quantite_stock', flat=True).first()
+            if stock is None:
+                return 0
+            return cls.appliquer({cahier_id: nouveau_stock - stock}, TypeMouvementStock.AJUSTEMENT).get(cahier_id, 0)
+
+class ReservationStock(models.Model):
+    """Stock retenu pendant la saisie d'une vente, libéré à sa validation ou à expiration"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # Identifiant de la saisie en cours (une fenêtre de vente ouverte)
+    cle = models.CharField(max_length=64)
+    cahier = models.ForeignKey(Cahiers, on_delete=models.CASCADE, related_name='reservations')
+    quantite = models.PositiveIntegerField()
+    expire_le = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['cle', 'cahier']
+
+    def __str__(self):
+        return f"Réservation {self.cle[:8]} - {self.quantite} x {self.cahier.titre}"
+
+    @classmethod
+    def disponibles(cls, cahier_ids, sauf_cle=None):
+        """Stock disponible par cahier : stock moins les réservations actives des autres saisies"""
+        reservations = cls.objects.filter(cahier=OuterRef('pk'), expire_le__gt=timezone.now())
+        if sauf_cle:
+            reservations = reservations.exclude(cle=sauf_cle)
+        reserve = Subquery(
+            reservations.order_by().values('cahier').annotate(total=Sum('quantite')).values('total')[:1],
+            output_field=models.IntegerField(),
+        )
+        return dict(
+            Cahiers.objects.filter(pk__in=cahier_ids)
+            .annotate(disponible=F('quantite_stock') - Coalesce(reserve, Value(0)))
+            .values_list('pk', 'disponible')
+        )
+
+    @classmethod
+    def reserver(cls, cle, quantites, duree_minutes=None):
+        """Remplace les réservations de la saisie `cle` par {cahier_id: quantité}, bornées au disponible.
+
+        Retourne les quantités effectivement réservées.
+        """
+        from django.conf import settings
+        
+        duree_minutes = duree_minutes or getattr(settings, 'RESERVATION_STOCK_MINUTES', 15)
+        maintenant = timezone.now()
+        
+        with transaction.atomic():
+            # Verrouiller les cahiers sérialise les réservations concurrentes sur le même stock
+            list(Cahiers.objects.select_for_update().filter(pk__in=quantites).order_by('pk').values_list('pk', flat=True))
+            cls.objects.filter(Q(cle=cle) | Q(expire_le__lte=maintenant)).delete()
+            
+            disponibles = cls.disponibles(quantites.keys())
+            reservees = {
+                cahier_id: max(0, min(quantite, disponibles[cahier_id]))
+                for cahier_id, quantite in quantites.items()
+                if cahier_id in disponibles
+            }
+            cls.objects.bulk_create([
+                cls(cle=cle, cahier_id=cahier_id, quantite=quantite, expire_le=maintenant + timedelta(minutes=duree_minutes))
+                for cahier_id, quantite in reservees.items()
+                if quantite > 0
+            ])
+        
+        return reservees
+
+    @classmethod
+    def liberer(cls, cle):
+        return cls.objects.filter(cle=cle).delete()[0]
+
+class DetteEcoleAnnee(models.Model):
+    """Registre matérialisé des dettes d'une école par année scolaire.
+
+    Seules les ventes avec un reste dû y contribuent ; le registre est mis à jour
+    à chaque variation des soldes d'une vente (voir Vente._appliquer_soldes).
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    ecole = models.ForeignKey(Ecoles, on_delete=models.CASCADE, related_name='dettes_annuelles')
+    annee_scolaire = models.ForeignKey(AnneeScolaire, on_delete=models.CASCADE, related_name='dettes_ecoles')
+
+    montant_articles = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    montant_paye = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    montant_restant = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    nb_ventes = models.IntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['ecole', 'annee_scolaire']
+        ordering = ['-annee_scolaire__annee_debut']
+
+    def __str__(self):
+        return f"Dette {self.ecole} - {self.annee_scolaire} : {self.montant_restant} F"
+
+    @staticmethod
+    def contribution(total_lignes, total_paye, total_restant):
+        """Part d'une vente dans le registre : (articles, payé, restant, nombre de ventes)"""
+        if total_restant > 0:
+            return (Decimal(total_lignes), Decimal(total_paye), Decimal(total_restant), 1)
+        return (Decimal('0'), Decimal('0'), Decimal('0'), 0)
+
+    @classmethod
+    def enregistrer_variation(cls, vente, avant, apres):
+        """Reporte dans le registre la variation de contribution d'une vente"""
+        delta = [nouveau - ancien for nouveau, ancien in zip(cls.contribution(*apres), cls.contribution(*avant))]
+        if not any(delta):
+            return
+        dette, created = cls.objects.get_or_create(ecole_id=vente.ecole_id, annee_scolaire_id=vente.annee_scolaire_id)
+        cls.objects.filter(pk=dette.pk).update(
+            montant_articles=F('montant_articles') + delta[0],
+            montant_paye=F('montant_paye') + delta[1],
+            montant_restant=F('montant_restant') + delta[2],
+            nb_ventes=F('nb_ventes') + delta[3],
+            updated_at=timezone.now(),
+        )
+
+    @classmethod
+    def dettes_par_annee(cls, ecole_id):
+        """Dettes de l'école par année scolaire, de la plus récente à la plus ancienne"""
+        dettes = cls.objects.filter(ecole_id=ecole_id, montant_restant__gt=0).select_related('annee_scolaire')
+        return {
+            str(dette.annee_scolaire): {
+                'annee_scolaire': dette.annee_scolaire,
+                'montant_restant': dette.montant_restant,
+                'montant_articles': dette.montant_articles,
+                'montant_total': dette.montant_articles,
+                'montant_paye': dette.montant_paye,
+                'nb_ventes': dette.nb_ventes,
+            }
+            for dette in dettes
+        }
+
+    @classmethod
+    def total_dette(cls, ecole_id):
+        """Dette totale de l'école, toutes années confondues"""
+        return cls.objects.filter(ecole_id=ecole_id).aggregate(total=Sum('montant_restant'))['total'] or Decimal('0')
+
+    @classmethod
+    def calculer(cls):
+        """Recalcule le registre depuis les soldes persistés des ventes (une requête groupée)"""
+        lignes = Vente.objects.filter(total_restant__gt=0).order_by()\
+            .values('ecole_id', 'annee_scolaire_id')\
+            .annotate(
+                articles=Sum('total_lignes'),
+                paye=Sum('total_paye'),
+                restant=Sum('total_restant'),
+                nb=Count('id'),
+            )
+        return {
+            (ligne['ecole_id'], ligne['annee_scolaire_id']): (ligne['articles'], ligne['paye'], ligne['restant'], ligne['nb'])
+            for ligne in lignes
+        }
+
+    @classmethod
+    def reconstruire(cls):
+        """Reconstruit entièrement le registre"""
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([
+                cls(
+                    ecole_id=ecole_id,
+                    annee_scolaire_id=annee_id,
+                    montant_articles=articles,
+                    montant_paye=paye,
+                    montant_restant=restant,
+                    nb_ventes=nb,
+                )
+                for (ecole_id, annee_id), (articles, paye, restant, nb) in cls.calculer().items()
+            ], batch_size=500)
+
+
 class BilanAnneeScolaire(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     annee_scolaire = models.OneToOneField(AnneeScolaire, on_delete=models.CASCADE, related_name='bilan')
@@ -314,44 +900,84 @@ class BilanAnneeScolaire(models.Model):
     nombre_ecoles_actives = models.IntegerField(default=0)
     
     date_generation = models.DateTimeField(auto_now=True)
+    # Version des données de l'année ayant servi au calcul (voir AnneeScolaire.version_donnees)
+    version_donnees = models.IntegerField(default=-1)
     
     def __str__(self):
         return f"Bilan {self.annee_scolaire}"
 
+    @property
+    def est_a_jour(self):
+        return self.version_donnees == self.annee_scolaire.version_donnees
+
+    @classmethod
+    def get_bilan(cls, annee_scolaire):
+        """Retourne le bilan de l'année, recalculé seulement si ses données ont changé"""
+        bilan = cls.objects.filter(annee_scolaire=annee_scolaire).select_related('annee_scolaire').first()
+        if bilan is None or not bilan.est_a_jour:
+            bilan = cls.generer_bilan(annee_scolaire)
+        return bilan
+
+    @classmethod
+    def get_bilans(cls, annees):
+        """Retourne les bilans d'une liste d'années (une requête), en recalculant ceux qui sont périmés"""
+        bilans = {
+            bilan.annee_scolaire_id: bilan
+            for bilan in cls.objects.filter(annee_scolaire__in=annees).select_related('annee_scolaire')
+        }
+        resultat = []
+        for annee in annees:
+            bilan = bilans.get(annee.pk)
+            if bilan is None or not bilan.est_a_jour:
+                bilan = cls.generer_bilan(annee)
+            resultat.append(bilan)
+        return resultat
+
     @classmethod
     def generer_bilan(cls, annee_scolaire):
+        # Lire la version avant le calcul : une écriture concurrente laissera le bilan périmé
+        version = AnneeScolaire.objects.filter(pk=annee_scolaire.pk).values_list('version_donnees', flat=True).get()
         bilan, created = cls.objects.get_or_create(annee_scolaire=annee_scolaire)
         
-        ventes = Vente.objects.filter(annee_scolaire=annee_scolaire)
-        
-        bilan.nombre_ventes_total = ventes.count()
-        bilan.montant_total_ventes = sum(v.montant_total for v in ventes)
-        bilan.montant_total_paye = sum(v.montant_paye for v in ventes)
-        bilan.montant_total_impaye = bilan.montant_total_ventes - bilan.montant_total_paye
+        totaux_ventes = Vente.objects.filter(annee_scolaire=annee_scolaire).aggregate(
+            nombre=Count('id'),
+            ecoles=Count('ecole', distinct=True),
+        )
+        # Exclure les paiements annulés
+        total_paye = Paiement.objects.filter(
+            vente__annee_scolaire=annee_scolaire,
+            est_annule=False
+        ).aggregate(total=Sum('montant'))['total'] or Decimal('0')
         
-        bilan.nombre_ecoles_actives = ventes.values('ecole').distinct().count()
+        # Une seule requête groupée par cahier (les cahiers sans vente restent listés)
+        cahiers = Cahiers.objects.annotate(
+            quantite_vendue=Coalesce(Sum('lignevente__quantite', filter=Q(lignevente__vente__annee_scolaire=annee_scolaire)), Value(0)),
+            ca_genere=Coalesce(
+                Sum('lignevente__montant', filter=Q(lignevente__vente__annee_scolaire=annee_scolaire)),
+                Value(Decimal('0')),
+                output_field=MONTANT_FIELD
+            ),
+        )
         
         ventes_par_cahier = {}
-        cahiers = Cahiers.objects.all()
-        
+        montant_total_ventes = Decimal('0')
         for cahier in cahiers:
-            lignes_cahier = LigneVente.objects.filter(
-                vente__annee_scolaire=annee_scolaire,
-                cahier=cahier
-            )
-            
-            quantite_vendue = sum(ligne.quantite for ligne in lignes_cahier)
-            ca_genere = sum(ligne.montant for ligne in lignes_cahier)
-            
+            montant_total_ventes += cahier.ca_genere
             ventes_par_cahier[str(cahier.id)] = {
                 'titre': cahier.titre,
                 'prix_unitaire': float(cahier.prix),
-                'quantite_vendue': quantite_vendue,
-                'ca_genere': float(ca_genere),
+                'quantite_vendue': cahier.quantite_vendue,
+                'ca_genere': float(cahier.ca_genere),
                 'stock_actuel': cahier.quantite_stock
             }
         
+        bilan.nombre_ventes_total = totaux_ventes['nombre']
+        bilan.nombre_ecoles_actives = totaux_ventes['ecoles']
+        bilan.montant_total_ventes = montant_total_ventes
+        bilan.montant_total_paye = total_paye
+        bilan.montant_total_impaye = bilan.montant_total_ventes - bilan.montant_total_paye
         bilan.ventes_par_cahier = ventes_par_cahier
+        bilan.version_donnees = version
         bilan.save()
         
         return bilan
@@ -369,6 +995,8 @@ class BilanMensuel(models.Model):
     ventes_par_cahier = models.JSONField(default=dict)
     
     date_generation = models.DateTimeField(auto_now=True)
+    # Version des données de l'année ayant servi au calcul (voir AnneeScolaire.version_donnees)
+    version_donnees = models.IntegerField(default=-1)
     
     class Meta:
         unique_together = ['annee_scolaire', 'mois', 'annee']
@@ -386,75 +1014,116 @@ class BilanMensuel(models.Model):
         return mois_noms[self.mois]
 
     @classmethod
-    def generer_bilan_mois(cls, annee_scolaire, mois, annee):
-        bilan, created = cls.objects.get_or_create(
-            annee_scolaire=annee_scolaire,
-            mois=mois,
-            annee=annee
-        )
-        
-        debut_mois = date(annee, mois, 1)
-        if mois == 12:
-            fin_mois = date(annee + 1, 1, 1) - timezone.timedelta(days=1)
-        else:
-            fin_mois = date(annee, mois + 1, 1) - timezone.timedelta(days=1)
+    def generer_bilans(cls, annee_scolaire, mois_scolaires):
+        """Calcule et enregistre les bilans des mois donnés en trois requêtes groupées par mois.
+
+        Retourne les bilans relus en base : les objets passés à bulk_create(update_conflicts=True)
+        n'ont pas forcément la clé primaire des lignes déjà existantes.
+        """
+        # Lire la version avant le calcul : une écriture concurrente laissera les bilans périmés
+        version = AnneeScolaire.objects.filter(pk=annee_scolaire.pk).values_list('version_donnees', flat=True).get()
+        debut = mois_scolaires[0]['date_debut']
+        fin = mois_scolaires[-1]['date_fin']
         
-        ventes_mois = Vente.objects.filter(
+        ventes = Vente.objects.filter(
             annee_scolaire=annee_scolaire,
-            created_at__date__range=[debut_mois, fin_mois]
+            created_at__date__range=[debut, fin]
         )
         
-        # Exclure les paiements annulés du bilan
-        paiements_mois = Paiement.objects.filter(
-            vente__annee_scolaire=annee_scolaire,
-            date_paiement__range=[debut_mois, fin_mois],
-            est_annule=False
-        )
-        
-        bilan.nombre_ventes = ventes_mois.count()
-        bilan.montant_ventes = sum(v.montant_total for v in ventes_mois)
-        bilan.montant_paye = sum(p.montant for p in paiements_mois)
+        totaux_ventes = {
+            (ligne['mois'].year, ligne['mois'].month): ligne
+            for ligne in ventes.annotate(mois=TruncMonth('created_at')).order_by()
+            .values('mois').annotate(nombre=Count('id'), montant=Sum('total_lignes'))
+        }
         
+        # Lignes des ventes du mois, regroupées par mois de création de la vente et par cahier
         ventes_par_cahier = {}
-        cahiers = Cahiers.objects.all()
-        
-        for cahier in cahiers:
-            lignes_mois = LigneVente.objects.filter(
-                vente__in=ventes_mois,
-                cahier=cahier
-            )
-            
-            quantite_vendue = sum(ligne.quantite for ligne in lignes_mois)
-            ca_genere = sum(ligne.montant for ligne in lignes_mois)
-            
-            if quantite_vendue > 0:  
-                ventes_par_cahier[str(cahier.id)] = {
-                    'titre': cahier.titre,
-                    'prix_unitaire': float(cahier.prix),            
-                    'quantite_vendue': quantite_vendue,
-                    'ca_genere': float(ca_genere),
-                    'stock_actuel': cahier.quantite_stock      
+        lignes = LigneVente.objects.filter(
+            vente__annee_scolaire=annee_scolaire,
+            vente__created_at__date__range=[debut, fin]
+        ).annotate(mois=TruncMonth('vente__created_at')).order_by()\
+            .values('mois', 'cahier_id', 'cahier__titre', 'cahier__prix', 'cahier__quantite_stock')\
+            .annotate(quantite_vendue=Sum('quantite'), ca_genere=Sum('montant'))
+        for ligne in lignes:
+            if ligne['quantite_vendue'] > 0:
+                ventes_par_cahier.setdefault((ligne['mois'].year, ligne['mois'].month), {})[str(ligne['cahier_id'])] = {
+                    'titre': ligne['cahier__titre'],
+                    'prix_unitaire': float(ligne['cahier__prix']),
+                    'quantite_vendue': ligne['quantite_vendue'],
+                    'ca_genere': float(ligne['ca_genere']),
+                    'stock_actuel': ligne['cahier__quantite_stock']
                 }
         
-        bilan.ventes_par_cahier = ventes_par_cahier
-        bilan.save()
+        # Exclure les paiements annulés du bilan
+        paiements = {
+            (ligne['mois'].year, ligne['mois'].month): ligne['total']
+            for ligne in Paiement.objects.filter(
+                vente__annee_scolaire=annee_scolaire,
+                date_paiement__range=[debut, fin],
+                est_annule=False
+            ).annotate(mois=TruncMonth('date_paiement')).order_by()
+            .values('mois').annotate(total=Sum('montant'))
+        }
         
-        return bilan
-
-    @classmethod
-    def generer_tous_bilans_mensuels(cls, annee_scolaire):
-        mois_scolaires = annee_scolaire.get_mois_scolaires() 
         bilans = []
+        for mois_info in mois_scolaires:
+            cle = (mois_info['annee'], mois_info['numero'])
+            totaux = totaux_ventes.get(cle, {})
+            bilans.append(cls(
+                annee_scolaire=annee_scolaire,
+                mois=mois_info['numero'],
+                annee=mois_info['annee'],
+                nombre_ventes=totaux.get('nombre', 0),
+                montant_ventes=totaux.get('montant') or Decimal('0'),
+                montant_paye=paiements.get(cle) or Decimal('0'),
+                ventes_par_cahier=ventes_par_cahier.get(cle, {}),
+                version_donnees=version,
+            ))
         
+        cls.objects.bulk_create(
+            bilans,
+            update_conflicts=True,
+            unique_fields=['annee_scolaire', 'mois', 'annee'],
+            update_fields=['nombre_ventes', 'montant_ventes', 'montant_paye', 'ventes_par_cahier', 'date_generation', 'version_donnees'],
+        )
+        mois_demandes = Q()
         for mois_info in mois_scolaires:
-            bilan = cls.generer_bilan_mois(
-                annee_scolaire,
-                mois_info['numero'],
-                mois_info['annee']
-            )
-            bilans.append(bilan)
+            mois_demandes |= Q(annee=mois_info['annee'], mois=mois_info['numero'])
+        return cls.objects.filter(mois_demandes, annee_scolaire=annee_scolaire).order_by('annee', 'mois')
+
+    @classmethod
+    def get_bilans_annee(cls, annee_scolaire):
+        """Bilans mensuels enregistrés de l'année, recalculés seulement si ses données ont changé"""
+        mois_scolaires = annee_scolaire.get_mois_scolaires()
+        version = AnneeScolaire.objects.filter(pk=annee_scolaire.pk).values_list('version_donnees', flat=True).get()
+        bilans = {
+            (bilan.annee, bilan.mois): bilan
+            for bilan in cls.objects.filter(annee_scolaire=annee_scolaire)
+        }
+        cles = [(mois_info['annee'], mois_info['numero']) for mois_info in mois_scolaires]
+        if all(cle in bilans and bilans[cle].version_donnees == version for cle in cles):
+            return [bilans[cle] for cle in cles]
+        return list(cls.generer_bilans(annee_scolaire, mois_scolaires))
+
+    @classmethod
+    def generer_bilan_mois(cls, annee_scolaire, mois, annee):
+        debut_mois = date(annee, mois, 1)
+        if mois == 12:
+            fin_mois = date(annee + 1, 1, 1) - timezone.timedelta(days=1)
+        else:
+            fin_mois = date(annee, mois + 1, 1) - timezone.timedelta(days=1)
         
-        return bilans
+        bilans = cls.generer_bilans(annee_scolaire, [{
+            'numero': mois,
+            'annee': annee,
+            'date_debut': debut_mois,
+            'date_fin': fin_mois,
+        }])
+        return bilans.get()
+
+    @classmethod
+    def generer_tous_bilans_mensuels(cls, annee_scolaire):
+        return cls.generer_bilans(annee_scolaire, annee_scolaire.get_mois_scolaires())
 
 class TypeNotification(models.TextChoices):
     STOCK_FAIBLE = 'stock_faible', 'Stock faible'
@@ -477,6 +1146,19 @@ class Notification(models.Model):
     
     class Meta:
         ordering = ['-date_creation']
+        constraints = [
+            # Une seule alerte non lue par cahier (stock) ou par vente (échéance), même en cas de vérifications concurrentes
+            models.UniqueConstraint(
+                fields=['cahier'],
+                condition=Q(type_notification=TypeNotification.STOCK_FAIBLE, est_lu=False),
+                name='notification_stock_faible_non_lue_unique',
+            ),
+            models.UniqueConstraint(
+                fields=['vente'],
+                condition=Q(type_notification=TypeNotification.ECHEANCE_PAIEMENT, est_lu=False),
+                name='notification_echeance_non_lue_unique',
+            ),
+        ]
     
     def __str__(self):
         return f"{self.get_type_notification_display()} - {self.titre}"
@@ -499,4 +1181,14 @@ class EmailNotification(models.Model):
         ordering = ['nom', 'email']
     
     def __str__(self):
-        return f"{self.nom} ({self.email})" if self.nom else self.email
\ No newline at end of file
+        return f"{self.nom} ({self.email})" if self.nom else self.email
+
+class VerrouTache(models.Model):
+    """Bail en base garantissant qu'une tâche périodique ne tourne que dans un seul processus"""
+    nom = models.CharField(max_length=100, unique=True)
+    proprietaire = models.CharField(max_length=255)
+    expire_le = models.DateTimeField()
+    derniere_execution = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.nom} ({self.proprietaire} jusqu'au {self.expire_le})"
@@ -1,40 +1,59 @@
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection
+from django.core.cache import cache
 from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.db.models.functions import TruncDate
 from django.utils import timezone
-from .models import Notification, EmailNotification, Cahiers, TypeNotification, Vente
+from datetime import timedelta
+from decimal import Decimal
+from .models import Notification, EmailNotification, Cahiers, TypeNotification, Vente, Paiement, VerrouTache
+import json
 import logging
+import os
+import socket
+import threading
+import uuid
 
 logger = logging.getLogger(__name__)
 
 class NotificationService:
     """Service pour gérer les notifications"""
     
+    @staticmethod
+    def _creer_notifications(notifications):
+        """Insère les notifications et retourne celles réellement créées.
+
+        Sous SQLite, bulk_create(ignore_conflicts=True) retourne aussi les objets écartés par la
+        contrainte unique : on relit donc les clés générées pour ne compter que les insertions.
+        """
+        if not notifications:
+            return []
+        Notification.objects.bulk_create(notifications, ignore_conflicts=True)
+        return list(Notification.objects.filter(pk__in=[notification.pk for notification in notifications]))
+
     @staticmethod
     def verifier_stock_faible():
         """Vérifie les stocks faibles et crée des notifications"""
         seuil_stock = getattr(settings, 'NOTIFICATION_SEUIL_STOCK', 100)
-        cahiers_stock_faible = Cahiers.objects.filter(quantite_stock__lte=seuil_stock)
-        
-        notifications_creees = []
+        alertes_non_lues = Notification.objects.filter(
+            type_notification=TypeNotification.STOCK_FAIBLE,
+            cahier=OuterRef('pk'),
+            est_lu=False
+        )
+        cahiers_stock_faible = Cahiers.objects.filter(quantite_stock__lte=seuil_stock).exclude(Exists(alertes_non_lues))
         
-        for cahier in cahiers_stock_faible:
-            # Vérifier si une notification existe déjà pour ce cahier
-            notification_existante = Notification.objects.filter(
+        notifications = [
+            Notification(
                 type_notification=TypeNotification.STOCK_FAIBLE,
-                cahier=cahier,
-                est_lu=False
-            ).exists()
-            
-            if not notification_existante:
-                notification = Notification.objects.create(
-                    type_notification=TypeNotification.STOCK_FAIBLE,
-                    titre=f"Stock faible: {cahier.titre}",
-                    message=f"Le cahier '{cahier.titre}' n'a plus que {cahier.quantite_stock} exemplaires en stock.",
-                    cahier=cahier
-                )
-                notifications_creees.append(notification)
-        
-        return notifications_creees
+                titre=f"Stock faible: {cahier.titre}",
+                message=f"Le cahier '{cahier.titre}' n'a plus que {cahier.quantite_stock} exemplaires en stock.",
+                cahier=cahier
+            )
+            for cahier in cahiers_stock_faible
+        ]
+        # La contrainte unique sur les alertes non lues écarte les doublons d'une vérification concurrente
+        return NotificationService._creer_notifications(notifications)
 
     @staticmethod
     def verifier_echeances():
@@ -44,104 +63,125 @@ class NotificationService:
         maintenant = timezone.now()
         limite = maintenant + timezone.timedelta(days=jours)
 
+        alertes_non_lues = Notification.objects.filter(
+            type_notification=TypeNotification.ECHEANCE_PAIEMENT,
+            vente=OuterRef('pk'),
+            est_lu=False
+        )
+        # Ventes non soldées arrivant à échéance et sans alerte non lue
         ventes_echeance = Vente.objects.filter(
             date_paiement__isnull=False,
             date_paiement__gte=maintenant,
-            date_paiement__lte=limite
-        )
-
-        notifications_creees = []
+            date_paiement__lte=limite,
+            total_restant__gt=0
+        ).exclude(Exists(alertes_non_lues)).select_related('ecole')
 
+        notifications = []
         for vente in ventes_echeance:
-            # Si la vente est déjà réglée (montant_restant == 0), on ignore
-            try:
-                montant_restant = vente.montant_restant
-            except Exception:
-                montant_restant = None
-
-            if montant_restant is not None and montant_restant <= 0:
-                continue
-
-            # Vérifier si une notification existe déjà pour cette vente
-            notification_existante = Notification.objects.filter(
+            date_str = vente.date_paiement.strftime('%d/%m/%Y')
+            notifications.append(Notification(
                 type_notification=TypeNotification.ECHEANCE_PAIEMENT,
-                vente=vente,
-                est_lu=False
-            ).exists()
-
-            if not notification_existante:
-                date_str = vente.date_paiement.strftime('%d/%m/%Y') if vente.date_paiement else ''
-                titre = f"Échéance paiement: {vente.ecole.nom} le {date_str}"
-                message = (
+                titre=f"Échéance paiement: {vente.ecole.nom} le {date_str}",
+                message=(
                     f"La vente pour l'école '{vente.ecole.nom}' a une échéance de paiement prévue le {date_str}. "
-                    f"Montant restant: {montant_restant if montant_restant is not None else 'N/A'} F."
-                )
-
-                notification = Notification.objects.create(
-                    type_notification=TypeNotification.ECHEANCE_PAIEMENT,
-                    titre=titre,
-                    message=message,
-                    vente=vente
-                )
-                notifications_creees.append(notification)
-
-        return notifications_creees
+                    f"Montant restant: {vente.total_restant} F."
+                ),
+                vente=vente
+            ))
+
+        return NotificationService._creer_notifications(notifications)
     
     @staticmethod
-    def envoyer_notification_email(notification):
-        """Envoie une notification par email"""
-        if not getattr(settings, 'NOTIFICATION_EMAIL_ACTIF', True):
-            return False
-        
-        if notification.email_envoye:
-            return False
-        
-        # Récupérer tous les emails actifs
-        emails_actifs = EmailNotification.objects.filter(est_actif=True)
-        
-        if not emails_actifs.exists():
+    def _destinataires():
+        """Adresses des destinataires actifs, chargées une seule fois par envoi"""
+        return list(EmailNotification.objects.filter(est_actif=True).values_list('email', flat=True))
+
+    @staticmethod
+    def _message_notification(notification, destinataires, connection):
+        return EmailMessage(
+            f"[Cahier Écriture] {notification.titre}",
+            notification.message,
+            settings.DEFAULT_FROM_EMAIL,
+            destinataires,
+            connection=connection,
+        )
+
+    @staticmethod
+    def _message_digest(notifications, destinataires, connection):
+        """Regroupe les notifications en un seul email récapitulatif"""
+        corps = "\n\n".join(
+            f"- {notification.titre}\n{notification.message}" for notification in notifications
+        )
+        return EmailMessage(
+            f"[Cahier Écriture] {len(notifications)} nouvelle(s) notification(s)",
+            corps,
+            settings.DEFAULT_FROM_EMAIL,
+            destinataires,
+            connection=connection,
+        )
+
+    @staticmethod
+    def envoyer_emails(notifications, digest=None):
+        """Envoie les notifications sur une seule connexion SMTP et marque les envois réussis en une requête.
+
+        En mode digest, toutes les notifications partent dans un seul email récapitulatif.
+        Retourne la liste des identifiants envoyés.
+        """
+        notifications = [notification for notification in notifications if not notification.email_envoye]
+        if not notifications or not getattr(settings, 'NOTIFICATION_EMAIL_ACTIF', True):
+            return []
+
+        destinataires = NotificationService._destinataires()
+        if not destinataires:
             logger.warning("Aucun email configuré pour les notifications")
-            return False
-        
-        destinataires = [email.email for email in emails_actifs]
-        
+            return []
+
+        if digest is None:
+            digest = getattr(settings, 'NOTIFICATION_EMAIL_DIGEST', False)
+
+        envoyees = []
         try:
-            sujet = f"[Cahier Écriture] {notification.titre}"
-            message = notification.message
-            
-            send_mail(
-                sujet,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                destinataires,
-                fail_silently=False,
-            )
-            
-            # Marquer l'email comme envoyé
+            with get_connection(fail_silently=False) as connection:
+                if digest:
+                    connection.send_messages([
+                        NotificationService._message_digest(notifications, destinataires, connection)
+                    ])
+                    envoyees = [notification.id for notification in notifications]
+                else:
+                    for notification in notifications:
+                        try:
+                            connection.send_messages([
+                                NotificationService._message_notification(notification, destinataires, connection)
+                            ])
+                            envoyees.append(notification.id)
+                        except Exception as e:
+                            logger.error(f"Erreur lors de l'envoi de l'email pour la notification {notification.id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Erreur lors de l'envoi des emails de notification: {str(e)}")
+
+        if envoyees:
+            Notification.objects.filter(id__in=envoyees).update(email_envoye=True)
+            logger.info(f"{len(envoyees)} email(s) de notification envoyé(s)")
+        return envoyees
+
+    @staticmethod
+    def envoyer_notification_email(notification):
+        """Envoie une notification par email"""
+        if NotificationService.envoyer_emails([notification], digest=False):
             notification.email_envoye = True
-            notification.save()
-            
-            logger.info(f"Email envoyé pour la notification {notification.id}")
             return True
-            
-        except Exception as e:
-            logger.error(f"Erreur lors de l'envoi de l'email pour la notification {notification.id}: {str(e)}")
-            return False
+        return False
     
     @staticmethod
     def traiter_notifications_en_attente():
         """Traite toutes les notifications en attente d'envoi par email"""
-        notifications_en_attente = Notification.objects.filter(email_envoye=False)
-        
-        resultats = []
-        for notification in notifications_en_attente:
-            succes = NotificationService.envoyer_notification_email(notification)
-            resultats.append({
-                'notification_id': notification.id,
-                'succes': succes
-            })
+        notifications_en_attente = list(Notification.objects.filter(email_envoye=False).order_by('date_creation'))
+        envoyees = set(NotificationService.envoyer_emails(notifications_en_attente))
         
-        return resultats
+        return [
+            {'notification_id': notification.id, 'succes': notification.id in envoyees}
+            for notification in notifications_en_attente
+        ]
     
     def verifier_notifications(self):
         """Vérifie et crée les notifications nécessaires (wrapper pour compatibilité)"""
@@ -194,3 +234,210 @@ class NotificationService:
             'emails_traites': len(resultats_emails),
             'emails_reussis': sum(1 for r in resultats_emails if r['succes'])
         }
+
+
+
+class PlanificateurNotifications:
+    """Exécute périodiquement les vérifications de notifications hors des requêtes HTTP.
+
+    Un bail en base (VerrouTache) garantit qu'un seul processus effectue les vérifications :
+    le détenteur le renouvelle à chaque passage, un autre processus ne le reprend qu'après expiration.
+    """
+
+    NOM_VERROU = 'verification_notifications'
+
+    def __init__(self, intervalle=None, duree_bail=None):
+        self.intervalle = intervalle or getattr(settings, 'NOTIFICATION_INTERVALLE_SECONDES', 900)
+        self.duree_bail = duree_bail or 2 * self.intervalle
+        self.identifiant = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.arret = threading.Event()
+
+    def acquerir_bail(self):
+        """Prend ou renouvelle le bail ; retourne False s'il est détenu par un autre processus"""
+        maintenant = timezone.now()
+        expire_le = maintenant + timedelta(seconds=self.duree_bail)
+        pris = VerrouTache.objects.filter(nom=self.NOM_VERROU).filter(
+            Q(expire_le__lt=maintenant) | Q(proprietaire=self.identifiant)
+        ).update(proprietaire=self.identifiant, expire_le=expire_le)
+        if pris:
+            return True
+        try:
+            with transaction.atomic():
+                VerrouTache.objects.create(nom=self.NOM_VERROU, proprietaire=self.identifiant, expire_le=expire_le)
+            return True
+        except IntegrityError:
+            return False
+
+    def liberer_bail(self):
+        VerrouTache.objects.filter(nom=self.NOM_VERROU, proprietaire=self.identifiant).update(expire_le=timezone.now())
+
+    def executer_une_fois(self):
+        """Lance une vérification si le bail est obtenu ; retourne None sinon"""
+        if not self.acquerir_bail():
+            return None
+        resultats = NotificationService.executer_verification_periodique()
+        VerrouTache.objects.filter(nom=self.NOM_VERROU, proprietaire=self.identifiant).update(derniere_execution=timezone.now())
+        return resultats
+
+    def boucle(self, rapport=None):
+        """Vérifie à intervalle régulier jusqu'à l'appel de arreter()"""
+        try:
+            while not self.arret.is_set():
+                # Processus de longue durée : ne pas garder une connexion périmée entre deux passages
+                close_old_connections()
+                try:
+                    resultats = self.executer_une_fois()
+                    if rapport:
+                        rapport(resultats)
+                except Exception as e:
+                    logger.error(f"Erreur lors de la vérification périodique des notifications: {str(e)}")
+                self.arret.wait(self.intervalle)
+        finally:
+            self.liberer_bail()
+
+    def arreter(self):
+        self.arret.set()
+
+
+def _evolution(actuel, reference):
+    """Pourcentage d'évolution, 100 si la référence est nulle et la valeur actuelle positive"""
+    if reference > 0:
+        return round(((actuel - reference) / reference) * 100, 1)
+    return 100 if actuel > 0 else 0
+
+
+class DashboardSnapshot:
+    """Instantané des indicateurs du tableau de bord, mis en cache par année et version des données.
+
+    La clé de cache contient AnneeScolaire.version_donnees : toute écriture de vente,
+    ligne, paiement ou cahier incrémente cette version et invalide donc l'instantané.
+    """
+
+    PREFIXE_CACHE = 'dashboard'
+
+    @classmethod
+    def cle_cache(cls, annee_scolaire, jour):
+        return f"{cls.PREFIXE_CACHE}:{annee_scolaire.pk}:{annee_scolaire.version_donnees}:{jour.isoformat()}"
+
+    @classmethod
+    def obtenir(cls, annee_scolaire):
+        """Retourne l'instantané de l'année, calculé seulement en l'absence de cache valide"""
+        today = timezone.now().date()
+        cle = cls.cle_cache(annee_scolaire, today)
+        snapshot = cache.get(cle)
+        if snapshot is None:
+            snapshot = cls.calculer(annee_scolaire, today)
+            cache.set(cle, snapshot, getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 300))
+        return snapshot
+
+    @staticmethod
+    def calculer(annee_scolaire, today):
+        yesterday = today - timedelta(days=1)
+        last_week = today - timedelta(days=7)
+        last_month = today - timedelta(days=30)
+        jours_graphique = [today - timedelta(days=6 - i) for i in range(7)]
+
+        ventes_annee = Vente.objects.filter(annee_scolaire=annee_scolaire)
+        # Exclure les paiements annulés
+        paiements_annee = Paiement.objects.filter(vente__annee_scolaire=annee_scolaire, est_annule=False)
+
+        # Ventes des 30 derniers jours, groupées par jour et par école
+        ventes_par_jour_ecole = ventes_annee.filter(created_at__date__gte=last_month).order_by()\
+            .annotate(jour=TruncDate('created_at')).values('jour', 'ecole').annotate(nombre=Count('id'))
+        nb_ventes_jour = {}
+        ecoles_jour = {}
+        for ligne in ventes_par_jour_ecole:
+            nb_ventes_jour[ligne['jour']] = nb_ventes_jour.get(ligne['jour'], 0) + ligne['nombre']
+            ecoles_jour.setdefault(ligne['jour'], set()).add(ligne['ecole'])
+
+        # Paiements de l'année, groupés par jour (date_paiement est déjà une date)
+        revenus_jour = {
+            ligne['date_paiement']: ligne['total']
+            for ligne in paiements_annee.order_by().values('date_paiement').annotate(total=Sum('montant'))
+        }
+
+        def revenus_entre(debut, fin):
+            return sum((total for jour, total in revenus_jour.items() if debut <= jour <= fin), Decimal('0'))
+
+        revenus_aujourd_hui = revenus_jour.get(today, 0)
+        revenus_semaine_derniere = revenus_entre(last_week, yesterday)
+        ca_total = sum(revenus_jour.values(), Decimal('0'))
+        ca_hier = revenus_jour.get(yesterday, 0)
+
+        ecoles_actives_aujourd_hui = len(ecoles_jour.get(today, ()))
+        ecoles_actives_mois_dernier = len(set().union(
+            *(ecoles for jour, ecoles in ecoles_jour.items() if last_month <= jour <= yesterday)
+        ))
+
+        ventes_aujourd_hui = nb_ventes_jour.get(today, 0)
+        ventes_hier = nb_ventes_jour.get(yesterday, 0)
+
+        ventes_par_jour = [
+            {'date': jour.strftime('%d/%m'), 'count': nb_ventes_jour.get(jour, 0)}
+            for jour in jours_graphique
+        ]
+        revenus_par_jour = [
+            {'date': jour.strftime('%d/%m'), 'revenus': float(revenus_jour.get(jour, 0))}
+            for jour in jours_graphique
+        ]
+
+        # Top 5 des écoles par montant payé (soldes persistés, paiements annulés exclus)
+        top_ecoles = list(
+            ventes_annee.values('ecole__nom').annotate(
+                total_ca=Sum('total_paye'),
+                nb_ventes=Count('id', distinct=True)
+            ).order_by('-total_ca')[:5]
+        )
+
+        # Ventes dont l'échéance est dépassée avec un reste dû
+        ventes_en_retard = ventes_annee.filter(date_paiement__date__lt=today, total_restant__gt=0).count()
+
+        # Activités récentes : derniers paiements et dernières ventes
+        activites_recentes = []
+        for paiement in paiements_annee.select_related('vente__ecole').order_by('-date_paiement')[:3]:
+            activites_recentes.append({
+                'type': 'paiement',
+                'description': f"{paiement.montant}F, Paiement reçu de {paiement.vente.ecole.nom}",
+                'date': paiement.date_paiement,
+                'icon': 'payments'
+            })
+        for vente in ventes_annee.select_related('ecole').order_by('-created_at')[:3]:
+            activites_recentes.append({
+                'type': 'vente',
+                'description': f"Nouvelle vente #{str(vente.id)[:8]}... à {vente.ecole.nom}",
+                'date': vente.created_at.date(),
+                'icon': 'shopping_cart'
+            })
+        activites_recentes.sort(key=lambda x: x['date'], reverse=True)
+
+        stocks = Cahiers.objects.aggregate(
+            total=Count('id'),
+            faible=Count('id', filter=Q(quantite_stock__lt=10))
+        )
+
+        return {
+            # Métriques principales
+            'revenus_aujourd_hui': revenus_aujourd_hui,
+            'pourcentage_revenus': _evolution(revenus_aujourd_hui, revenus_semaine_derniere),
+            'ecoles_actives': ecoles_actives_aujourd_hui,
+            'pourcentage_ecoles': _evolution(ecoles_actives_aujourd_hui, ecoles_actives_mois_dernier),
+            'ventes_aujourd_hui': ventes_aujourd_hui,
+            'pourcentage_ventes': _evolution(ventes_aujourd_hui, ventes_hier),
+            'ca_total': ca_total,
+            'pourcentage_ca': _evolution(revenus_aujourd_hui, ca_hier),
+
+            # Données pour graphiques (JSON)
+            'ventes_par_jour_json': json.dumps(ventes_par_jour),
+            'revenus_par_jour_json': json.dumps(revenus_par_jour),
+
+            # Tableaux et listes
+            'top_ecoles': top_ecoles,
+            'activites_recentes': activites_recentes[:3],
+            'ventes_en_retard': ventes_en_retard,
+            'stock_faible': stocks['faible'],
+            'total_cahiers': stocks['total'],
+
+            # Données brutes pour graphiques
+            'ventes_par_jour': ventes_par_jour,
+            'revenus_par_jour': revenus_par_jour,
+        }
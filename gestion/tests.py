@@ -1,3 +1,226 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import date
+from decimal import Decimal
+from django.db import connection
+from django.db.models import Sum
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from gestion.models import (
+    AnneeScolaire, BilanMensuel, Cahiers, DetteEcoleAnnee, Ecoles, LigneVente, MouvementStock, Notification,
+    ReservationStock, TypeMouvementStock, TypeNotification, Vente,
+)
+from gestion.services import NotificationService
+from gestion.Views.sales import creer_vente, reserver_stock
 
-# Create your tests here.
+
+def creer_annee_active():
+    return AnneeScolaire.objects.create(
+        annee_debut=2024, annee_fin=2025,
+        date_debut=date(2024, 9, 1), date_fin=date(2025, 8, 31),
+        est_active=True,
+    )
+
+
+def creer_cahier(titre, prix, stock):
+    cahier = Cahiers.objects.create(titre=titre, prix=Decimal(prix), quantite_stock=0)
+    MouvementStock.appliquer({cahier.pk: stock}, TypeMouvementStock.STOCK_INITIAL)
+    return cahier
+
+
+class SuppressionCahierTests(TestCase):
+    def setUp(self):
+        self.annee = creer_annee_active()
+        self.conserve = creer_cahier('Cahier conservé', '600', 10)
+        self.retire = creer_cahier('Cahier supprimé', '400', 10)
+        self.ecole = Ecoles.objects.create(nom='École', adresse='-')
+        self.vente = Vente.objects.create(ecole=self.ecole, annee_scolaire=self.annee)
+        self.vente.ajouter_articles([{'cahier': self.conserve, 'quantite': 1}, {'cahier': self.retire, 'quantite': 1}])
+        self.vente.gerer_paiement(Decimal('200'))
+
+    def test_recalcule_soldes_et_registre(self):
+        """Les lignes supprimées en cascade sont retirées des soldes de la vente et du registre des dettes"""
+        reponse = self.client.post(reverse('supprimer_cahier', args=[self.retire.pk]))
+        self.assertRedirects(reponse, reverse('cahiers'), fetch_redirect_response=False)
+        self.assertFalse(Cahiers.objects.filter(pk=self.retire.pk).exists())
+
+        vente = Vente.objects.get(pk=self.vente.pk)
+        self.assertEqual(
+            (vente.total_lignes, vente.total_paye, vente.total_restant, vente.nb_lignes),
+            (Decimal('600'), Decimal('200'), Decimal('400'), 1),
+        )
+
+        dette = DetteEcoleAnnee.objects.get(ecole=self.ecole, annee_scolaire=self.annee)
+        self.assertEqual(
+            (dette.montant_articles, dette.montant_paye, dette.montant_restant, dette.nb_ventes),
+            tuple(DetteEcoleAnnee.calculer()[(self.ecole.pk, self.annee.pk)]),
+        )
+        self.assertEqual(dette.montant_restant, Decimal('400'))
+
+
+class BilansMensuelsTests(TestCase):
+    def setUp(self):
+        self.annee = creer_annee_active()
+        self.mois_scolaires = self.annee.get_mois_scolaires()
+
+    def test_generer_bilans_relit_les_lignes_existantes(self):
+        """Un nouveau calcul retourne les bilans déjà enregistrés, avec leur clé primaire en base"""
+        premiers = list(BilanMensuel.generer_bilans(self.annee, self.mois_scolaires))
+        seconds = list(BilanMensuel.generer_bilans(self.annee, self.mois_scolaires))
+        self.assertEqual(len(seconds), len(self.mois_scolaires))
+        self.assertEqual([bilan.pk for bilan in seconds], [bilan.pk for bilan in premiers])
+        self.assertEqual(BilanMensuel.objects.filter(annee_scolaire=self.annee).count(), len(self.mois_scolaires))
+
+    def test_detail_utilise_les_bilans_enregistres(self):
+        """Le détail d'un mois ne recalcule pas les bilans tant que les données de l'année n'ont pas changé"""
+        mois = self.mois_scolaires[0]
+        url = reverse('detail_bilan_mensuel', args=[self.annee.pk, mois['numero'], mois['annee']])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        date_generation = BilanMensuel.objects.get(annee_scolaire=self.annee, mois=mois['numero'], annee=mois['annee']).date_generation
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(
+            BilanMensuel.objects.get(annee_scolaire=self.annee, mois=mois['numero'], annee=mois['annee']).date_generation,
+            date_generation,
+        )
+
+    def test_detail_mois_hors_annee(self):
+        url = reverse('detail_bilan_mensuel', args=[self.annee.pk, 1, 1990])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class NotificationsTests(TestCase):
+    def setUp(self):
+        self.cahier = creer_cahier('Cahier en rupture', '500', 5)
+        Notification.objects.all().delete()
+
+    def alerte_stock(self):
+        return Notification(
+            type_notification=TypeNotification.STOCK_FAIBLE,
+            titre=f"Stock faible: {self.cahier.titre}",
+            message='-',
+            cahier=self.cahier,
+        )
+
+    def test_verifier_stock_faible_ne_compte_que_les_creations(self):
+        self.assertEqual(len(NotificationService.verifier_stock_faible()), 1)
+        self.assertEqual(len(NotificationService.verifier_stock_faible()), 0)
+
+    def test_doublons_concurrents_non_comptes(self):
+        """Une alerte insérée entre-temps par une autre vérification n'est pas comptée comme créée"""
+        self.alerte_stock().save()
+        self.assertEqual(NotificationService._creer_notifications([self.alerte_stock()]), [])
+        self.assertEqual(Notification.objects.filter(cahier=self.cahier).count(), 1)
+
+
+class RapportAnnuelTests(TestCase):
+    def setUp(self):
+        self.annee = creer_annee_active()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        self.url = reverse('generer_rapport_annuel_pdf', args=[self.annee.pk])
+
+    def telecharger(self):
+        reponse = self.client.get(self.url)
+        self.assertEqual(reponse.status_code, 200)
+        contenu = b''.join(reponse.streaming_content)
+        self.assertTrue(contenu.startswith(b'%PDF'))
+        return contenu
+
+    def rapports(self):
+        return sorted(os.listdir(os.path.join(self.media, 'rapports')))
+
+    def test_nouvelle_version_remplace_le_rapport(self):
+        with override_settings(MEDIA_ROOT=self.media):
+            self.telecharger()
+            premiers = self.rapports()
+            AnneeScolaire.marquer_modifiee(self.annee.pk)
+            self.telecharger()
+            seconds = self.rapports()
+        self.assertEqual(len(premiers), 1)
+        self.assertEqual(len(seconds), 1)
+        self.assertNotEqual(premiers, seconds)
+
+    def test_rapport_supprime_entre_temps_est_reconstruit(self):
+        """Un rapport effacé par le rendu d'une autre version est reconstruit au lieu d'une erreur 500"""
+        with override_settings(MEDIA_ROOT=self.media):
+            self.telecharger()
+            for nom in self.rapports():
+                os.remove(os.path.join(self.media, 'rapports', nom))
+            self.telecharger()
+            self.assertEqual(len(self.rapports()), 1)
+
+
+class VentesConcurrentesTests(TransactionTestCase):
+    """Requêtes creer_vente simultanées, une connexion par thread comme sous un serveur multi-thread"""
+
+    NB_VENTES = 24
+    NB_THREADS = 6
+    QUANTITE = 3
+
+    def setUp(self):
+        creer_annee_active()
+        self.ecoles = [Ecoles.objects.create(nom=f'École {i + 1}', adresse='-') for i in range(self.NB_THREADS)]
+        self.factory = RequestFactory()
+
+    def vendre(self, cahier, ecole, numero, reponses):
+        try:
+            articles = json.dumps([{'cahier_id': str(cahier.pk), 'quantite': self.QUANTITE}])
+            donnees = {'ecole_id': str(ecole.pk), 'articles': articles}
+            # Une saisie sur deux passe par une réservation, comme la fenêtre de vente
+            if numero % 2 == 0:
+                reponse = reserver_stock(self.factory.post('/ventes/reservation/', {'articles': articles}))
+                donnees['reservation'] = json.loads(reponse.content)['reservation']
+            reponses.append(json.loads(creer_vente(self.factory.post('/ventes/creer/', donnees)).content))
+        except Exception as e:
+            reponses.append({'success': False, 'error': repr(e)})
+        finally:
+            connection.close()
+
+    def lancer_ventes(self, cahier):
+        reponses = []
+        for lot in range(0, self.NB_VENTES, self.NB_THREADS):
+            threads = [
+                threading.Thread(target=self.vendre, args=(cahier, self.ecoles[i], lot + i, reponses))
+                for i in range(min(self.NB_THREADS, self.NB_VENTES - lot))
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return reponses
+
+    def verifier_stock(self, cahier, stock_initial):
+        stock_final = Cahiers.objects.get(pk=cahier.pk).quantite_stock
+        vendu = LigneVente.objects.filter(cahier=cahier).aggregate(total=Sum('quantite'))['total'] or 0
+        journal = MouvementStock.objects.filter(cahier=cahier).aggregate(total=Sum('quantite'))['total'] or 0
+        self.assertEqual(stock_final, stock_initial - vendu)
+        self.assertEqual(stock_final, journal)
+        self.assertGreaterEqual(stock_final, 0)
+        self.assertFalse(ReservationStock.objects.filter(cahier=cahier).exists())
+        return vendu
+
+    def test_stock_exact_apres_ventes_concurrentes(self):
+        stock_initial = self.NB_VENTES * self.QUANTITE + 10
+        cahier = creer_cahier('Cahier', '100', stock_initial)
+
+        reponses = self.lancer_ventes(cahier)
+
+        self.assertEqual([reponse for reponse in reponses if not reponse['success']], [])
+        self.assertEqual(self.verifier_stock(cahier, stock_initial), self.NB_VENTES * self.QUANTITE)
+
+    def test_stock_insuffisant_sans_survente(self):
+        """Quand la demande dépasse le stock, les ventes refusées le sont pour stock insuffisant et rien n'est survendu"""
+        stock_initial = self.NB_VENTES * self.QUANTITE // 2
+        cahier = creer_cahier('Cahier', '100', stock_initial)
+
+        reponses = self.lancer_ventes(cahier)
+
+        refusees = [reponse['error'] for reponse in reponses if not reponse['success']]
+        self.assertTrue(refusees)
+        self.assertTrue(all(erreur.startswith('Stock insuffisant') for erreur in refusees), refusees)
+        vendu = self.verifier_stock(cahier, stock_initial)
+        self.assertEqual(vendu, (self.NB_VENTES - len(refusees)) * self.QUANTITE)
+        self.assertFalse(Vente.objects.filter(nb_lignes=0).exists())
@@ -7,6 +7,7 @@ from gestion.Views.sales import *
 from gestion.Views.sales import creer_vente
 from gestion.Views.notifications import *
 from gestion.views_pdf import generer_facture_pdf, generer_pdf_ventes_ecole
+from gestion.api import VenteListe
 
 urlpatterns = [
     path('', home, name='home'),
@@ -46,8 +47,13 @@ urlpatterns = [
     
     path('ventes/', liste_ventes, name='ventes'),
     path('ventes/creer/', creer_vente, name='creer_vente'),
+    path('ventes/importer-paiements/', importer_paiements, name='importer_paiements'),
+    path('ventes/importer-commandes/', importer_commandes, name='importer_commandes'),
+    path('ventes/reservation/', reserver_stock, name='reserver_stock'),
+    path('ventes/reservation/liberer/', liberer_reservation, name='liberer_reservation'),
     path('ventes-ecole/', ventes_par_ecole, name='ventes_par_ecole'),
     path('ventes-ajax/<uuid:ecole_id>/', ventes_ajax, name='ventes_ajax'),
+    path('api/ventes/', VenteListe.as_view(), name='api_ventes'),
     path('ventes/<uuid:vente_id>/', vente_detail, name='vente_detail'),
     path('ventes/<uuid:vente_id>/modifier/', modifier_vente, name='modifier_vente'),
     path('ventes/<uuid:vente_id>/paiement/', gerer_paiement, name='gerer_paiement'),
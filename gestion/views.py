@@ -1,11 +1,11 @@
 from django.shortcuts import *
 from gestion.models import AnneeScolaire, BilanMensuel, BilanAnneeScolaire, Cahiers, Vente, LigneVente, Paiement
-from .services import NotificationService
+from .conditions import annee_courante, annee_de_l_url, donnees_conditionnelles, toutes_les_annees
+from .services import DashboardSnapshot
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer
 from reportlab.lib import colors
 from reportlab.lib.units import cm
-from io import BytesIO
 from django.db.models import Sum, Count
 import json
 from django.utils import timezone
@@ -16,21 +16,14 @@ import calendar
 from collections import defaultdict
 from datetime import date
 from django.db import models
+from django.conf import settings
+from django.http import FileResponse, Http404
+import os
+import tempfile
 
+@donnees_conditionnelles(annee_courante)
 def home(request):
-    # Vérification automatique des notifications à chaque chargement de la page d'accueil
-    notification_service = NotificationService()
-    try:
-        notification_service.verifier_notifications()
-        notification_service.envoyer_notifications_en_attente()
-    except Exception as e:
-        # Log l'erreur mais ne pas interrompre le chargement de la page
-        print(f"Erreur lors de la vérification automatique des notifications: {e}")
-    
     today = timezone.now().date()
-    yesterday = today - timedelta(days=1)
-    last_week = today - timedelta(days=7)
-    last_month = today - timedelta(days=30)
     
     # Année scolaire courante
     annee_courante = AnneeScolaire.get_annee_courante()
@@ -40,166 +33,20 @@ def home(request):
         annee_courante = AnneeScolaire.creer_annee_scolaire(annee_courante_num)
         annee_courante.activer()
     
-    # Filtrer les données par année scolaire courante (exclure les paiements annulés)
-    ventes_annee = Vente.objects.filter(annee_scolaire=annee_courante)
-    paiements_annee = Paiement.objects.filter(vente__annee_scolaire=annee_courante, est_annule=False)
-    
-    # Revenus d'aujourd'hui (année courante)
-    revenus_aujourd_hui = paiements_annee.filter(
-        date_paiement=today
-    ).aggregate(total=Sum('montant'))['total'] or 0
-    
-    # Revenus de la semaine dernière pour comparaison
-    revenus_semaine_derniere = paiements_annee.filter(
-        date_paiement__range=[last_week, yesterday]
-    ).aggregate(total=Sum('montant'))['total'] or 0
-    
-    # Calcul du pourcentage d'augmentation
-    if revenus_semaine_derniere > 0:
-        pourcentage_revenus = ((revenus_aujourd_hui - revenus_semaine_derniere) / revenus_semaine_derniere) * 100
-    else:
-        pourcentage_revenus = 100 if revenus_aujourd_hui > 0 else 0
-    
-    # Nombre d'écoles actives aujourd'hui (année courante)
-    ecoles_actives_aujourd_hui = ventes_annee.filter(
-        created_at__date=today
-    ).values('ecole').distinct().count()
-    
-    # Écoles actives le mois dernier
-    ecoles_actives_mois_dernier = ventes_annee.filter(
-        created_at__date__range=[last_month, yesterday]
-    ).values('ecole').distinct().count()
-    
-    # Pourcentage d'écoles actives
-    if ecoles_actives_mois_dernier > 0:
-        pourcentage_ecoles = ((ecoles_actives_aujourd_hui - ecoles_actives_mois_dernier) / ecoles_actives_mois_dernier) * 100
-    else:
-        pourcentage_ecoles = 100 if ecoles_actives_aujourd_hui > 0 else 0
-    
-    # Nombre de ventes aujourd'hui (année courante)
-    ventes_aujourd_hui = ventes_annee.filter(created_at__date=today).count()
-    ventes_hier = ventes_annee.filter(created_at__date=yesterday).count()
-    
-    if ventes_hier > 0:
-        pourcentage_ventes = ((ventes_aujourd_hui - ventes_hier) / ventes_hier) * 100
-    else:
-        pourcentage_ventes = 100 if ventes_aujourd_hui > 0 else 0
-    
-    # Chiffre d'affaires total (année courante)
-    ca_total = paiements_annee.aggregate(total=Sum('montant'))['total'] or 0
-    ca_hier = paiements_annee.filter(date_paiement=yesterday).aggregate(total=Sum('montant'))['total'] or 0
-    
-    if ca_hier > 0:
-        pourcentage_ca = ((revenus_aujourd_hui - ca_hier) / ca_hier) * 100
-    else:
-        pourcentage_ca = 100 if revenus_aujourd_hui > 0 else 0
-    
-    # Données pour les graphiques (7 derniers jours, année courante)
-    ventes_par_jour = []
-    for i in range(7):
-        date = today - timedelta(days=6-i)
-        count = ventes_annee.filter(created_at__date=date).count()
-        ventes_par_jour.append({
-            'date': date.strftime('%d/%m'),
-            'count': count
-        })
-    
-    # Revenus par jour (7 derniers jours, année courante)
-    revenus_par_jour = []
-    for i in range(7):
-        date = today - timedelta(days=6-i)
-        revenus = paiements_annee.filter(date_paiement=date).aggregate(total=Sum('montant'))['total'] or 0
-        revenus_par_jour.append({
-            'date': date.strftime('%d/%m'),
-            'revenus': float(revenus)
-        })
-    
-    # Top 5 des écoles par chiffre d'affaires (année courante, exclure les paiements annulés)
-    top_ecoles = ventes_annee.values(
-        'ecole__nom'
-    ).annotate(
-        total_ca=Sum('paiements__montant', filter=models.Q(paiements__est_annule=False)),
-        nb_ventes=Count('id', distinct=True)
-    ).order_by('-total_ca')[:5]
-    
-    # Ventes en retard (année courante)
-    ventes_en_retard = ventes_annee.filter(
-        date_paiement__lt=today
-    ).exclude(
-        id__in=ventes_annee.filter(paiements__isnull=False).filter(
-            paiements__montant__gte=models.F('lignes__montant')
-        ).values('id')
-    ).count()
-    
-    # Activités récentes (année courante)
-    activites_recentes = []
-    
-    # Derniers paiements
-    derniers_paiements = paiements_annee.select_related('vente__ecole').order_by('-date_paiement')[:3]
-    for paiement in derniers_paiements:
-        activites_recentes.append({
-            'type': 'paiement',
-            'description': f"{paiement.montant}F, Paiement reçu de {paiement.vente.ecole.nom}",
-            'date': paiement.date_paiement,
-            'icon': 'payments'
-        })
-    
-    # Dernières ventes
-    dernieres_ventes = ventes_annee.select_related('ecole').order_by('-created_at')[:3]
-    for vente in dernieres_ventes:
-        activites_recentes.append({
-            'type': 'vente',
-            'description': f"Nouvelle vente #{str(vente.id)[:8]}... à {vente.ecole.nom}",
-            'date': vente.created_at.date(),
-            'icon': 'shopping_cart'
-        })
-    
-    # Trier les activités par date
-    activites_recentes.sort(key=lambda x: x['date'], reverse=True)
-    activites_recentes = activites_recentes[:3]  
-    
-    # Données sur les stocks
-    stock_faible = Cahiers.objects.filter(quantite_stock__lt=10).count()
-    total_cahiers = Cahiers.objects.count()
-    
+    # Indicateurs servis depuis le cache, recalculés après toute écriture touchant l'année
     context = {
-        # Année scolaire
         'annee_courante': annee_courante,
-        
-        # Métriques principales
-        'revenus_aujourd_hui': revenus_aujourd_hui,
-        'pourcentage_revenus': round(pourcentage_revenus, 1),
-        'ecoles_actives': ecoles_actives_aujourd_hui,
-        'pourcentage_ecoles': round(pourcentage_ecoles, 1),
-        'ventes_aujourd_hui': ventes_aujourd_hui,
-        'pourcentage_ventes': round(pourcentage_ventes, 1),
-        'ca_total': ca_total,
-        'pourcentage_ca': round(pourcentage_ca, 1),
-        
-        # Données pour graphiques (JSON)
-        'ventes_par_jour_json': json.dumps(ventes_par_jour),
-        'revenus_par_jour_json': json.dumps(revenus_par_jour),
-        
-        # Tableaux et listes
-        'top_ecoles': top_ecoles,
-        'activites_recentes': activites_recentes,
-        'ventes_en_retard': ventes_en_retard,
-        'stock_faible': stock_faible,
-        'total_cahiers': total_cahiers,
-        
-        # Données brutes pour graphiques
-        'ventes_par_jour': ventes_par_jour,
-        'revenus_par_jour': revenus_par_jour,
+        **DashboardSnapshot.obtenir(annee_courante),
     }
     return render(request, 'index.html', context)
 
+@donnees_conditionnelles(toutes_les_annees)
 def bilans_annuels(request):
-    annees = AnneeScolaire.objects.all()
+    annees = list(AnneeScolaire.objects.all())
     bilans = []
     
-    for annee in annees:
-        # Générer ou récupérer le bilan
-        bilan = BilanAnneeScolaire.generer_bilan(annee)
+    # Récupérer les bilans (recalculés seulement si les données de l'année ont changé)
+    for annee, bilan in zip(annees, BilanAnneeScolaire.get_bilans(annees)):
         bilans.append({
             'annee': annee,
             'bilan': bilan,
@@ -212,9 +59,10 @@ def bilans_annuels(request):
     return render(request, 'bilans_annuels.html', context)
 
 
+@donnees_conditionnelles(annee_de_l_url)
 def detail_bilan_annuel(request, annee_id):
     annee = get_object_or_404(AnneeScolaire, id=annee_id)
-    bilan = BilanAnneeScolaire.generer_bilan(annee)
+    bilan = BilanAnneeScolaire.get_bilan(annee)
     
     # Préparer les données pour les graphiques
     cahiers_data = []
@@ -235,9 +83,9 @@ def detail_bilan_annuel(request, annee_id):
     top_ecoles = Vente.objects.filter(annee_scolaire=annee).values(
         'ecole__nom'
     ).annotate(
-        total_ca=Sum('lignes__montant'),
+        total_ca=Sum('total_lignes'),
         nb_ventes=Count('id', distinct=True),
-        total_paye=Sum('paiements__montant', filter=models.Q(paiements__est_annule=False))
+        total_paye=Sum('total_paye')
     ).order_by('-total_ca')[:5]
     
     context = {
@@ -255,11 +103,12 @@ def detail_bilan_annuel(request, annee_id):
     return render(request, 'detail_bilan_annuel.html', context)
 
 
+@donnees_conditionnelles(annee_de_l_url)
 def bilans_mensuels(request, annee_id):
     annee = get_object_or_404(AnneeScolaire, id=annee_id)
 
-    # Générer tous les bilans mensuels
-    bilans_mensuels = BilanMensuel.generer_tous_bilans_mensuels(annee)
+    # Bilans mensuels enregistrés, recalculés seulement si les données de l'année ont changé
+    bilans_mensuels = BilanMensuel.get_bilans_annee(annee)
 
     for bilan in bilans_mensuels:
         bilan.montant_impaye = float(bilan.montant_ventes) - float(bilan.montant_paye)
@@ -347,9 +196,16 @@ def bilans_mensuels(request, annee_id):
     return render(request, 'bilans_mensuels.html', context)
 
 
+@donnees_conditionnelles(annee_de_l_url)
 def detail_bilan_mensuel(request, annee_id, mois, annee):
     annee_scolaire = get_object_or_404(AnneeScolaire, id=annee_id)
-    bilan = BilanMensuel.generer_bilan_mois(annee_scolaire, mois, annee)
+    # Même chemin que la liste des bilans : recalcul groupé seulement si les données de l'année ont changé
+    bilan = next(
+        (bilan for bilan in BilanMensuel.get_bilans_annee(annee_scolaire) if (bilan.annee, bilan.mois) == (annee, mois)),
+        None,
+    )
+    if bilan is None:
+        raise Http404("Mois hors de l'année scolaire")
 
     # Calcul du taux de recouvrement
     if bilan.montant_ventes > 0:
@@ -393,13 +249,61 @@ def detail_bilan_mensuel(request, annee_id, mois, annee):
     return render(request, 'detail_bilan_mensuel.html', context)
 
 
+def _chemin_rapport_annuel(annee, version):
+    return os.path.join(settings.MEDIA_ROOT, 'rapports', f'rapport_annuel_{annee.pk}_v{version}.pdf')
+
+
+def _rendre_rapport_annuel(annee, bilan, chemin):
+    """Rend le rapport dans un fichier temporaire propre à la requête, le publie sous `chemin`
+    et retourne ce fichier ouvert, lisible même si une version plus récente le supprime ensuite"""
+    dossier = os.path.dirname(chemin)
+    os.makedirs(dossier, exist_ok=True)
+    fichier = tempfile.NamedTemporaryFile(dir=dossier, suffix='.tmp', delete=False)
+    try:
+        _construire_rapport_annuel(annee, bilan, fichier)
+        fichier.flush()
+        os.replace(fichier.name, chemin)
+    except BaseException:
+        fichier.close()
+        os.remove(fichier.name)
+        raise
+    fichier.seek(0)
+
+    # Supprimer les rapports des versions précédentes ; une autre requête peut déjà l'avoir fait
+    prefixe = f'rapport_annuel_{annee.pk}_v'
+    for nom in os.listdir(dossier):
+        if nom.startswith(prefixe) and nom.endswith('.pdf') and os.path.join(dossier, nom) != chemin:
+            try:
+                os.remove(os.path.join(dossier, nom))
+            except FileNotFoundError:
+                pass
+    return fichier
+
+
+@donnees_conditionnelles(annee_de_l_url)
 def generer_rapport_annuel_pdf(request, annee_id):
     annee = get_object_or_404(AnneeScolaire, id=annee_id)
-    bilan = BilanAnneeScolaire.generer_bilan(annee)
+    bilan = BilanAnneeScolaire.get_bilan(annee)
     
-    # Créer le PDF
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4,
+    # Rapport rendu une fois par version des bilans, puis servi depuis le disque
+    chemin = _chemin_rapport_annuel(annee, bilan.version_donnees)
+    try:
+        fichier = open(chemin, 'rb')
+    except FileNotFoundError:
+        # Absent, ou supprimé entre-temps par le rendu d'une version plus récente
+        fichier = _rendre_rapport_annuel(annee, bilan, chemin)
+    
+    return FileResponse(
+        fichier,
+        as_attachment=True,
+        filename=f'rapport_annuel_{annee.annee_debut}_{annee.annee_fin}.pdf',
+        content_type='application/pdf',
+    )
+
+
+def _construire_rapport_annuel(annee, bilan, destination):
+    """Écrit le rapport annuel PDF à partir des bilans enregistrés (aucun recalcul si ceux-ci sont à jour)"""
+    doc = SimpleDocTemplate(destination, pagesize=A4,
                             leftMargin=2*cm, rightMargin=2*cm,
                             topMargin=2*cm, bottomMargin=2*cm)
     story = []
@@ -528,8 +432,8 @@ def generer_rapport_annuel_pdf(request, annee_id):
     ]))
     story.append(cahiers_table)
     
-    # Générer les bilans mensuels pour le graphique
-    bilans_mensuels = BilanMensuel.generer_tous_bilans_mensuels(annee)
+    # Bilans mensuels enregistrés pour l'évolution
+    bilans_mensuels = BilanMensuel.get_bilans_annee(annee)
     story.append(Spacer(1, 0.5 * cm))
     
     # Évolution mensuelle
@@ -577,9 +481,3 @@ def generer_rapport_annuel_pdf(request, annee_id):
     
     # Construire le PDF
     doc.build(story)
-    buffer.seek(0)
-    
-    # Retourner le PDF
-    response = HttpResponse(buffer, content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="rapport_annuel_{annee.annee_debut}_{annee.annee_fin}.pdf"'
-    return response
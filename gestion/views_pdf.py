@@ -1,5 +1,5 @@
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.http import FileResponse, Http404, HttpResponse
 from django.template.loader import get_template
 from django.utils import timezone
 from django.conf import settings
@@ -17,30 +17,184 @@ from datetime import datetime
 from PyPDF2 import PdfReader, PdfWriter, PageObject
 from io import BytesIO
 import os
+import tempfile
+from itertools import chain
 from decimal import Decimal
-from django.db.models import Sum
+from django.db.models import Case, F, Sum, Value, When
 from gestion.models import Ecoles, AnneeScolaire
+from gestion.conditions import donnees_conditionnelles, toutes_les_annees
+from gestion.factures import FactureData, obtenir_facture
 
 
+# Lignes par tableau : ReportLab découpe les longs tableaux en temps quadratique
+LIGNES_PAR_TABLEAU = 200
+
+
+def _tableau_historique(lignes, total=None):
+    """Un tableau de l'historique ; le dernier d'une année porte la ligne de total"""
+    entete = ['Date', 'Montant total', 'Montant payé', 'Montant restant', 'Statut']
+    data = [entete] + lignes
+    dernier = total is not None
+    if dernier:
+        data.append(total)
+    style = [
+        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -2 if dernier else -1), colors.beige),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ]
+    if dernier:
+        style += [
+            ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
+            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ]
+    tableau = Table(data, colWidths=[3*cm, 3*cm, 3*cm, 3*cm, 4*cm], repeatRows=1)
+    tableau.setStyle(TableStyle(style))
+    return tableau
+
+
+def _montants(montants):
+    return [f"{float(montant):.0f} F" for montant in montants]
+
+
+def _flowables_historique(ventes, annees, styles):
+    """Tableaux de l'historique produits au fil de la lecture des ventes, puis le résumé.
+
+    Un tableau est émis toutes les LIGNES_PAR_TABLEAU ventes : seules les lignes du tableau
+    en cours sont gardées en mémoire.
+    """
+    libelles = {annee.id: str(annee) for annee in annees}
+    nombre_ventes = 0
+    total_general = [Decimal('0')] * 3
+    annee_en_cours = None
+    lignes = []
+    total_annee = None
+
+    for annee_id, created_at, montant_lignes, montant_paye, reste, statut in ventes.iterator(chunk_size=500):
+        if annee_id != annee_en_cours:
+            if annee_en_cours is not None:
+                yield _tableau_historique(lignes, ['TOTAL'] + _montants(total_annee) + [''])
+                yield Spacer(1, 20)
+            annee_en_cours, lignes, total_annee = annee_id, [], [Decimal('0')] * 3
+            if len(annees) > 1:
+                yield Paragraph(f"<b>Année scolaire {libelles[annee_id]}</b>", styles['Heading3'])
+        elif len(lignes) == LIGNES_PAR_TABLEAU:
+            yield _tableau_historique(lignes)
+            lignes = []
+
+        montants = (Decimal(montant_lignes), Decimal(montant_paye), Decimal(reste))
+        lignes.append([created_at.strftime('%d/%m/%Y')] + _montants(montants) + [statut])
+        total_annee = [total + montant for total, montant in zip(total_annee, montants)]
+        total_general = [total + montant for total, montant in zip(total_general, montants)]
+        nombre_ventes += 1
+
+    if annee_en_cours is None:
+        yield Paragraph("Aucune vente trouvée pour cette école sur la période demandée.", styles['Normal'])
+        return
+    yield _tableau_historique(lignes, ['TOTAL'] + _montants(total_annee) + [''])
+    yield Spacer(1, 20)
+
+    # Résumé
+    yield Spacer(1, 10)
+    resume_style = ParagraphStyle(
+        'ResumeStyle',
+        parent=styles['Normal'],
+        fontSize=12,
+        textColor=colors.black,
+        leftIndent=20
+    )
+    total_ventes, total_paye, total_restant = total_general
+    yield Paragraph(f"<b>Résumé :</b>", resume_style)
+    yield Paragraph(f"• Nombre de ventes : {nombre_ventes}", resume_style)
+    yield Paragraph(f"• Chiffre d'affaires total : {float(total_ventes):.0f} F", resume_style)
+    yield Paragraph(f"• Montant total payé : {float(total_paye):.0f} F", resume_style)
+    yield Paragraph(f"• Montant total restant : {float(total_restant):.0f} F", resume_style)
+    if total_ventes > 0:
+        pourcentage_paye = (total_paye / total_ventes) * 100
+        yield Paragraph(f"• Pourcentage payé : {pourcentage_paye:.1f}%", resume_style)
+
+
+class _FluxFlowables(list):
+    """Liste de flowables remplie à la demande depuis un générateur.
+
+    doc.build() consomme la liste par la tête en appelant len() à chaque tour : on n'y garde
+    que quelques éléments d'avance au lieu de tout le document.
+    """
+
+    def __init__(self, source, avance=2):
+        super().__init__()
+        self._source = iter(source)
+        self._avance = avance
+
+    def __len__(self):
+        while list.__len__(self) < self._avance:
+            suivant = next(self._source, None)
+            if suivant is None:
+                break
+            self.append(suivant)
+        return list.__len__(self)
+
+
+@donnees_conditionnelles(toutes_les_annees)
 def generer_pdf_ventes_ecole(request, ecole_id):
-    """Génère un PDF avec l'historique des ventes d'une école"""
+    """Génère un PDF avec l'historique des ventes d'une école.
+
+    Par défaut l'année active ; ?de=2022-2023&a=2024-2025 couvre les années existantes de la plage,
+    même si ses bornes ne sont pas en base.
+    """
     ecole = get_object_or_404(Ecoles, id=ecole_id)
     
-    # Filtrer par année scolaire courante
     annee_active = AnneeScolaire.get_annee_courante()
-    if not annee_active:
-        return HttpResponse("Aucune année scolaire active", status=400)
-    
-    ventes = Vente.objects.filter(
-        ecole=ecole, 
-        annee_scolaire=annee_active
-    ).prefetch_related('paiements', 'lignes').order_by('-updated_at')
-    
-    # Créer le buffer pour le PDF
-    buffer = BytesIO()
+    de = request.GET.get('de')
+    a = request.GET.get('a')
+    if de or a:
+        # Plage comparée sur annee_debut : les bornes n'ont pas à exister en base
+        debut_de = AnneeScolaire.debut_du_libelle(de) if de else None
+        debut_a = AnneeScolaire.debut_du_libelle(a) if a else None
+        if (de and debut_de is None) or (a and debut_a is None):
+            return HttpResponse("Année scolaire mal formée (format attendu : 2024-2025)", status=400)
+        if debut_a is None:
+            if not annee_active:
+                return HttpResponse("Aucune année scolaire active", status=400)
+            debut_a = annee_active.annee_debut
+        if debut_de is None:
+            debut_de = debut_a
+        annees = list(AnneeScolaire.objects.filter(
+            annee_debut__gte=min(debut_de, debut_a),
+            annee_debut__lte=max(debut_de, debut_a),
+        ).order_by('-annee_debut'))
+        if not annees:
+            raise Http404("Aucune année scolaire dans cette plage")
+    else:
+        # Filtrer par année scolaire courante
+        if not annee_active:
+            return HttpResponse("Aucune année scolaire active", status=400)
+        annees = [annee_active]
+    
+    periode = str(annees[0]) if len(annees) == 1 else f"{annees[-1]} à {annees[0]}"
+    
+    # Une seule requête, lue par lots : soldes persistés et statut calculés en SQL
+    ventes = Vente.objects.filter(ecole=ecole, annee_scolaire__in=annees)\
+        .annotate(
+            reste=F('total_lignes') - F('total_paye'),
+            statut=Case(
+                When(total_lignes__lte=F('total_paye'), then=Value('Payée')),
+                When(total_paye__gt=0, then=Value('Partiellement payée')),
+                default=Value('Non payée'),
+            ),
+        )\
+        .order_by('-annee_scolaire__annee_debut', '-updated_at')\
+        .values_list('annee_scolaire_id', 'created_at', 'total_lignes', 'total_paye', 'reste', 'statut')
+    
+    # Fichier temporaire plutôt qu'un buffer en mémoire, envoyé par morceaux
+    fichier = tempfile.TemporaryFile()
     
     # Créer le document PDF
-    doc = SimpleDocTemplate(buffer, pagesize=A4,
+    doc = SimpleDocTemplate(fichier, pagesize=A4,
                             leftMargin=2*cm, rightMargin=2*cm,
                             topMargin=2*cm, bottomMargin=2*cm)
     
@@ -58,561 +212,38 @@ def generer_pdf_ventes_ecole(request, ecole_id):
     )
     
     story.append(Paragraph(f"Historique des ventes - {ecole.nom}", titre_style))
-    story.append(Paragraph(f"Année scolaire : {annee_active}", styles['Normal']))
+    story.append(Paragraph(f"Année scolaire : {periode}", styles['Normal']))
     story.append(Paragraph(f"Date de génération : {timezone.now().strftime('%d/%m/%Y à %H:%M')}", styles['Normal']))
     story.append(Spacer(1, 20))
     
-    if ventes.exists():
-        # Préparer les données pour le tableau
-        data = [['Date', 'Montant total', 'Montant payé', 'Montant restant', 'Statut']]
-        
-        total_general = Decimal('0')
-        total_paye = Decimal('0')
-        total_restant = Decimal('0')
-        
-        for vente in ventes:
-            montant_lignes = vente.lignes.aggregate(total=Sum('montant'))['total'] or Decimal('0')
-            montant_paye = vente.paiements.filter(est_annule=False).aggregate(total=Sum('montant'))['total'] or Decimal('0')
-            montant_restant_vente = montant_lignes - montant_paye
-            
-            # Déterminer le statut
-            if montant_restant_vente <= 0:
-                statut = "Payée"
-            elif montant_paye > 0:
-                statut = "Partiellement payée"
-            else:
-                statut = "Non payée"
-            
-            data.append([
-                vente.created_at.strftime('%d/%m/%Y'),
-                f"{float(montant_lignes):.0f} F",
-                f"{float(montant_paye):.0f} F",
-                f"{float(montant_restant_vente):.0f} F",
-                statut
-            ])
-            
-            total_general += montant_lignes
-            total_paye += montant_paye
-            total_restant += montant_restant_vente
-        
-        # Ligne de total
-        data.append([
-            'TOTAL',
-            f"{float(total_general):.0f} F",
-            f"{float(total_paye):.0f} F", 
-            f"{float(total_restant):.0f} F",
-            ''
-        ])
-        
-        # Créer le tableau
-        tableau = Table(data, colWidths=[3*cm, 3*cm, 3*cm, 3*cm, 4*cm])
-        tableau.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        
-        story.append(tableau)
-        
-        # Résumé
-        story.append(Spacer(1, 30))
-        resume_style = ParagraphStyle(
-            'ResumeStyle',
-            parent=styles['Normal'],
-            fontSize=12,
-            textColor=colors.black,
-            leftIndent=20
-        )
-        
-        story.append(Paragraph(f"<b>Résumé :</b>", resume_style))
-        story.append(Paragraph(f"• Nombre de ventes : {ventes.count()}", resume_style))
-        story.append(Paragraph(f"• Chiffre d'affaires total : {float(total_general):.0f} F", resume_style))
-        story.append(Paragraph(f"• Montant total payé : {float(total_paye):.0f} F", resume_style))
-        story.append(Paragraph(f"• Montant total restant : {float(total_restant):.0f} F", resume_style))
-        
-        if total_general > 0:
-            pourcentage_paye = (total_paye / total_general) * 100
-            story.append(Paragraph(f"• Pourcentage payé : {pourcentage_paye:.1f}%", resume_style))
-    
-    else:
-        story.append(Paragraph("Aucune vente trouvée pour cette école pour l'année scolaire courante.", styles['Normal']))
-    
-    # Construire le PDF
-    doc.build(story)
-    
-    # Préparer la réponse
-    buffer.seek(0)
-    response = HttpResponse(buffer.read(), content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="historique_ventes_{ecole.nom.replace(" ", "_")}_{annee_active}.pdf"'
-    
-    buffer.close()
-    return response
-
-
-def generer_facture_pdf(request, vente_id):
-    vente = get_object_or_404(Vente, id=vente_id)
-    
-    vente.refresh_from_db()
-    
-    buffer = BytesIO()
-    
-    # Styles
-    styles_paragraph = getSampleStyleSheet()
-    style_cellule = styles_paragraph['BodyText']
-    style_cellule.wordWrap = 'CJK'
-    style_cellule.leading = 11
-    style_cellule.fontSize = 9
-    
-    # Créer le document PDF
-    doc = SimpleDocTemplate(buffer, pagesize=A4,
-                            leftMargin=2*cm, rightMargin=2*cm,
-                            topMargin=5.5*cm, bottomMargin=4*cm)
-    
-    story = []
-    styles = getSampleStyleSheet()
-    style_normal = styles["Normal"]
-    style_bold = styles["Heading4"]
-    style_important = styles["Heading3"]
-
-    
-    # Style pour le nom de l'école
-    style_header = ParagraphStyle(
-        'HeaderStyle',
-        parent=styles['Normal'],
-        fontSize=9,
-        fontName='Helvetica-Bold',
-        alignment=1,  
-        leading=10,
-        spaceBefore=0,
-        spaceAfter=0,
-        wordWrap='LTR'   
+    # Construire le PDF au fil de la lecture des ventes ; ReportLab garde seulement les pages déjà
+    # mises en page (flux compressés) jusqu'à l'écriture du fichier
+    doc.build(_FluxFlowables(chain(story, _flowables_historique(ventes, annees, styles))))
+    fichier.seek(0)
+    
+    nom_periode = str(annees[0]) if len(annees) == 1 else f"{annees[-1]}_{annees[0]}"
+    return FileResponse(
+        fichier,
+        as_attachment=True,
+        filename=f'historique_ventes_{ecole.nom.replace(" ", "_")}_{nom_periode}.pdf',
+        content_type='application/pdf',
     )
 
-    # Style pour les valeurs
-    style_ecole = ParagraphStyle(
-        'EcoleStyle',
-        parent=styles['Normal'],
-        fontSize=9,
-        fontName='Helvetica',
-        alignment=1,  
-        leading=10,
-        spaceBefore=0,
-        spaceAfter=0,
-        wordWrap='LTR'   
-    )
-    
-    # Style pour le nom de l'école en rouge
-    style_nom_ecole = ParagraphStyle(
-        'NomEcoleStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        fontName='Helvetica-Bold',
-        alignment=1,  # Centré
-        textColor=colors.darkred,
-        spaceBefore=0,
-        spaceAfter=5
-    )
-    style_representant = ParagraphStyle(
-        'RepresentantEcoleStyle',
-        parent=styles['Normal'],
-        fontSize=10,
-        fontName='Helvetica-Bold',
-        alignment=1,  # Centré
-        textColor=colors.black,
-        spaceBefore=0,
-        spaceAfter=5
-    )
-    
-    # Informations de la facture
-    representant = vente.ecole.representant if vente.ecole.representant else "—"
-    numero_facture = f"F-{datetime.now().year}-{str(vente.id)[:8]}"
-    date_creation_str = vente.created_at.strftime('%d-%m-%Y') if vente.created_at else "—"
-    date_modif_str = vente.modified_at.strftime('%d-%m-%Y') if vente.modified_at else "—"
-    date_paiement = vente.date_paiement.strftime('%d-%m-%Y') if vente.date_paiement else "—"
-    
-    # Afficher le nom de l'école en rouge au-dessus du tableau
-    story.append(Paragraph(vente.ecole.nom, style_nom_ecole))
-    story.append(Paragraph(f"<b>Représenté par :</b> {representant}", style_representant))
-    story.append(Spacer(0.1, 0.2 * cm))
-    
-    # Tableau d'en-tête avec informations (sans la colonne école)
-    info_data = [
-        [
-            Paragraph("FACTURE", style_header),
-            Paragraph("DATE D'ÉDITION", style_header),
-            Paragraph("DATE DE MODIFICATION", style_header),
-            Paragraph("DATE DE PAIEMENT", style_header),
-            Paragraph("ANNÉE SCOLAIRE", style_header)
-        ],
-        [
-            Paragraph(numero_facture, style_ecole),
-            Paragraph(date_creation_str, style_ecole),
-            Paragraph(date_modif_str, style_ecole),
-            Paragraph(date_paiement, style_ecole),
-            Paragraph(str(vente.annee_scolaire), style_ecole)
-        ]
-    ]
-
-    # Largeurs de colonnes (ajustées sans la colonne école)
-    info_table = Table(info_data, colWidths=[3*cm, 3*cm, 3*cm, 3*cm, 3*cm])
 
-    # Style du tableau
-    info_table_style = TableStyle([
-        ('GRID', (0,0), (-1,-1), 1.5, colors.black),
-        ('BACKGROUND', (0,0), (-1,0), colors.white),
-        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-        ('TOPPADDING', (0,0), (-1,-1), 4),
-        ('BOTTOMPADDING', (0,0), (-1,-1), 4),
-        ('LEFTPADDING', (0,0), (-1,-1), 5),
-        ('RIGHTPADDING', (0,0), (-1,-1), 5),
-    ])
-
-    info_table.setStyle(info_table_style)
-
-    story.append(info_table)
-    story.append(Spacer(0.1, 0.1 * cm))
-    
-    # Récupérer toutes les dettes de l'école par année
-    dettes_par_annee = vente.get_dettes_par_annee_ecole()
-    total_dettes_ecole = vente.get_total_dettes_ecole()
-    
-    # Affichage des dettes par année (s'il y en a)
-    if len(dettes_par_annee) > 0:
-        # Exclure la vente courante du calcul des autres dettes à afficher
-        dettes_autres = {k: v for k, v in dettes_par_annee.items() 
-                        if any(vte.id != vente.id for vte in v['ventes'])}
-        
-        if dettes_autres:
-            story.append(Paragraph("<b>HISTORIQUE DES DETTES PAR ANNÉE SCOLAIRE</b>", style_bold))
-            story.append(Spacer(0.1, 0.1*cm))
-            
-            # Tableau des dettes par année
-            dettes_data = [["Année scolaire", "Montant articles", "Total", "Payé", "Restant dû"]]
-            
-            for annee_str, dette_info in dettes_autres.items():
-                dettes_data.append([
-                    str(dette_info['annee_scolaire']),
-                    f"{dette_info['montant_articles']:.2f} F",
-                    f"{dette_info['montant_total']:.2f} F",
-                    f"{dette_info['montant_paye']:.2f} F",
-                    f"{dette_info['montant_restant']:.2f} F"
-                ])
-            
-            table_dettes = Table(dettes_data, colWidths=[3*cm, 3*cm, 3*cm, 3*cm, 3*cm])
-            table_style_dettes = TableStyle([
-                ('BACKGROUND', (0,0), (-1,0), colors.darkred),
-                ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
-                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0,0), (-1,0), 8),
-                ('BOTTOMPADDING', (0,0), (-1,0), 6),
-                ('TOPPADDING', (0,0), (-1,0), 3),
-                ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
-                ('FONTSIZE', (0,1), (-1,-1), 8),
-                ('TOPPADDING', (0,1), (-1,-1), 3),
-                ('BOTTOMPADDING', (0,1), (-1,-1), 3),
-                ('ALIGN', (0,0), (-1,-1), 'CENTER'),
-                ('GRID', (0,0), (-1,-1), 1, colors.black),
-                ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ])
-            
-            # Alterner les couleurs des lignes
-            for i in range(1, len(dettes_data), 2):
-                if i < len(dettes_data):
-                    table_style_dettes.add('BACKGROUND', (0,i), (-1,i), colors.lightgrey)
-            
-            table_dettes.setStyle(table_style_dettes)
-            story.append(table_dettes)
-            story.append(Spacer(0.2, 0.3*cm))
-    
-    # Sessions d'articles de cette facture
-    sessions = vente.get_articles_par_session()
-    
-    if sessions:
-        story.append(Paragraph("<b>ARTICLES DE CETTE FACTURE PAR SESSION</b>", style_bold))
-        story.append(Spacer(0.1, 0.1*cm))
-        
-        for i, session in enumerate(sessions, 1):
-            # Titre de la session
-            session_title = f"SESSION #{i} - {session['date_session'].strftime('%d-%m-%Y %H:%M')}"
-            story.append(Paragraph(f"<b>{session_title}</b>", style_normal))
-            story.append(Spacer(0.1, 0.1*cm))
-            
-            # Tableau des articles de cette session
-            session_data = [["Cahier", "Quantité", "Prix Unitaire", "Total"]]
-            
-            for ligne in session['lignes']:
-                session_data.append([
-                    Paragraph(ligne.cahier.titre, style_cellule),
-                    str(ligne.quantite),
-                    f"{ligne.cahier.prix:.2f} F",
-                    f"{ligne.montant:.2f} F"
-                ])
-            
-            table_session = Table(session_data, colWidths=[8*cm, 2.5*cm, 3*cm, 3*cm])
-            table_style_session = TableStyle([
-                ('BACKGROUND', (0,0), (-1,0), colors.blue),
-                ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
-                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0,0), (-1,0), 10),
-                ('BOTTOMPADDING', (0,0), (-1,0), 6),
-                ('TOPPADDING', (0,0), (-1,0), 3),
-                ('FONTNAME', (0,1), (-1,-1), 'Helvetica'),
-                ('FONTSIZE', (0,1), (-1,-1), 10),
-                ('TOPPADDING', (0,1), (-1,-1), 3),
-                ('BOTTOMPADDING', (0,1), (-1,-1), 3),
-                ('ALIGN', (0,0), (-1,-1), 'CENTER'),
-                ('GRID', (0,0), (-1,-1), 1, colors.black),
-                ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ])
-            
-            # Alterner les couleurs des lignes
-            for j in range(1, len(session_data), 2):
-                if j < len(session_data):
-                    table_style_session.add('BACKGROUND', (0,j), (-1,j), colors.lightgrey)
-            
-            table_session.setStyle(table_style_session)
-            story.append(table_session)
-            
-            # Sous-total de la session
-            story.append(Spacer(0.1, 0.2*cm))
-            story.append(Paragraph(f"<b>Sous-total session #{i} : {session['montant_total']:.2f} F</b>", style_normal))
-            story.append(Spacer(0.2, 0.3*cm))
-    
-    # Récapitulatif financier
-    montant_total_articles = sum(Decimal(str(ligne.montant)) for ligne in vente.lignes.all())
-    montant_total_facture = montant_total_articles
-    
-    # Calculs des paiements (exclure les paiements annulés)
-    paiements_vente = vente.paiements.filter(est_annule=False).order_by('date_paiement')
-    montant_paye = sum(Decimal(str(p.montant)) for p in paiements_vente)
-    montant_restant_facture = montant_total_facture - montant_paye
-    
-    story.append(Spacer(1, 0.3*cm))
-    
-    # Préparation des données du récapitulatif
-    recap_data = []
-    
-    # Ligne articles
-    recap_data.append([
-        "Sous-total des articles :",
-        f"{montant_total_articles:.2f} F"
-    ])
-    
-    # Ligne total de cette facture
-    recap_data.append([
-        "Total de la facture :",
-        f"{montant_total_facture:.2f} F"
-    ])
-    
-    # Ligne montant payé
-    recap_data.append([
-        "Paiements reçus :",
-        f"{montant_paye:.2f} F" if montant_paye > 0 else "Aucun paiement"
-    ])
-    
-    # Calculer les dettes antérieures (excluant la vente courante)
-    dettes_autres = {k: v for k, v in dettes_par_annee.items() 
-                    if any(vte.id != vente.id for vte in v['ventes'])}
-    total_dettes_autres = sum(Decimal(str(dette_info['montant_restant'])) for dette_info in dettes_autres.values())
-    
-    # Colonne STATUS (tenir compte des dettes antérieures)
-    if montant_restant_facture > 0:
-        # Facture courante pas totalement payée
-        if vente.montant_paye == 0:
-            status_text = "IMPAYÉ"
-        else:
-            status_text = "PARTIELLEMENT PAYÉ"
-    else:
-        # Facture courante payée, mais vérifier les dettes antérieures
-        if total_dettes_autres > 0:
-            status_text = "PARTIELLEMENT PAYÉ"  # Facture payée mais dettes restantes
-        else:
-            status_text = "PAYÉ"  # Tout est payé
-    
-    recap_data.append([
-        "Status :",
-        status_text
-    ])
-    
-    # Colonne RESTE À PAYER avec indication de la nature du montant
-    total_reste_a_payer = montant_restant_facture + total_dettes_autres
-    
-    if total_reste_a_payer > 0:
-        # Déterminer le libellé approprié avec parenthèses pour clarification
-        if montant_restant_facture > 0 and total_dettes_autres > 0:
-            # Il y a à la fois du reste sur facture ET des dettes antérieures
-            libelle_reste = "Reste à payer (Dette + Reste) :"
-        elif total_dettes_autres > 0 and montant_restant_facture == 0:
-            # Seulement des dettes antérieures
-            libelle_reste = "Reste à payer (Dette) :"
-        else:
-            # Seulement du reste sur la facture courante
-            libelle_reste = "Reste à payer (Reste) :"
-        
-        recap_data.append([
-            libelle_reste,
-            f"{total_reste_a_payer:.2f} F"
-        ])
-    else:
-        recap_data.append([
-            "Reste à payer :",
-            "0 F"
-        ])
-    
-    # Si il y a d'autres dettes, ajouter le total global
-    if len(dettes_par_annee) > 1:
-        recap_data.append([
-            "Encours global de l'établissement :",
-            f"{total_dettes_ecole:.2f} F"
-        ])
-    
-    recap_table = Table(recap_data, colWidths=[10*cm, 6.5*cm])
-    recap_table_style = TableStyle([
-        ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
-        ('FONTSIZE', (0,0), (-1,-1), 10),
-        ('ALIGN', (0,0), (0,-1), 'LEFT'),     
-        ('ALIGN', (1,0), (1,-1), 'RIGHT'),    
-        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-        ('GRID', (0,0), (-1,-1), 1, colors.black),
-        ('TOPPADDING', (0,0), (-1,-1), 4),
-        ('BOTTOMPADDING', (0,0), (-1,-1), 4),
-        ('LEFTPADDING', (0,0), (-1,-1), 6),
-        ('RIGHTPADDING', (0,0), (-1,-1), 6),
-    ])
-    
-    # Mise en forme spéciale pour certaines lignes
-    ligne_total_facture = 1  
-    ligne_status = 2  # Position de la ligne Status
-    ligne_reste_a_payer = 3  # Position de la ligne Reste à payer/Dette/etc.
-    
-    # Ligne total facture en gris
-    recap_table_style.add('BACKGROUND', (0,ligne_total_facture), (-1,ligne_total_facture), colors.lightgrey)
-    recap_table_style.add('FONTNAME', (0,ligne_total_facture), (-1,ligne_total_facture), 'Helvetica-Bold')
-    
-    # Colorer la ligne STATUS selon l'état
-    if status_text == "PAYÉ":
-        recap_table_style.add('BACKGROUND', (0,ligne_status), (-1,ligne_status), colors.lightgreen)
-        recap_table_style.add('TEXTCOLOR', (0,ligne_status), (-1,ligne_status), colors.darkgreen)
-        recap_table_style.add('FONTNAME', (0,ligne_status), (-1,ligne_status), 'Helvetica-Bold')
-    elif status_text == "PARTIELLEMENT PAYÉ":
-        recap_table_style.add('BACKGROUND', (0,ligne_status), (-1,ligne_status), colors.lightyellow)
-        recap_table_style.add('TEXTCOLOR', (0,ligne_status), (-1,ligne_status), colors.orange)
-        recap_table_style.add('FONTNAME', (0,ligne_status), (-1,ligne_status), 'Helvetica-Bold')
-    elif status_text == "IMPAYÉ":
-        recap_table_style.add('BACKGROUND', (0,ligne_status), (-1,ligne_status), colors.lightcoral)
-        recap_table_style.add('TEXTCOLOR', (0,ligne_status), (-1,ligne_status), colors.darkred)
-        recap_table_style.add('FONTNAME', (0,ligne_status), (-1,ligne_status), 'Helvetica-Bold')
-    
-    # Colorer la ligne "reste à payer" selon l'état
-    if total_reste_a_payer <= 0:
-        recap_table_style.add('BACKGROUND', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), colors.lightgreen)
-        recap_table_style.add('TEXTCOLOR', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), colors.darkgreen)
-        recap_table_style.add('FONTNAME', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), 'Helvetica-Bold')
-    else:
-        recap_table_style.add('BACKGROUND', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), colors.lightyellow)
-        recap_table_style.add('TEXTCOLOR', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), colors.orange)
-        recap_table_style.add('FONTNAME', (0,ligne_reste_a_payer), (-1,ligne_reste_a_payer), 'Helvetica-Bold')
-    
-    # Si il y a un total des dettes école, le mettre en évidence
-    if len(dettes_par_annee) > 1:
-        ligne_total_ecole = len(recap_data) - 1
-        recap_table_style.add('BACKGROUND', (0,ligne_total_ecole), (-1,ligne_total_ecole), colors.lightyellow)
-        recap_table_style.add('FONTNAME', (0,ligne_total_ecole), (-1,ligne_total_ecole), 'Helvetica-Bold')
-        recap_table_style.add('FONTSIZE', (0,ligne_total_ecole), (-1,ligne_total_ecole), 11)
-    
-    recap_table.setStyle(recap_table_style)
-    story.append(recap_table)
-    story.append(Spacer(1, 0.5*cm))
-    if paiements_vente.exists():
-        style_paiement = ParagraphStyle(
-            'PaiementStyle',
-            parent=styles['Normal'],
-            fontSize=10,
-            fontName='Helvetica',
-            textColor=colors.red,
-            spaceBefore=2,
-            spaceAfter=2
-        )
-        
-        style_paiement_bold = ParagraphStyle(
-            'PaiementBoldStyle',
-            parent=styles['Normal'],
-            fontSize=10,
-            fontName='Helvetica-Bold',
-            textColor=colors.darkred,
-            spaceBefore=2,
-            spaceAfter=2
-        )
-        
-        story.append(Paragraph("<b>HISTORIQUE DES PAIEMENTS :</b>", style_paiement_bold))
-        for paiement in paiements_vente:
-            paiement_text = f"Tranche {paiement.numero_tranche} : {paiement.montant:.2f} FCFA payé le {paiement.date_paiement.strftime('%d-%m-%Y')}"
-            story.append(Paragraph(paiement_text, style_paiement_bold))
-        
-    story.append(Spacer(1, 0.5*cm))
-    story.append(Paragraph("Merci pour votre confiance !", 
-                          ParagraphStyle('Thanks', parent=styles['Normal'], 
-                                       alignment=TA_CENTER, fontSize=12, 
-                                       textColor=colors.darkblue)))
-    story.append(Spacer(1, 0.2*cm))
-    story.append(Paragraph(f"Facture générée le {timezone.now().strftime('%d/%m/%Y à %H:%M')}", 
-                          ParagraphStyle('Generated', parent=styles['Normal'], 
-                                       alignment=TA_CENTER, fontSize=8, 
-                                       textColor=colors.grey)))
-    
-    # Construire le PDF principal
-    doc.build(story)
-    buffer.seek(0)
+@donnees_conditionnelles(toutes_les_annees)
+def generer_facture_pdf(request, vente_id):
+    try:
+        donnees = FactureData.charger(vente_id)
+    except Vente.DoesNotExist:
+        raise Http404("Vente introuvable")
+    vente = donnees.vente
     
-    # Tentative de fusion avec le papier en-tête
-    papier_en_tete_path = os.path.join(settings.BASE_DIR, 'static/admin/fa.pdf')
-    papier_signature_path = os.path.join(settings.BASE_DIR, 'static/admin/FACTURE.pdf')
-    final_buffer = BytesIO()
-
-    if os.path.exists(papier_en_tete_path) and os.path.exists(papier_signature_path):
-        try:
-            modele_pdf = PdfReader(papier_en_tete_path)  
-            modele_signature_pdf = PdfReader(papier_signature_path) 
-            tableau_pdf = PdfReader(buffer)
-            writer = PdfWriter()
-            
-            total_pages = len(tableau_pdf.pages)
-            
-            for idx, page_tableau in enumerate(tableau_pdf.pages):
-                if idx == total_pages - 1: 
-                    fond = modele_signature_pdf.pages[0]
-                else:
-                    fond = modele_pdf.pages[0]
-                
-                page_fusionnee = PageObject.create_blank_page(
-                    width=fond.mediabox.width,
-                    height=fond.mediabox.height
-                )
-                page_fusionnee.merge_page(fond)
-                page_fusionnee.merge_page(page_tableau)
-                writer.add_page(page_fusionnee)
-            
-            writer.write(final_buffer)
-            final_buffer.seek(0)
-            
-        except Exception as pdf_error:
-            print(f"Erreur lors de la fusion PDF : {pdf_error}")
-            final_buffer = buffer
-    else:
-        print(f"Fichier papier en-tête introuvable")
-        final_buffer = buffer
-
+    # Relue depuis le fichier rendu tant que la vente n'a pas changé
+    contenu = obtenir_facture(donnees)
     
     # Créer la réponse HTTP
     response = HttpResponse(content_type='application/pdf')
     response['Content-Disposition'] = f'attachment; filename="facture_{vente.ecole.nom.replace(" ", "_")}_{vente.id}.pdf"'
-    response.write(final_buffer.getvalue())
+    response.write(contenu)
     
     return response